@@ -2,15 +2,24 @@
 猫课电商管理落地班核心工具 - Flask主应用
 """
 import os
-import json
 import logging
 from datetime import datetime, timedelta
+from typing import Optional
 from logging.handlers import RotatingFileHandler
-from flask import Flask, render_template, request, jsonify, send_file, session, Response
+from flask import Flask, render_template, request, jsonify, send_file, session, Response, stream_with_context
 from io import BytesIO
 from config import Config
 from database import db
 from modules.ai_service import ai_service
+from modules.ai_gateway import ai_gateway
+from modules.ai_router import ai_router
+from modules.ai_cache import ai_cache
+from modules.ai_ledger import ai_ledger, GROUP_FIELDS, STATUS_OK, STATUS_ERROR, STATUS_REJECTED
+from modules.ai_profiles import ai_profiles, profile_usage, PROFILE_ADMIN_REPORT, PROFILE_INTERACTIVE_CHAT
+from modules.ai_scheduler import ai_scheduler, AISchedulerTimeout, PRIORITY_ANALYSIS
+from modules.image_pipeline import image_preprocessor
+from modules.sse_codec import coalesce, sse_frame
+from modules.token_budget import MESSAGE_OVERHEAD_TOKENS, context_budget, estimate_tokens, truncate_tokens
 from modules.prompts import get_system_prompt, get_welcome_message, get_input_guide
 from modules.auth_service import auth_service
 from modules.memory_service import memory_service
@@ -64,71 +73,100 @@ app.config['SESSION_COOKIE_SECURE'] = True  # 仅 HTTPS
 app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'  # 防止 CSRF
 
+# 每个 worker 启动发件箱补写线程（本机积压的回退写入在 Supabase 恢复后自动补写）
+db.outbox.start()
+# 会话归档线程（配置 ARCHIVE_IDLE_DAYS 后启用，多个 worker 通过租约只有一个在执行）
+db.archive.start()
+# 预热到 AI 服务商的 keep-alive 连接（后台进行，不阻塞启动）
+ai_gateway.warm_up([
+    base_url for api_key, base_url in (
+        (Config.CLOSEAI_API_KEY, Config.CLOSEAI_BASE_URL),
+        (Config.YUNWU_API_KEY, Config.YUNWU_BASE_URL)
+    ) if api_key
+])
 
-@app.before_request
-def csrf_protect():
-    """
-    CSRF 防护：验证 POST/PUT/DELETE 请求的来源
-    对于 JSON API，检查 Origin 或 Referer 头
-    """
-    # 跳过安全方法
-    if request.method in ('GET', 'HEAD', 'OPTIONS'):
-        return
 
-    # 跳过健康检查
-    if request.path == '/health':
-        return
+@app.before_request
+def begin_session_cache_scope():
+    """开启请求级会话缓存（同一请求内重复读取同一会话只查一次库）"""
+    db.session_cache.begin_request()
+
+
+@app.teardown_request
+def end_session_cache_scope(exc):
+    """请求结束（流式响应在输出完毕后）清空请求级会话缓存"""
+    db.session_cache.end_request()
+
+
+# 允许的请求来源（CSRF 防护）
+CSRF_ALLOWED_ORIGINS = [
+    'http://localhost',
+    'http://127.0.0.1',
+    'https://kpi.longgonghuohuo.com',
+    'http://kpi.longgonghuohuo.com',
+    'https://ai.maoke123.com',
+    'http://ai.maoke123.com',
+    'https://www.ai.maoke123.com',
+    'http://www.ai.maoke123.com',
+    'https://maoke123.com',
+    'http://maoke123.com',
+    'https://www.maoke123.com',
+    'http://www.maoke123.com',
+]
 
-    # 获取允许的来源
-    allowed_origins = [
-        'http://localhost',
-        'http://127.0.0.1',
-        'https://kpi.longgonghuohuo.com',
-        'http://kpi.longgonghuohuo.com',
-        'https://ai.maoke123.com',
-        'http://ai.maoke123.com',
-        'https://www.ai.maoke123.com',
-        'http://www.ai.maoke123.com',
-        'https://maoke123.com',
-        'http://maoke123.com',
-        'https://www.maoke123.com',
-        'http://www.maoke123.com',
-    ]
 
-    # 本地开发时允许任意端口
-    origin = request.headers.get('Origin', '')
-    referer = request.headers.get('Referer', '')
+def _check_request_origin(origin: str, referer: str, path: str) -> bool:
+    """
+    检查 POST/PUT/DELETE 请求的来源（csrf_protect 和 asgi.py 共用）
 
+    Returns:
+        True 放行，False 拦截
+    """
     # 检查 Origin 头（优先）
     if origin:
         # 本地开发：允许 localhost 和 127.0.0.1 的任意端口
         if origin.startswith('http://localhost:') or origin.startswith('http://127.0.0.1:'):
-            return
+            return True
         # 检查是否在允许列表
-        if any(origin.startswith(allowed) for allowed in allowed_origins):
-            return
+        if any(origin.startswith(allowed) for allowed in CSRF_ALLOWED_ORIGINS):
+            return True
         # Origin 不匹配，记录并拒绝
-        logger.warning(f"CSRF 拦截：非法 Origin - {origin}, 路径: {request.path}")
-        return jsonify({'success': False, 'error': '请求来源不合法'}), 403
+        logger.warning(f"CSRF 拦截：非法 Origin - {origin}, 路径: {path}")
+        return False
 
     # 如果没有 Origin，检查 Referer
     if referer:
-        if any(referer.startswith(allowed) for allowed in allowed_origins):
-            return
+        if any(referer.startswith(allowed) for allowed in CSRF_ALLOWED_ORIGINS):
+            return True
         if referer.startswith('http://localhost:') or referer.startswith('http://127.0.0.1:'):
-            return
-        logger.warning(f"CSRF 拦截：非法 Referer - {referer}, 路径: {request.path}")
-        return jsonify({'success': False, 'error': '请求来源不合法'}), 403
+            return True
+        logger.warning(f"CSRF 拦截：非法 Referer - {referer}, 路径: {path}")
+        return False
+
+    # 没有 Origin 和 Referer 的请求（如 curl 测试）：JSON 请求通常是安全的
+    # （浏览器跨站请求不能设置自定义 Content-Type），其他情况也允许（兼容旧客户端）
+    logger.debug(f"CSRF 检查跳过：无 Origin/Referer，路径: {path}")
+    return True
+
 
-    # 对于没有 Origin 和 Referer 的请求（如 curl 测试），检查 Content-Type
-    # 浏览器发起的跨站请求通常不会设置 application/json
-    content_type = request.headers.get('Content-Type', '')
-    if 'application/json' in content_type:
-        # JSON 请求通常是安全的（浏览器跨站请求不能设置自定义 Content-Type）
+@app.before_request
+def csrf_protect():
+    """
+    CSRF 防护：验证 POST/PUT/DELETE 请求的来源
+    对于 JSON API，检查 Origin 或 Referer 头
+    """
+    # 跳过安全方法
+    if request.method in ('GET', 'HEAD', 'OPTIONS'):
         return
 
-    # 其他情况：允许（兼容旧客户端）
-    logger.debug(f"CSRF 检查跳过：无 Origin/Referer，路径: {request.path}")
+    # 跳过健康检查
+    if request.path == '/health':
+        return
+
+    origin = request.headers.get('Origin', '')
+    referer = request.headers.get('Referer', '')
+    if not _check_request_origin(origin, referer, request.path):
+        return jsonify({'success': False, 'error': '请求来源不合法'}), 403
 
 
 # ========================================
@@ -356,11 +394,7 @@ def chat_api():
                 '_claimed_by': user_id,
                 '_claimed_at': datetime.now().isoformat()
             })
-            if db.use_supabase:
-                db.supabase.table('sessions').update({
-                    'user_id': user_id,
-                    'user_email': session.get('email', '')
-                }).eq('id', session_id).execute()
+            db.claim_session(session_id, user_id, session.get('email', ''))
             logger.info(f"会话 {session_id} 已关联到用户 {user_id}")
         except Exception as e:
             logger.warning(f"关联会话所有者失败: {e}")
@@ -376,40 +410,21 @@ def chat_api():
             'admin_wechat': '猫课工作人员'
         }), 402
 
-    # 保存用户消息
-    db.add_message(session_id, 'user', message)
-
-    # 获取对话历史
-    messages = db.get_messages_for_api(session_id)
-
-    # 获取用户记忆上下文（跨模块）
-    user_memory_context = None
-    if user_id:
-        user_memory_context = memory_service.get_memory_context(user_id)
+    # 保存用户消息（保存失败时不调用 AI、不扣积分）
+    if not db.add_message(session_id, 'user', message):
+        return jsonify({'success': False, 'error': '保存消息失败，请稍后重试'}), 503
 
-    # 获取知识库上下文
-    knowledge_context = prompt_service.get_knowledge_context(chat_session['module'])
-
-    # 合并记忆和知识库上下文
-    combined_context = ""
-    if user_memory_context:
-        combined_context += user_memory_context
-    if knowledge_context:
-        combined_context += knowledge_context
-
-    # 获取系统提示词（注入记忆和知识库）
-    system_prompt = get_system_prompt(
-        chat_session['module'],
-        chat_session['collected_data'],
-        combined_context if combined_context else None
-    )
+    # 获取系统提示词（注入记忆和知识库），对话历史用剩下的上下文预算
+    system_prompt, budget = _build_system_prompt(chat_session, user_id)
+    messages = db.get_messages_for_api(session_id, max_tokens=budget.remaining)
 
     try:
         # 调用AI
         response = ai_service.chat(
             messages=messages,
             system_prompt=system_prompt,
-            model=model
+            model=model,
+            profile=PROFILE_INTERACTIVE_CHAT
         )
 
         # 保存AI回复
@@ -417,10 +432,7 @@ def chat_api():
 
         # 异步提取用户画像（后台执行，不阻塞响应）
         try:
-            # 获取最新消息列表
-            updated_session = db.get_session(session_id)
-            if updated_session and user_id:
-                memory_service.extract_and_update(user_id, updated_session['messages'])
+            _extract_memory_async(user_id, session_id)
         except Exception as mem_err:
             logger.warning(f"用户画像提取失败（不影响主流程）: {mem_err}")
 
@@ -488,12 +500,16 @@ def _generate_thinking_steps(module: str, message: str) -> list:
     return unique_steps[:5]  # 最多 5 个步骤
 
 
-@app.route('/api/chat/stream', methods=['POST'])
-def chat_stream_api():
-    """流式对话 - 逐字返回（打字机效果）- 支持图片和文档"""
-    data = request.get_json()
+def _prepare_chat_stream(data: dict, user_id: Optional[str], user_email: str):
+    """
+    流式对话的准备阶段（WSGI 路由和 asgi.py 共用）：校验参数 / 登录 / 会话所有权 / 积分，
+    提取文档文本，保存用户消息，组装对话历史和系统提示词
+
+    Returns:
+        (ctx, None) 或 (None, (错误响应 dict, HTTP 状态码))
+    """
     if not data:
-        return jsonify({'success': False, 'error': '无效的请求数据'}), 400
+        return None, ({'success': False, 'error': '无效的请求数据'}, 400)
 
     session_id = data.get('session_id')
     message = data.get('message', '').strip()
@@ -503,20 +519,19 @@ def chat_stream_api():
 
     # 必须有文字或图片或文档
     if not session_id or (not message and not images and not documents):
-        return jsonify({'success': False, 'error': '缺少必要参数'}), 400
+        return None, ({'success': False, 'error': '缺少必要参数'}, 400)
 
     chat_session = db.get_session(session_id)
     if not chat_session:
-        return jsonify({'success': False, 'error': '会话不存在'}), 404
+        return None, ({'success': False, 'error': '会话不存在'}, 404)
 
     # 检查用户登录
-    user_id = session.get('user_id')
     if not user_id:
-        return jsonify({
+        return None, ({
             'success': False,
             'error': '请先登录后再使用',
             'need_login': True
-        }), 401
+        }, 401)
 
     # 验证会话所有权（增强版：修复旧会话访问漏洞）
     session_owner_id = chat_session.get('user_id')
@@ -524,7 +539,7 @@ def chat_stream_api():
     if session_owner_id:
         # 会话已有所有者，必须是当前用户
         if session_owner_id != user_id:
-            return jsonify({'success': False, 'error': '无权访问此会话'}), 403
+            return None, ({'success': False, 'error': '无权访问此会话'}, 403)
     else:
         # 会话没有所有者（旧会话），自动关联到当前用户
         try:
@@ -532,11 +547,7 @@ def chat_stream_api():
                 '_claimed_by': user_id,
                 '_claimed_at': datetime.now().isoformat()
             })
-            if db.use_supabase:
-                db.supabase.table('sessions').update({
-                    'user_id': user_id,
-                    'user_email': session.get('email', '')
-                }).eq('id', session_id).execute()
+            db.claim_session(session_id, user_id, user_email)
             logger.info(f"会话 {session_id} 已关联到用户 {user_id}")
         except Exception as e:
             logger.warning(f"关联会话所有者失败: {e}")
@@ -545,12 +556,16 @@ def chat_stream_api():
     credits_cost = auth_service.CREDITS_PER_CHAT
     current_credits = auth_service.get_credits(user_id)
     if current_credits < credits_cost:
-        return jsonify({
+        return None, ({
             'success': False,
             'error': f'积分不足！当前积分: {current_credits}，需要: {credits_cost}。请联系猫课工作人员进行充值。',
             'credits_exhausted': True,
             'admin_wechat': '猫课工作人员'
-        }), 402
+        }, 402)
+
+    # 图片缩小、重新编码、去重后再发给 AI（asgi.py 下整个准备阶段在线程里执行，不占事件循环）
+    if images:
+        images, _ = image_preprocessor.process(images)
 
     # 处理文档文件，提取文本内容
     document_texts = []
@@ -601,10 +616,17 @@ def chat_stream_api():
             display_message = f"[{', '.join(attachments)}]"
     if not display_message:
         display_message = '[附件]'
-    db.add_message(session_id, 'user', display_message)
+    # 保存失败时不调用 AI、不扣积分
+    if not db.add_message(session_id, 'user', display_message):
+        return None, ({'success': False, 'error': '保存消息失败，请稍后重试'}, 503)
+
+    # 获取系统提示词（注入记忆和知识库）
+    system_prompt, budget = _build_system_prompt(chat_session, user_id)
 
-    # 获取对话历史
-    messages = db.get_messages_for_api(session_id)
+    # 获取对话历史（文档全文不在保存的消息里，先从预算中扣除）
+    if document_texts:
+        budget.charge('documents', estimate_tokens(final_message))
+    messages = db.get_messages_for_api(session_id, max_tokens=budget.remaining)
 
     # 如果有文档内容，替换最后一条用户消息（用于发送给 AI，包含完整文档文本）
     if document_texts and messages:
@@ -614,25 +636,80 @@ def chat_stream_api():
                 messages[i] = {'role': 'user', 'content': final_message}
                 break
 
-    # 获取用户记忆上下文
-    user_memory_context = memory_service.get_memory_context(user_id) if user_id else None
+    return {
+        'session_id': session_id,
+        'module': chat_session['module'],
+        'user_id': user_id,
+        'message': message,
+        'model': model,
+        'images': images,
+        'messages': messages,
+        'system_prompt': system_prompt
+    }, None
+
 
-    # 获取知识库上下文
-    knowledge_context = prompt_service.get_knowledge_context(chat_session['module'])
+def _build_system_prompt(chat_session: dict, user_id: Optional[str]):
+    """
+    组装系统提示词（注入用户记忆和知识库），两者按上下文预算的分项上限截断
 
-    # 合并上下文
-    combined_context = ""
-    if user_memory_context:
-        combined_context += user_memory_context
-    if knowledge_context:
-        combined_context += knowledge_context
+    Returns:
+        (system_prompt, budget)；budget.remaining 即对话历史可用的 token 数
+    """
+    budget = context_budget.start()
+    user_memory_context = budget.take('memory', memory_service.get_memory_context(user_id) if user_id else None)
+    knowledge_context = budget.take('knowledge', prompt_service.get_knowledge_context(chat_session['module']))
 
-    # 获取系统提示词
+    # 合并记忆和知识库上下文
+    combined_context = user_memory_context + knowledge_context
     system_prompt = get_system_prompt(
         chat_session['module'],
         chat_session['collected_data'],
         combined_context if combined_context else None
     )
+    # 记忆和知识库已计入预算，这里补记提示词的其余部分
+    budget.charge('system', estimate_tokens(system_prompt) + MESSAGE_OVERHEAD_TOKENS - budget.spent('memory', 'knowledge'))
+    return system_prompt, budget
+
+
+def _extract_memory_async(user_id: str, session_id: str):
+    """从最新对话提取用户画像：交给 memory_service 的后台队列（线程数固定，同一用户合并，见 submit_extraction）"""
+    updated_session = db.get_session(session_id)
+    if not updated_session or not user_id:
+        return
+    memory_service.submit_extraction(user_id, list(updated_session['messages']))
+
+
+def _finish_chat_stream(ctx: dict, complete_response: str):
+    """
+    流式对话输出完毕后的收尾（WSGI 路由和 asgi.py 共用）：保存 AI 回复、提取用户画像、扣除积分
+
+    Returns:
+        (credits_used, remaining_credits)
+    """
+    session_id = ctx['session_id']
+    user_id = ctx['user_id']
+    db.add_message(session_id, 'assistant', complete_response)
+
+    # 异步提取用户画像（后台执行，不阻塞响应）
+    try:
+        _extract_memory_async(user_id, session_id)
+    except Exception as mem_err:
+        print(f"[Stream] 用户画像提取失败: {mem_err}")
+
+    # 扣除积分
+    credits_cost = auth_service.CREDITS_PER_CHAT
+    success, msg, remaining_credits = auth_service.use_credits(
+        user_id, credits_cost, f"AI对话 - {ctx['module']}"
+    )
+    return credits_cost, remaining_credits
+
+
+@app.route('/api/chat/stream', methods=['POST'])
+def chat_stream_api():
+    """流式对话 - 逐字返回（打字机效果）- 支持图片和文档"""
+    ctx, error = _prepare_chat_stream(request.get_json(), session.get('user_id'), session.get('email', ''))
+    if error:
+        return jsonify(error[0]), error[1]
 
     def generate():
         """生成器：流式返回 AI 响应"""
@@ -640,52 +717,39 @@ def chat_stream_api():
 
         try:
             # 发送思考状态（让用户看到 AI 正在思考）
-            thinking_steps = _generate_thinking_steps(chat_session['module'], message)
+            thinking_steps = _generate_thinking_steps(ctx['module'], ctx['message'])
             for step in thinking_steps:
-                yield f"data: {json.dumps({'thinking': step})}\n\n"
+                yield sse_frame({'thinking': step})
                 import time
                 time.sleep(0.3)  # 短暂延迟，让动画更自然
 
-            for chunk in ai_service.chat_stream(
-                messages=messages,
-                system_prompt=system_prompt,
-                model=model,
-                images=images  # 传递图片
-            ):
+            # 细碎的增量合并后再推（首段立即推送），减少 JSON 编码和写 socket 的次数
+            for chunk in coalesce(ai_service.chat_stream(
+                messages=ctx['messages'],
+                system_prompt=ctx['system_prompt'],
+                model=ctx['model'],
+                images=ctx['images'],  # 传递图片
+                profile=PROFILE_INTERACTIVE_CHAT
+            ), Config.AI_STREAM_FLUSH_INTERVAL, Config.AI_STREAM_FLUSH_CHARS):
                 if chunk.startswith('[ERROR]'):
                     # 发送错误
-                    yield f"data: {json.dumps({'error': chunk[7:]})}\n\n"
+                    yield sse_frame({'error': chunk[7:]})
                     return
                 else:
                     full_response.append(chunk)
-                    yield f"data: {json.dumps({'content': chunk})}\n\n"
+                    yield sse_frame({'content': chunk})
 
-            # 流结束，保存完整响应
-            complete_response = ''.join(full_response)
-            db.add_message(session_id, 'assistant', complete_response)
-
-            # 异步提取用户画像（后台执行，不阻塞响应）
-            try:
-                updated_session = db.get_session(session_id)
-                if updated_session and user_id:
-                    memory_service.extract_and_update(user_id, updated_session['messages'])
-            except Exception as mem_err:
-                print(f"[Stream] 用户画像提取失败: {mem_err}")
-
-            # 扣除积分
-            credits_cost = auth_service.CREDITS_PER_CHAT
-            success, msg, remaining_credits = auth_service.use_credits(
-                user_id, credits_cost, f"AI对话 - {chat_session['module']}"
-            )
+            # 流结束，保存完整响应、扣除积分
+            credits_cost, remaining_credits = _finish_chat_stream(ctx, ''.join(full_response))
 
             # 发送完成信号
-            yield f"data: {json.dumps({'done': True, 'credits_used': credits_cost, 'remaining_credits': remaining_credits})}\n\n"
+            yield sse_frame({'done': True, 'credits_used': credits_cost, 'remaining_credits': remaining_credits})
 
         except Exception as e:
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+            yield sse_frame({'error': str(e)})
 
     return Response(
-        generate(),
+        stream_with_context(generate()),
         mimetype='text/event-stream',
         headers={
             'Cache-Control': 'no-cache',
@@ -833,16 +897,17 @@ def resume_session(session_id):
 
     session_owner_id = chat_session.get('user_id')
 
+    # 冷存储中的会话恢复到热表（恢复失败时仍可只读查看）
+    if chat_session.get('archived') and session_owner_id in (None, user_id):
+        if not db.archive.restore(session_id):
+            logger.warning(f"恢复归档会话失败: {session_id}")
+
     # 🔴 修复：允许认领无主会话
     # 场景：用户未登录时创建了会话，后来登录了，应该能继续使用
     if session_owner_id is None:
         # 无主会话，当前用户可以认领
         try:
-            if db.use_supabase:
-                db.supabase.table('sessions').update({
-                    'user_id': user_id,
-                    'user_email': session.get('email', '')
-                }).eq('id', session_id).execute()
+            db.claim_session(session_id, user_id, session.get('email', ''))
             logger.info(f"用户 {user_id} 认领了无主会话 {session_id}")
         except Exception as e:
             logger.warning(f"认领会话失败: {e}")
@@ -1141,13 +1206,35 @@ def admin_get_me():
 
 @app.route('/api/admin/sessions', methods=['GET'])
 def admin_get_sessions():
-    """获取所有用户会话（包含用户详细信息）"""
+    """
+    获取用户会话（包含用户详细信息）
+
+    游标分页：返回 next_cursor，下一页带上 cursor 参数
+    过滤参数：user_email, user_id, module, status, date_from, date_to（YYYY-MM-DD）
+    """
     if not session.get('is_admin'):
         return jsonify({'success': False, 'error': '请先登录管理后台'}), 401
 
     try:
-        sessions_data = db.get_all_sessions_for_admin(limit=100)
+        limit = min(max(int(request.args.get('limit', 100)), 1), 500)
+    except ValueError:
+        return jsonify({'success': False, 'error': 'limit 参数无效'}), 400
+
+    try:
+        page = db.browse_sessions(
+            limit=limit,
+            cursor=request.args.get('cursor') or None,
+            user_email=request.args.get('user_email') or None,
+            user_id=request.args.get('user_id') or None,
+            module=request.args.get('module') or None,
+            status=request.args.get('status') or None,
+            date_from=request.args.get('date_from') or None,
+            date_to=request.args.get('date_to') or None
+        )
+        sessions_data = page['sessions']
         logger.info(f"获取到 {len(sessions_data)} 条会话记录")
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         logger.error(f"获取会话失败: {e}")
         return jsonify({'success': False, 'error': f'获取会话失败: {str(e)}'}), 500
@@ -1185,7 +1272,73 @@ def admin_get_sessions():
 
     return jsonify({
         'success': True,
-        'sessions': sessions_data
+        'sessions': sessions_data,
+        'next_cursor': page['next_cursor'],
+        'has_more': page['next_cursor'] is not None
+    })
+
+
+@app.route('/api/admin/sessions/<session_id>/messages', methods=['GET'])
+def admin_get_session_messages(session_id):
+    """获取单个会话的完整消息（会话列表只返回摘要，展开时再加载）"""
+    if not session.get('is_admin'):
+        return jsonify({'success': False, 'error': '请先登录管理后台'}), 401
+
+    try:
+        messages = db.get_session_messages(session_id)
+    except Exception as e:
+        logger.error(f"获取会话消息失败: {e}")
+        return jsonify({'success': False, 'error': f'获取会话消息失败: {str(e)}'}), 500
+
+    return jsonify({
+        'success': True,
+        'session_id': session_id,
+        'messages': messages
+    })
+
+
+@app.route('/api/admin/search', methods=['GET'])
+def admin_search():
+    """
+    全文搜索对话消息和调研记录
+
+    参数：q 搜索词（空格分隔多个词）, source（message / research_note，可选）, limit, cursor
+    """
+    if not session.get('is_admin'):
+        return jsonify({'success': False, 'error': '请先登录管理后台'}), 401
+
+    query = (request.args.get('q') or '').strip()
+    if not query:
+        return jsonify({'success': False, 'error': '请输入搜索词'}), 400
+
+    try:
+        limit = min(max(int(request.args.get('limit', 20)), 1), 100)
+        cursor = int(request.args.get('cursor') or 0)
+    except ValueError:
+        return jsonify({'success': False, 'error': '分页参数无效'}), 400
+
+    try:
+        page = db.search_index.search(
+            query, source=request.args.get('source') or None, limit=limit, cursor=cursor
+        )
+        # 补充消息所在会话的用户和模块
+        session_ids = [r['ref_id'] for r in page['results'] if r['source'] == 'message']
+        summaries = db.get_session_summaries(session_ids)
+        for r in page['results']:
+            if r['source'] == 'message':
+                summary = summaries.get(r['ref_id'], {})
+                r['session_id'] = r['ref_id']
+                r['user_email'] = summary.get('user_email')
+                r['module'] = summary.get('module')
+    except Exception as e:
+        logger.error(f"全文搜索失败: {e}")
+        return jsonify({'success': False, 'error': f'搜索失败: {str(e)}'}), 500
+
+    return jsonify({
+        'success': True,
+        'results': page['results'],
+        'next_cursor': page['next_cursor'],
+        'has_more': page['next_cursor'] is not None
     })
 
 
@@ -1203,8 +1356,7 @@ def admin_user_profile_summary():
             return jsonify({'success': False, 'error': '缺少用户邮箱参数'}), 400
 
         # 获取该用户的所有会话和消息
-        sessions_data = db.get_all_sessions_for_admin(limit=500)
-        user_sessions = [s for s in sessions_data if s.get('user_email') == user_email]
+        user_sessions = db.get_sessions_by_email(user_email, limit=500)
 
         if not user_sessions:
             return jsonify({
@@ -1212,10 +1364,11 @@ def admin_user_profile_summary():
                 'error': '该用户没有聊天记录'
             }), 404
 
-        # 收集所有消息
+        # 收集所有消息（会话列表只有摘要，消息按需读取）
+        messages_map = db.get_messages_for_sessions([s['id'] for s in user_sessions])
         all_messages = []
         for sess in user_sessions:
-            messages = sess.get('messages', [])
+            messages = messages_map.get(sess['id'], [])
             all_messages.extend(messages)
 
         # 统计信息
@@ -1226,19 +1379,10 @@ def admin_user_profile_summary():
         # 提取用户消息内容用于分析
         user_messages_text = [m.get('content', '') for m in all_messages if m.get('role') == 'user']
 
-        # 限制分析的消息数量和长度，避免token过多
-        max_messages_to_analyze = 50
-        if len(user_messages_text) > max_messages_to_analyze:
-            # 取最近的消息
-            user_messages_text = user_messages_text[-max_messages_to_analyze:]
-
-        # 截断每条消息的长度
-        truncated_messages = []
-        for msg in user_messages_text:
-            if len(msg) > 500:
-                truncated_messages.append(msg[:500] + '...')
-            else:
-                truncated_messages.append(msg)
+        # 限制分析的消息数量和长度，避免token过多：最近 50 条，每条最多 500 token，总量不超过分析预算
+        truncated_messages = context_budget.start(Config.AI_ANALYSIS_TOKENS).take_recent(
+            'history', user_messages_text[-50:], item_limit=500
+        )
 
         # 构建分析提示词
         analysis_prompt = f"""你是一个用户行为分析专家。请分析以下用户的聊天记录，生成用户画像。
@@ -1274,10 +1418,9 @@ def admin_user_profile_summary():
         import re
 
         try:
-            from openai import OpenAI
             import os
 
-            # 初始化OpenAI客户端（使用DeepSeek或其他兼容的API）
+            # 使用 DeepSeek 或其他 OpenAI 兼容的 API（经 AI 网关复用连接）
             api_key = os.getenv('OPENAI_API_KEY') or os.getenv('DEEPSEEK_API_KEY')
             base_url = os.getenv('OPENAI_BASE_URL', 'https://api.deepseek.com')
 
@@ -1298,19 +1441,12 @@ def admin_user_profile_summary():
                     }
                 })
 
-            client = OpenAI(api_key=api_key, base_url=base_url)
-
-            response = client.chat.completions.create(
-                model='deepseek-chat',
-                messages=[
-                    {'role': 'system', 'content': '你是一个专业的用户行为分析专家，擅长从聊天记录中提取用户画像。'},
-                    {'role': 'user', 'content': analysis_prompt}
-                ],
-                temperature=0.7,
-                max_tokens=1500
+            ai_response = _admin_report(
+                base_url, api_key,
+                '你是一个专业的用户行为分析专家，擅长从聊天记录中提取用户画像。',
+                analysis_prompt,
+                model='deepseek-chat', max_tokens=1500  # 画像只输出一段 JSON
             )
-
-            ai_response = response.choices[0].message.content.strip()
             logger.info(f"AI分析响应: {ai_response}")
 
             # 提取JSON部分（可能包含markdown代码块）
@@ -1441,6 +1577,32 @@ def set_analysis_cache(user_email, analysis_type, message_count, result):
     logger.info(f"缓存已更新: {cache_key}, 消息数: {message_count}")
 
 
+def _admin_report(base_url: str, api_key: str, system_content: str, prompt: str, **overrides) -> str:
+    """管理后台分析报告的 AI 调用：admin_report 配置档、analysis 优先级，返回回复文本（overrides 覆盖配置档参数）"""
+    profile = ai_profiles[PROFILE_ADMIN_REPORT]
+    payload = profile.apply(dict(overrides, messages=[
+        {'role': 'system', 'content': system_content},
+        {'role': 'user', 'content': prompt}
+    ]))
+    payload.setdefault('model', profile.model_name())
+    record = ai_ledger.begin(profile, payload['model'], PRIORITY_ANALYSIS)
+    try:
+        with ai_scheduler.slot(PRIORITY_ANALYSIS):
+            record.attempt(ai_ledger.provider_name(base_url))
+            response = ai_gateway.chat_completion(base_url, api_key, payload, timeout=profile.timeout or 120)
+        choice = response['choices'][0]
+        content = choice['message']['content'].strip()
+    except AISchedulerTimeout:
+        record.finish(STATUS_REJECTED)
+        raise
+    except Exception:
+        record.finish(STATUS_ERROR, payload)
+        raise
+    record.first_token(record.provider)
+    record.finish(STATUS_OK, payload, content, response.get('usage'), choice.get('finish_reason'))
+    return content
+
+
 @app.route('/api/admin/user-insight', methods=['POST'])
 def admin_user_insight():
     """生成用户洞察（需求摘要）- 支持缓存"""
@@ -1451,13 +1613,13 @@ def admin_user_insight():
         data = request.get_json()
         user_email = data.get('email')
         force_refresh = data.get('force_refresh', False)  # 强制刷新参数
+        requested_at = datetime.now().timestamp()
 
         if not user_email:
             return jsonify({'success': False, 'error': '缺少用户邮箱参数'}), 400
 
         # 获取该用户的所有会话和消息
-        sessions_data = db.get_all_sessions_for_admin(limit=500)
-        user_sessions = [s for s in sessions_data if s.get('user_email') == user_email]
+        user_sessions = db.get_sessions_by_email(user_email, limit=500)
 
         if not user_sessions:
             return jsonify({
@@ -1465,8 +1627,8 @@ def admin_user_insight():
                 'error': '该用户没有聊天记录'
             }), 404
 
-        # 计算总消息数（用于缓存判断）
-        total_message_count = sum(len(s.get('messages', [])) for s in user_sessions)
+        # 计算总消息数（用于缓存判断，直接读摘要列）
+        total_message_count = sum(s.get('message_count', 0) for s in user_sessions)
 
         # 检查缓存（如果不是强制刷新）
         if not force_refresh:
@@ -1478,22 +1640,24 @@ def admin_user_insight():
                     'from_cache': True
                 })
 
-        # 收集所有对话（包含完整上下文）
+        # 收集所有对话（包含完整上下文，未命中缓存才读取消息）
+        messages_map = db.get_messages_for_sessions([s['id'] for s in user_sessions])
         all_conversations = []
         for sess in user_sessions:
             module = sess.get('module', '未知模块')
-            messages = sess.get('messages', [])
+            messages = messages_map.get(sess['id'], [])
             if messages:
                 conversation = f"\n--- 对话模块：{module} ---\n"
                 for msg in messages:
                     role = '用户' if msg.get('role') == 'user' else 'AI'
-                    content = msg.get('content', '')[:1000]  # 限制每条消息长度
+                    content = truncate_tokens(msg.get('content', ''), 1000, '...')  # 限制每条消息长度
                     conversation += f"{role}：{content}\n"
                 all_conversations.append(conversation)
 
-        # 限制总对话数量，避免 token 过多
-        if len(all_conversations) > 20:
-            all_conversations = all_conversations[-20:]
+        # 限制总对话数量，避免 token 过多（最近 20 段，总量不超过分析预算）
+        all_conversations = context_budget.start(Config.AI_ANALYSIS_TOKENS).take_recent(
+            'history', all_conversations[-20:]
+        )
 
         # 获取调研记录
         research_notes_text = db.get_research_notes_text_for_analysis(user_email)
@@ -1594,7 +1758,6 @@ def admin_user_insight():
 
         # 调用 AI 进行分析
         try:
-            from openai import OpenAI
             import os
 
             # 使用 CloseAI API
@@ -1604,20 +1767,21 @@ def admin_user_insight():
             if not api_key:
                 return jsonify({'success': False, 'error': '未配置 CLOSEAI_API_KEY'}), 500
 
-            client = OpenAI(api_key=api_key, base_url=base_url)
-
-            response = client.chat.completions.create(
-                model='gpt-4o',
-                messages=[
-                    {'role': 'system', 'content': '你是一个专业的需求分析专家，擅长从客户对话中提取核心需求和洞察。请使用 Markdown 格式输出。'},
-                    {'role': 'user', 'content': insight_prompt}
-                ],
-                temperature=0.7,
-                max_tokens=3000
+            def generate():
+                return _admin_report(
+                    base_url, api_key,
+                    '你是一个专业的需求分析专家，擅长从客户对话中提取核心需求和洞察。请使用 Markdown 格式输出。',
+                    insight_prompt
+                )
+
+            # 同一用户、同样消息数的分析同一时刻只生成一次（跨 worker），重复点击 / 多人同时打开时等待同一份结果；
+            # 强制刷新只接受本次请求之后生成的结果
+            ai_response, shared = db.single_flight.do(
+                f"{user_email}:user_insight:{total_message_count}",
+                generate,
+                since=requested_at if force_refresh else None
             )
-
-            ai_response = response.choices[0].message.content.strip()
-            logger.info(f"用户洞察分析完成，用户：{user_email}")
+            logger.info(f"用户洞察分析完成，用户：{user_email}{'（复用同时进行的分析）' if shared else ''}")
 
             # 保存到缓存
             set_analysis_cache(user_email, 'user_insight', total_message_count, ai_response)
@@ -1625,7 +1789,8 @@ def admin_user_insight():
             return jsonify({
                 'success': True,
                 'result': ai_response,
-                'from_cache': False
+                'from_cache': False,
+                'shared': shared
             })
 
         except Exception as e:
@@ -1653,13 +1818,13 @@ def admin_tool_analysis():
         data = request.get_json()
         user_email = data.get('email')
         force_refresh = data.get('force_refresh', False)  # 强制刷新参数
+        requested_at = datetime.now().timestamp()
 
         if not user_email:
             return jsonify({'success': False, 'error': '缺少用户邮箱参数'}), 400
 
         # 获取该用户的所有会话和消息
-        sessions_data = db.get_all_sessions_for_admin(limit=500)
-        user_sessions = [s for s in sessions_data if s.get('user_email') == user_email]
+        user_sessions = db.get_sessions_by_email(user_email, limit=500)
 
         if not user_sessions:
             return jsonify({
@@ -1667,8 +1832,8 @@ def admin_tool_analysis():
                 'error': '该用户没有聊天记录'
             }), 404
 
-        # 计算总消息数（用于缓存判断）
-        total_message_count = sum(len(s.get('messages', [])) for s in user_sessions)
+        # 计算总消息数（用于缓存判断，直接读摘要列）
+        total_message_count = sum(s.get('message_count', 0) for s in user_sessions)
 
         # 检查缓存（如果不是强制刷新）
         if not force_refresh:
@@ -1680,22 +1845,24 @@ def admin_tool_analysis():
                     'from_cache': True
                 })
 
-        # 收集所有对话（包含完整上下文）
+        # 收集所有对话（包含完整上下文，未命中缓存才读取消息）
+        messages_map = db.get_messages_for_sessions([s['id'] for s in user_sessions])
         all_conversations = []
         for sess in user_sessions:
             module = sess.get('module', '未知模块')
-            messages = sess.get('messages', [])
+            messages = messages_map.get(sess['id'], [])
             if messages:
                 conversation = f"\n--- 对话模块：{module} ---\n"
                 for msg in messages:
                     role = '用户' if msg.get('role') == 'user' else 'AI'
-                    content = msg.get('content', '')[:1000]
+                    content = truncate_tokens(msg.get('content', ''), 1000, '...')
                     conversation += f"{role}：{content}\n"
                 all_conversations.append(conversation)
 
-        # 限制总对话数量
-        if len(all_conversations) > 20:
-            all_conversations = all_conversations[-20:]
+        # 限制总对话数量（最近 20 段，总量不超过分析预算）
+        all_conversations = context_budget.start(Config.AI_ANALYSIS_TOKENS).take_recent(
+            'history', all_conversations[-20:]
+        )
 
         # 获取调研记录
         research_notes_text = db.get_research_notes_text_for_analysis(user_email)
@@ -1774,7 +1941,6 @@ def admin_tool_analysis():
 
         # 调用 AI 进行分析
         try:
-            from openai import OpenAI
             import os
 
             # 使用 CloseAI API
@@ -1784,20 +1950,21 @@ def admin_tool_analysis():
             if not api_key:
                 return jsonify({'success': False, 'error': '未配置 CLOSEAI_API_KEY'}), 500
 
-            client = OpenAI(api_key=api_key, base_url=base_url)
-
-            response = client.chat.completions.create(
-                model='gpt-4o',
-                messages=[
-                    {'role': 'system', 'content': '你是一个专业的产品经理，擅长从客户对话中提取功能需求并输出清晰的需求文档。请使用 Markdown 格式输出。'},
-                    {'role': 'user', 'content': analysis_prompt}
-                ],
-                temperature=0.7,
-                max_tokens=3000
+            def generate():
+                return _admin_report(
+                    base_url, api_key,
+                    '你是一个专业的产品经理，擅长从客户对话中提取功能需求并输出清晰的需求文档。请使用 Markdown 格式输出。',
+                    analysis_prompt
+                )
+
+            # 同一用户、同样消息数的分析同一时刻只生成一次（跨 worker），重复点击 / 多人同时打开时等待同一份结果；
+            # 强制刷新只接受本次请求之后生成的结果
+            ai_response, shared = db.single_flight.do(
+                f"{user_email}:tool_analysis:{total_message_count}",
+                generate,
+                since=requested_at if force_refresh else None
             )
-
-            ai_response = response.choices[0].message.content.strip()
-            logger.info(f"工具分析完成，用户：{user_email}")
+            logger.info(f"工具分析完成，用户：{user_email}{'（复用同时进行的分析）' if shared else ''}")
 
             # 保存到缓存
             set_analysis_cache(user_email, 'tool_analysis', total_message_count, ai_response)
@@ -1805,7 +1972,8 @@ def admin_tool_analysis():
             return jsonify({
                 'success': True,
                 'result': ai_response,
-                'from_cache': False
+                'from_cache': False,
+                'shared': shared
             })
 
         except Exception as e:
@@ -2477,20 +2645,24 @@ def admin_batch_add_credits_by_phone():
         'fail_list': []
     }
 
+    valid_phones = []
     for phone in phones:
         phone = str(phone).strip()
         if not phone or len(phone) != 11 or not phone.isdigit():
             results['fail_count'] += 1
             results['fail_list'].append({'phone': phone, 'error': '手机号格式错误'})
             continue
+        valid_phones.append(phone)
 
-        success, message, new_balance, user_data = auth_service.add_credits_by_phone(
-            phone=phone,
-            amount=credits,
-            reason=reason or '管理员批量充值',
-            admin_name=admin_name
-        )
+    # 一次查出已注册用户，未注册的手机号一次批量写入预充值
+    batch_results = auth_service.add_credits_by_phones(
+        valid_phones,
+        amount=credits,
+        reason=reason or '管理员批量充值',
+        admin_name=admin_name
+    )
 
+    for phone, success, message, new_balance, user_data in batch_results:
         if success:
             results['success_count'] += 1
             results['success_list'].append({
@@ -2676,6 +2848,74 @@ def internal_error(error):
     return jsonify({'success': False, 'error': '服务器内部错误'}), 500
 
 
+@app.route('/api/admin/db-stats', methods=['GET'])
+def admin_db_stats():
+    """存储层运行统计（会话缓存命中率、连接池等）"""
+    if not session.get('is_admin'):
+        return jsonify({'success': False, 'error': '请先登录管理后台'}), 401
+
+    return jsonify({'success': True, 'stats': db.get_stats()})
+
+
+@app.route('/api/admin/ai-stats', methods=['GET'])
+def admin_ai_stats():
+    """AI 请求统计：连接池（每个服务商的请求数、新建连接数、复用率等）、首字耗时分布、响应缓存命中率、调度排队情况、各配置档的 token 用量、图片预处理节省的字节数和用户画像提取队列"""
+    if not session.get('is_admin'):
+        return jsonify({'success': False, 'error': '请先登录管理后台'}), 401
+
+    return jsonify({
+        'success': True,
+        'stats': ai_gateway.stats(),
+        'ttft': ai_service.ttft.stats(),
+        'hedge_enabled': ai_service.hedge_enabled,
+        'cache': ai_cache.stats(),
+        'scheduler': ai_scheduler.stats(),
+        'profiles': {name: profile.to_dict() for name, profile in ai_profiles.items()},
+        'profile_usage': profile_usage.stats(),
+        'ledger': ai_ledger.stats(),
+        'images': image_preprocessor.stats(),
+        'memory_extraction': memory_service.extraction_stats()
+    })
+
+
+@app.route('/api/admin/ai-ledger', methods=['GET'])
+def admin_ai_ledger():
+    """
+    AI 调用台账汇总：按服务商 / 模型 / 配置档统计调用数、错误率、切换率、token 用量和首字 / 总耗时分位数（毫秒）
+
+    参数：hours（时间窗口，默认 24，最长为台账保留天数），group_by（逗号分隔，可选 provider, model, profile, priority, status），
+    profile（只看某个配置档）
+    """
+    if not session.get('is_admin'):
+        return jsonify({'success': False, 'error': '请先登录管理后台'}), 401
+
+    try:
+        hours = min(max(float(request.args.get('hours', 24)), 0.1), ai_ledger.max_hours())
+    except ValueError:
+        return jsonify({'success': False, 'error': 'hours 参数无效'}), 400
+    group_by = [field.strip() for field in request.args.get('group_by', 'provider,model,profile').split(',')]
+    invalid = [field for field in group_by if field not in GROUP_FIELDS]
+    if invalid:
+        return jsonify({'success': False, 'error': f"group_by 参数无效: {', '.join(invalid)}"}), 400
+
+    try:
+        rollup = ai_ledger.rollup(hours, group_by, request.args.get('profile') or None)
+    except Exception as e:
+        logger.error(f"AI 调用台账汇总失败: {e}")
+        return jsonify({'success': False, 'error': f'汇总失败: {str(e)}'}), 500
+
+    return jsonify({'success': True, 'hours': hours, 'group_by': group_by, 'rollup': rollup})
+
+
+@app.route('/api/admin/ai-routing', methods=['GET'])
+def admin_ai_routing():
+    """AI 服务商实时路由表：各服务商熔断状态、各模型 EWMA 首字耗时 / 错误率和当前排序"""
+    if not session.get('is_admin'):
+        return jsonify({'success': False, 'error': '请先登录管理后台'}), 401
+
+    return jsonify({'success': True, 'routing': ai_router.table()})
+
+
 # ========================================
 # 管理员操作日志 API
 # ========================================
@@ -0,0 +1,206 @@
+"""
+猫课电商管理落地班核心工具 - ASGI 入口
+流式对话（/api/chat/stream）走异步引擎（modules/ai_async.py），其余请求原样交给 Flask 应用
+
+启动：uvicorn asgi:app --host 0.0.0.0 --port 3014 --workers 4
+与 gunicorn + gevent 的对比压测见 scripts/loadtest_stream.py
+"""
+import asyncio
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from http.cookies import SimpleCookie
+
+from a2wsgi import WSGIMiddleware
+
+from app import app as flask_app, _prepare_chat_stream, _finish_chat_stream, _check_request_origin, \
+    _generate_thinking_steps
+from config import Config
+from database import db
+from modules.ai_async import async_ai_streamer
+from modules.ai_profiles import PROFILE_INTERACTIVE_CHAT
+from modules.sse_codec import acoalesce, sse_frame
+
+logger = logging.getLogger(__name__)
+
+# 非流式请求在线程池里跑 Flask
+wsgi_app = WSGIMiddleware(flask_app, workers=Config.ASGI_WSGI_THREADS)
+
+SSE_HEADERS = [
+    (b'content-type', b'text/event-stream; charset=utf-8'),
+    (b'cache-control', b'no-cache'),
+    (b'x-accel-buffering', b'no'),  # 禁用 Nginx 缓冲
+]
+
+
+def _headers(scope) -> dict:
+    return {key.decode('latin-1').lower(): value.decode('latin-1') for key, value in scope['headers']}
+
+
+def _load_flask_session(headers: dict) -> dict:
+    """用 Flask 的签名密钥解出会话 Cookie（与 Flask 路由看到的 session 一致），无效时返回空字典"""
+    cookie = SimpleCookie()
+    try:
+        cookie.load(headers.get('cookie', ''))
+    except Exception:
+        return {}
+    morsel = cookie.get(flask_app.config['SESSION_COOKIE_NAME'])
+    if morsel is None:
+        return {}
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    if serializer is None:
+        return {}
+    try:
+        return serializer.loads(morsel.value, max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+    except Exception:
+        return {}
+
+
+def _in_cache_scope(fn, *args):
+    """在线程池里执行同步的存储层调用，并开启请求级会话缓存（对应 Flask 的 before/teardown_request）"""
+    with db.session_cache.request_scope():
+        return fn(*args)
+
+
+class RequestTooLarge(Exception):
+    """请求体超过 MAX_CONTENT_LENGTH（对应 Flask 的 413）"""
+
+
+async def _read_body(receive) -> bytes:
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise ConnectionError('客户端已断开')
+        body = message.get('body', b'')
+        size += len(body)
+        if size > flask_app.config['MAX_CONTENT_LENGTH']:
+            raise RequestTooLarge(size)
+        chunks.append(body)
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+async def _send_json(send, status: int, payload: dict):
+    body = json.dumps(payload).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def chat_stream(scope, receive, send):
+    """流式对话 - 与 app.py 的 chat_stream_api 行为一致，输出同样的 SSE 帧"""
+    headers = _headers(scope)
+    if not _check_request_origin(headers.get('origin', ''), headers.get('referer', ''), scope['path']):
+        await _send_json(send, 403, {'success': False, 'error': '请求来源不合法'})
+        return
+
+    try:
+        data = json.loads(await _read_body(receive) or b'null')
+    except ConnectionError:
+        return
+    except RequestTooLarge:
+        await _send_json(send, 413, {'success': False, 'error': '请求数据过大'})
+        return
+    except ValueError:
+        data = None
+
+    user = _load_flask_session(headers)
+    ctx, error = await asyncio.to_thread(
+        _in_cache_scope, _prepare_chat_stream, data, user.get('user_id'), user.get('email', '')
+    )
+    if error:
+        await _send_json(send, error[1], error[0])
+        return
+
+    async def stream_body():
+        await send({'type': 'http.response.start', 'status': 200, 'headers': SSE_HEADERS})
+        full_response = []
+        try:
+            # 发送思考状态（让用户看到 AI 正在思考）
+            for step in _generate_thinking_steps(ctx['module'], ctx['message']):
+                await send({'type': 'http.response.body', 'body': sse_frame({'thinking': step}), 'more_body': True})
+                await asyncio.sleep(0.3)  # 短暂延迟，让动画更自然
+
+            # send 在客户端来不及接收时会等待，上游也就暂停读取（背压）；细碎的增量合并后再推
+            async for chunk in acoalesce(async_ai_streamer.chat_stream(
+                messages=ctx['messages'],
+                system_prompt=ctx['system_prompt'],
+                model=ctx['model'],
+                images=ctx['images'],
+                profile=PROFILE_INTERACTIVE_CHAT
+            ), Config.AI_STREAM_FLUSH_INTERVAL, Config.AI_STREAM_FLUSH_CHARS):
+                if chunk.startswith('[ERROR]'):
+                    await send({'type': 'http.response.body', 'body': sse_frame({'error': chunk[7:]})})
+                    return
+                full_response.append(chunk)
+                await send({'type': 'http.response.body', 'body': sse_frame({'content': chunk}), 'more_body': True})
+
+            # 流结束，保存完整响应、扣除积分
+            credits_cost, remaining_credits = await asyncio.to_thread(
+                _in_cache_scope, _finish_chat_stream, ctx, ''.join(full_response)
+            )
+            await send({'type': 'http.response.body', 'body': sse_frame({
+                'done': True, 'credits_used': credits_cost, 'remaining_credits': remaining_credits
+            })})
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"异步流式对话出错: {e}")
+            await send({'type': 'http.response.body', 'body': sse_frame({'error': str(e)})})
+
+    # 客户端断开时取消输出（与 WSGI 版一样：不保存回复、不扣积分），上游连接随之关闭
+    task = asyncio.ensure_future(stream_body())
+
+    async def watch_disconnect():
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                task.cancel()
+                return
+
+    watcher = asyncio.ensure_future(watch_disconnect())
+    try:
+        await task
+    except asyncio.CancelledError:
+        logger.info(f"客户端断开，停止流式输出: {ctx['session_id']}")
+    finally:
+        watcher.cancel()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # asyncio.to_thread 的默认线程池只有 CPU 数 + 4 个线程，流式对话的准备 / 收尾会排队，换成 ASGI_STREAM_THREADS 个
+            asyncio.get_running_loop().set_default_executor(
+                ThreadPoolExecutor(max_workers=Config.ASGI_STREAM_THREADS, thread_name_prefix='asgi')
+            )
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await async_ai_streamer.aclose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+# 异步处理的路由
+ASYNC_ROUTES = {
+    ('POST', '/api/chat/stream'): chat_stream,
+}
+
+
+async def app(scope, receive, send):
+    """ASGI 应用"""
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] == 'http':
+        handler = ASYNC_ROUTES.get((scope['method'], scope['path']))
+        if handler is not None:
+            await handler(scope, receive, send)
+            return
+    await wsgi_app(scope, receive, send)
@@ -11,12 +11,80 @@ class Config:
     PORT = int(os.getenv('KPI_PORT', os.getenv('PORT', 5009)))
 
     # AI API配置 - 双 API 自动切换
-    # 主用：云雾 API（便宜）
+    # 请求顺序由 modules/ai_router.py 按实时首字耗时和错误率决定，没有数据时 CloseAI 优先
+    # 云雾 API（便宜）
     YUNWU_API_KEY = os.getenv('YUNWU_API_KEY')
     YUNWU_BASE_URL = os.getenv('YUNWU_BASE_URL', 'https://api.yunwu.ai/v1')
-    # 备用：CloseAI（更快）
+    # CloseAI
     CLOSEAI_API_KEY = os.getenv('CLOSEAI_API_KEY')
     CLOSEAI_BASE_URL = os.getenv('CLOSEAI_BASE_URL', 'https://api.closeai-asia.com/v1')
+    # AI 请求连接池：每个服务商每个 worker 的最大连接数（与 gunicorn --worker-connections 一致），启动时预热的连接数
+    AI_POOL_MAXSIZE = int(os.getenv('AI_POOL_MAXSIZE', 100))
+    AI_POOL_WARM_CONNECTIONS = int(os.getenv('AI_POOL_WARM_CONNECTIONS', 2))
+    # 对冲请求：主用服务商超过「首字耗时分位数」还没出首字，就同时请求备用，先出首字的胜出（默认关闭）
+    AI_HEDGE_ENABLED = os.getenv('AI_HEDGE_ENABLED', 'false').lower() == 'true'
+    AI_HEDGE_PERCENTILE = float(os.getenv('AI_HEDGE_PERCENTILE', 95))
+    AI_HEDGE_DELAY = float(os.getenv('AI_HEDGE_DELAY', 8))  # 样本不足时的默认对冲延迟（秒）
+    AI_HEDGE_MIN_DELAY = float(os.getenv('AI_HEDGE_MIN_DELAY', 1))
+    # 流式回复中途断开时，把已输出部分交给其他服务商续写（关闭则直接报错）
+    AI_STREAM_RESUME = os.getenv('AI_STREAM_RESUME', 'true').lower() == 'true'
+    # 流式输出合并：首段立即推送，之后每隔 N 秒或攒够 N 字推一帧（间隔设为 0 则逐段推送）
+    AI_STREAM_FLUSH_INTERVAL = float(os.getenv('AI_STREAM_FLUSH_INTERVAL', 0.05))
+    AI_STREAM_FLUSH_CHARS = int(os.getenv('AI_STREAM_FLUSH_CHARS', 1024))
+    # 内部 AI 调用（记忆提取、摘要、信息图）的响应缓存：进程内 LRU 条数、有效期（秒）、
+    # 是否启用本地 SQLite 共享层（多 worker 共用）及其最大条数；对话不走缓存
+    AI_CACHE_ENABLED = os.getenv('AI_CACHE_ENABLED', 'true').lower() == 'true'
+    AI_CACHE_SIZE = int(os.getenv('AI_CACHE_SIZE', 500))
+    AI_CACHE_TTL = float(os.getenv('AI_CACHE_TTL', 86400))
+    AI_CACHE_SHARED = os.getenv('AI_CACHE_SHARED', 'true').lower() == 'true'
+    AI_CACHE_MAX_ROWS = int(os.getenv('AI_CACHE_MAX_ROWS', 20000))
+    # AI 请求调度（每个 worker 各一份）：analysis / background 类的并发上限，每个服务商每秒请求数和突发量，
+    # background 要给对话留出的配额比例，排队最长等待秒数；上下文摘要在对话路径上，等不到就用降级摘要
+    AI_SCHEDULER_ANALYSIS_CONCURRENCY = int(os.getenv('AI_SCHEDULER_ANALYSIS_CONCURRENCY', 4))
+    AI_SCHEDULER_BACKGROUND_CONCURRENCY = int(os.getenv('AI_SCHEDULER_BACKGROUND_CONCURRENCY', 2))
+    AI_PROVIDER_RATE = float(os.getenv('AI_PROVIDER_RATE', 5))
+    AI_PROVIDER_BURST = float(os.getenv('AI_PROVIDER_BURST', 20))
+    AI_SCHEDULER_RESERVE = float(os.getenv('AI_SCHEDULER_RESERVE', 0.3))
+    AI_SCHEDULER_MAX_WAIT = float(os.getenv('AI_SCHEDULER_MAX_WAIT', 60))
+    AI_SCHEDULER_SUMMARY_WAIT = float(os.getenv('AI_SCHEDULER_SUMMARY_WAIT', 5))
+    # 用户画像提取排队上限（按用户合并，满了丢弃，下一轮对话会再提取）；执行线程数同 background 并发上限
+    MEMORY_EXTRACTION_QUEUE = int(os.getenv('MEMORY_EXTRACTION_QUEUE', 200))
+    # AI 调用配置档覆盖（JSON），如 {"extraction": {"max_tokens": 400}, "interactive_chat": {"max_tokens": 12000}}；
+    # 可改 model / max_tokens / temperature / timeout / stop，默认值见 modules/ai_profiles.py
+    AI_PROFILE_OVERRIDES = os.getenv('AI_PROFILE_OVERRIDES', '')
+    # AI 调用台账（本地 SQLite）：每次调用的服务商、模型、配置档、token、首字 / 总耗时、状态，后台线程批量写入
+    AI_LEDGER_ENABLED = os.getenv('AI_LEDGER_ENABLED', 'true').lower() == 'true'
+    AI_LEDGER_BATCH_SIZE = int(os.getenv('AI_LEDGER_BATCH_SIZE', 200))
+    AI_LEDGER_FLUSH_INTERVAL = float(os.getenv('AI_LEDGER_FLUSH_INTERVAL', 2))  # 秒
+    AI_LEDGER_RETENTION_DAYS = float(os.getenv('AI_LEDGER_RETENTION_DAYS', 30))
+    # 管理后台 AI 分析单飞：相同分析正在生成时，后来的请求最多等待的秒数
+    SINGLE_FLIGHT_WAIT = float(os.getenv('SINGLE_FLIGHT_WAIT', 180))
+    # 异步流式引擎（asgi.py）：每个服务商的最大连接数 / 保持的空闲连接数；其余 WSGI 请求的线程数
+    AI_ASYNC_MAX_CONNECTIONS = int(os.getenv('AI_ASYNC_MAX_CONNECTIONS', 1000))
+    AI_ASYNC_MAX_KEEPALIVE = int(os.getenv('AI_ASYNC_MAX_KEEPALIVE', 100))
+    ASGI_WSGI_THREADS = int(os.getenv('ASGI_WSGI_THREADS', 100))
+    # 流式对话准备 / 收尾（读写会话、查扣积分）的线程数：太少排队拉长首字时间，太多则本地库写锁争用（database is locked）
+    ASGI_STREAM_THREADS = int(os.getenv('ASGI_STREAM_THREADS', 16))
+    # AI 路由：EWMA 平滑系数；服务商熔断的失败次数阈值和冷却秒数；样本超过 N 秒没更新就重新探测
+    AI_ROUTER_EWMA_ALPHA = float(os.getenv('AI_ROUTER_EWMA_ALPHA', 0.2))
+    AI_BREAKER_THRESHOLD = int(os.getenv('AI_BREAKER_THRESHOLD', 3))
+    AI_BREAKER_RESET = float(os.getenv('AI_BREAKER_RESET', 30))
+    AI_ROUTER_EXPLORE_AFTER = float(os.getenv('AI_ROUTER_EXPLORE_AFTER', 300))
+    # Token 估算：heuristic（CJK 感知估算，系数可用 scripts/calibrate_token_estimator.py 标定）或 tiktoken（需另行安装）
+    TOKEN_ESTIMATOR = os.getenv('TOKEN_ESTIMATOR', 'heuristic')
+    TOKEN_ENCODING = os.getenv('TOKEN_ENCODING', 'o200k_base')
+    TOKEN_CJK_RATIO = float(os.getenv('TOKEN_CJK_RATIO', 1.0))  # 每个中日韩字符约多少 token
+    TOKEN_CHARS_PER_TOKEN = float(os.getenv('TOKEN_CHARS_PER_TOKEN', 4.0))  # 其他字符约多少个 1 token
+    # 上下文预算（token）：模型上下文、预留给回复的部分；用户记忆 / 知识库（总量和单个文件）/ 对话摘要的上限，
+    # 最近对话用剩下的全部
+    AI_CONTEXT_TOKENS = int(os.getenv('AI_CONTEXT_TOKENS', 64000))
+    AI_OUTPUT_RESERVE_TOKENS = int(os.getenv('AI_OUTPUT_RESERVE_TOKENS', 16000))
+    AI_MEMORY_TOKENS = int(os.getenv('AI_MEMORY_TOKENS', 1000))
+    AI_KNOWLEDGE_TOKENS = int(os.getenv('AI_KNOWLEDGE_TOKENS', 8000))
+    AI_KNOWLEDGE_FILE_TOKENS = int(os.getenv('AI_KNOWLEDGE_FILE_TOKENS', 2000))
+    AI_SUMMARY_TOKENS = int(os.getenv('AI_SUMMARY_TOKENS', 1500))
+    # 管理后台分析（用户画像 / 洞察 / 工具需求）提示词里聊天记录部分的 token 上限
+    AI_ANALYSIS_TOKENS = int(os.getenv('AI_ANALYSIS_TOKENS', 24000))
     DEFAULT_MODEL = os.getenv('DEFAULT_MODEL', 'gemini-3-flash-preview')
 
     # 可用模型
@@ -35,6 +103,25 @@ class Config:
     # 数据库
     DATABASE_PATH = os.getenv('DATABASE_PATH', 'data/kpi_tool.db')
 
+    # 会话缓存：请求内去重始终开启；进程内 LRU 默认关闭（worker 之间不共享，开启时 TTL 保持几秒）
+    SESSION_CACHE_SIZE = int(os.getenv('SESSION_CACHE_SIZE', 0))
+    SESSION_CACHE_TTL = float(os.getenv('SESSION_CACHE_TTL', 5))
+    # Supabase 熔断：失败次数阈值、熔断冷却秒数
+    SUPABASE_BREAKER_THRESHOLD = int(os.getenv('SUPABASE_BREAKER_THRESHOLD', 3))
+    SUPABASE_BREAKER_RESET = float(os.getenv('SUPABASE_BREAKER_RESET', 30))
+    # 大文本落库压缩：超过阈值（字符数，0 关闭）的消息 / 文件文本压缩存储；算法 auto / zstd / zlib / none
+    STORAGE_COMPRESS_THRESHOLD = int(os.getenv('STORAGE_COMPRESS_THRESHOLD', 8192))
+    STORAGE_COMPRESS_ALGORITHM = os.getenv('STORAGE_COMPRESS_ALGORITHM', 'auto')
+    # 多模态上传图片预处理（需要 Pillow，未安装时只去重）：最长边像素、输出格式 webp / jpeg、编码质量、每个 worker 的处理线程数
+    IMAGE_PREPROCESS_ENABLED = os.getenv('IMAGE_PREPROCESS_ENABLED', 'true').lower() == 'true'
+    IMAGE_MAX_EDGE = int(os.getenv('IMAGE_MAX_EDGE', 1536))
+    IMAGE_FORMAT = os.getenv('IMAGE_FORMAT', 'webp')
+    IMAGE_QUALITY = int(os.getenv('IMAGE_QUALITY', 80))
+    IMAGE_PREPROCESS_WORKERS = int(os.getenv('IMAGE_PREPROCESS_WORKERS', 2))
+    # 会话冷存储：闲置超过 N 天的会话归档到段文件（0 关闭自动归档）
+    ARCHIVE_IDLE_DAYS = int(os.getenv('ARCHIVE_IDLE_DAYS', 0))
+    ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'data/archive')
+
     # Supabase 配置
     SUPABASE_URL = os.getenv('SUPABASE_URL')
     SUPABASE_KEY = os.getenv('SUPABASE_KEY')
@@ -2,21 +2,76 @@
 数据库模块 - Supabase 云存储 + SQLite 本地备用
 优先使用 Supabase 存储会话数据，确保数据不丢失
 """
-import sqlite3
+import base64
 import json
+import threading
 import uuid
-from datetime import datetime
+from collections import OrderedDict
+from datetime import datetime, timedelta
 from typing import Optional, Dict, List, Tuple
 from config import Config
+from modules.sqlite_pool import SQLitePool
+from modules.session_cache import SessionCache
+from modules.circuit_breaker import CircuitBreaker
+from modules.sync_outbox import SyncOutbox, KIND_SESSION, KIND_MESSAGE, KIND_SESSION_UPDATE, KIND_RESEARCH_NOTE
+from modules.search_index import SearchIndex, SOURCE_RESEARCH_NOTE
+from modules.message_totals import MessageTotals
+from modules.token_budget import context_budget, estimate_tokens, truncate_tokens
+from modules.storage_codec import storage_codec
+from modules.session_archive import SessionArchive
+from modules.ai_cache import AIResponseCache
+from modules.ai_ledger import AICallLedger
+from modules.single_flight import SingleFlight
 
 
 class Database:
     """数据库管理 - Supabase 优先，SQLite 备用"""
 
+    # 会话摘要列（会话列表只读这些，不加载消息正文）
+    SUMMARY_COLUMNS = 'message_count, preview, last_role, total_chars'
+    PREVIEW_LENGTH = 50
+    MESSAGE_PAGE_SIZE = 1000
+
+    # 会话所在存储的记忆上限（超出后淘汰最久未用的，再用时查一次本地库即可）
+    SESSION_BACKEND_CACHE_SIZE = 10000
+    # 消息用量前缀和的缓存会话数（淘汰后下次组装上下文时重算一次）
+    MESSAGE_TOTALS_CACHE_SIZE = 2000
+
     def __init__(self, db_path: str = None):
         self.db_path = db_path or Config.DATABASE_PATH
+        self.pool = SQLitePool(self.db_path)
+        self.session_cache = SessionCache(Config.SESSION_CACHE_SIZE, Config.SESSION_CACHE_TTL)
         self.supabase = None
         self.use_supabase = False
+        # Supabase 是否已建 session_messages 表（未迁移时沿用 sessions.messages 数组）
+        self.use_message_table = False
+        # Supabase sessions 表是否已加摘要列（message_count / preview 等）
+        self.use_summary_columns = False
+        # Supabase session_messages 是否已加压缩辅助列（未加时写入 Supabase 的内容保持明文）
+        self.use_compressed_storage = False
+        self._schema_checked = False
+
+        # Supabase 熔断器：故障期间直接走 SQLite，冷却后由一次健康探测决定是否恢复
+        self.supabase_breaker = CircuitBreaker(
+            'Supabase',
+            failure_threshold=Config.SUPABASE_BREAKER_THRESHOLD,
+            reset_timeout=Config.SUPABASE_BREAKER_RESET,
+            probe=self._probe_supabase
+        )
+        # session_id -> 'supabase' / 'sqlite'，会话读写直接找对存储
+        self._session_backends: OrderedDict = OrderedDict()
+        self._session_backends_lock = threading.Lock()
+        # session_id -> MessageTotals，组装 API 上下文时免去每轮重算全部消息长度
+        self._message_totals: OrderedDict = OrderedDict()
+        self._message_totals_lock = threading.Lock()
+        # 回退到 SQLite 的写入记入发件箱，Supabase 恢复后批量补写
+        self.outbox = SyncOutbox(self)
+        # 管理后台全文检索（本地 FTS5 索引）
+        self.search_index = SearchIndex(self)
+        # 长期闲置会话的冷存储（段文件 + 本地索引）
+        self.archive = SessionArchive(self, Config.ARCHIVE_DIR, Config.ARCHIVE_IDLE_DAYS)
+        # 相同的昂贵 AI 分析同一时刻只生成一次（跨 worker）
+        self.single_flight = SingleFlight(self, wait_seconds=Config.SINGLE_FLIGHT_WAIT)
 
         # 初始化 Supabase
         self._init_supabase()
@@ -34,14 +89,151 @@ class Database:
             self.use_supabase = True
             print("✅ 使用 Supabase 存储会话数据")
         except Exception as e:
+            if self.supabase is not None and not self._is_request_error(e):
+                # 已配置但暂时连不上：先熔断走 SQLite，恢复后由健康探测自动切回
+                print(f"⚠️ Supabase 暂时不可用，先使用本地 SQLite: {e}")
+                self.use_supabase = True
+                self.supabase_breaker.trip()
+                return
             print(f"⚠️ Supabase sessions 表不可用，使用本地 SQLite: {e}")
             self.use_supabase = False
+            return
+
+        try:
+            self._check_schema()
+        except Exception as e:
+            print(f"⚠️ Supabase 检测表结构失败，稍后由健康探测重试: {e}")
+            self.supabase_breaker.trip()
+
+    def _check_schema(self):
+        """检测 Supabase 是否已执行 session_messages 表和会话摘要列的迁移"""
+        try:
+            self.supabase.table('session_messages').select('session_id').limit(1).execute()
+            self.use_message_table = True
+        except Exception as e:
+            if not self._is_request_error(e):
+                raise
+            print(f"⚠️ Supabase session_messages 表不可用，请执行 database/create_session_messages_table.sql: {e}")
+            self.use_message_table = False
+
+        self.use_summary_columns = False
+        if self.use_message_table:
+            try:
+                self.supabase.table('sessions').select(self.SUMMARY_COLUMNS).limit(1).execute()
+                self.use_summary_columns = True
+            except Exception as e:
+                if not self._is_request_error(e):
+                    raise
+                print(f"⚠️ Supabase 会话摘要列不可用，请执行 database/add_session_summary_columns.sql: {e}")
+
+        self.use_compressed_storage = False
+        if self.use_summary_columns:
+            try:
+                self.supabase.table('session_messages').select('content_chars, content_preview').limit(1).execute()
+                self.use_compressed_storage = True
+            except Exception as e:
+                if not self._is_request_error(e):
+                    raise
+                print(f"⚠️ Supabase 压缩存储未启用，请执行 database/add_message_compression_columns.sql: {e}")
+        self._schema_checked = True
+
+    def _probe_supabase(self):
+        """熔断器半开时的健康探测（失败抛异常）"""
+        self.supabase.table('sessions').select('id').limit(1).execute()
+        if not self._schema_checked:
+            self._check_schema()
+
+    @staticmethod
+    def _is_request_error(error: Exception) -> bool:
+        """Supabase 已正常响应、只是拒绝了本次请求（约束冲突、参数错误、表不存在等），不算故障"""
+        code = str(getattr(error, 'code', '') or '')
+        return type(error).__name__ == 'APIError' and (code[:2] in ('22', '23', '42') or code.startswith('PGRST'))
+
+    def _supabase_available(self) -> bool:
+        """Supabase 已启用且未熔断"""
+        return self.use_supabase and self.supabase_breaker.allow_request()
+
+    def _supabase_ok(self):
+        """记录一次 Supabase 请求成功（熔断器只对连续故障计数，成功即清零）"""
+        self.supabase_breaker.record_success()
+
+    def _supabase_failed(self, error: Exception):
+        """记录一次 Supabase 故障（连接失败、超时、5xx 等）；请求被拒绝说明服务正常，按成功计"""
+        if self._is_request_error(error):
+            self.supabase_breaker.record_success()
+        else:
+            self.supabase_breaker.record_failure()
+
+    def _remember_backend(self, session_id: str, backend: str):
+        """
+        只记住 Supabase 上的会话；本地会话随时可能被其他 worker 补写到 Supabase，
+        每次查一下本地主键即可（远比一次失败的 Supabase 请求便宜）
+        """
+        with self._session_backends_lock:
+            if backend != 'supabase':
+                self._session_backends.pop(session_id, None)
+                return
+            self._session_backends[session_id] = backend
+            self._session_backends.move_to_end(session_id)
+            while len(self._session_backends) > self.SESSION_BACKEND_CACHE_SIZE:
+                self._session_backends.popitem(last=False)
+
+    def _forget_backend(self, session_id: str):
+        """会话已从热表删除（如归档）时清掉记住的位置"""
+        with self._session_backends_lock:
+            self._session_backends.pop(session_id, None)
+
+    def _session_backend(self, session_id: str) -> str:
+        """
+        会话所在的存储：'supabase' 或 'sqlite'
+
+        Supabase 故障期间创建的会话只存在于本地库，记住位置后不再白白请求 Supabase
+        """
+        if not self.use_supabase:
+            return 'sqlite'
+
+        with self._session_backends_lock:
+            backend = self._session_backends.get(session_id)
+            if backend:
+                self._session_backends.move_to_end(session_id)
+                return backend
+
+        # 本地有记录且尚未补写到 Supabase 的才算本地会话
+        with self.connection() as conn:
+            row = conn.execute('SELECT synced_at FROM sessions WHERE id = ?', (session_id,)).fetchone()
+        backend = 'sqlite' if row and not row['synced_at'] else 'supabase'
+        self._remember_backend(session_id, backend)
+        return backend
+
+    def _supabase_holds(self, session_id: str) -> bool:
+        """该会话应访问 Supabase（会话在 Supabase 且未熔断）"""
+        return self._session_backend(session_id) == 'supabase' and self._supabase_available()
+
+    def connection(self, immediate: bool = False):
+        """
+        获取 SQLite 连接（上下文管理器，来自连接池）
 
-    def _get_conn(self) -> sqlite3.Connection:
-        """获取 SQLite 数据库连接"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        return conn
+        退出时自动提交，异常时回滚；其他模块的本地表也通过这里访问
+
+        Args:
+            immediate: 先读后写的事务传 True（BEGIN IMMEDIATE）
+        """
+        return self.pool.connection(immediate=immediate)
+
+    def get_stats(self) -> Dict:
+        """存储层运行统计（管理后台查看）"""
+        return {
+            'backend': 'supabase' if self.use_supabase else 'sqlite',
+            'supabase_breaker': self.supabase_breaker.stats(),
+            'session_backends_cached': len(self._session_backends),
+            'message_totals_cached': len(self._message_totals),
+            'outbox': self.outbox.stats(),
+            'session_cache': self.session_cache.stats(),
+            'storage_codec': storage_codec.stats(),
+            'archive': self.archive.stats(),
+            'single_flight': self.single_flight.stats(),
+            'sqlite_pool': self.pool.stats()
+        }
 
     def _safe_json_loads(self, data: str, default=None):
         """
@@ -65,99 +257,331 @@ class Database:
 
     def _init_db(self):
         """初始化本地 SQLite 数据库表"""
-        conn = self._get_conn()
-        cursor = conn.cursor()
-
-        # 会话表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS sessions (
-                id TEXT PRIMARY KEY,
-                module TEXT NOT NULL,
-                user_id TEXT,
-                user_email TEXT,
-                status TEXT DEFAULT 'in_progress',
-                collected_data TEXT DEFAULT '{}',
-                messages TEXT DEFAULT '[]',
-                output_document TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-
-        # 检查是否需要添加新列
-        cursor.execute("PRAGMA table_info(sessions)")
-        columns = [col[1] for col in cursor.fetchall()]
-
-        if 'user_id' not in columns:
-            cursor.execute('ALTER TABLE sessions ADD COLUMN user_id TEXT')
-        if 'user_email' not in columns:
-            cursor.execute('ALTER TABLE sessions ADD COLUMN user_email TEXT')
-
-        # 本地提示词表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS local_prompts (
-                module_id TEXT PRIMARY KEY,
-                prompt TEXT,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        with self.connection() as conn:
+            cursor = conn.cursor()
 
-        # 本地模块表
+            # 会话表
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS sessions (
+                    id TEXT PRIMARY KEY,
+                    module TEXT NOT NULL,
+                    user_id TEXT,
+                    user_email TEXT,
+                    status TEXT DEFAULT 'in_progress',
+                    collected_data TEXT DEFAULT '{}',
+                    messages TEXT DEFAULT '[]',
+                    output_document TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # 检查是否需要添加新列
+            cursor.execute("PRAGMA table_info(sessions)")
+            columns = [col[1] for col in cursor.fetchall()]
+
+            if 'user_id' not in columns:
+                cursor.execute('ALTER TABLE sessions ADD COLUMN user_id TEXT')
+            if 'user_email' not in columns:
+                cursor.execute('ALTER TABLE sessions ADD COLUMN user_email TEXT')
+            if 'synced_at' not in columns:
+                # 回退期间创建的会话补写到 Supabase 的时间
+                cursor.execute('ALTER TABLE sessions ADD COLUMN synced_at TIMESTAMP')
+
+            # 会话摘要列（写消息时同步维护，会话列表只读这些列）
+            summary_added = 'message_count' not in columns
+            if summary_added:
+                cursor.execute('ALTER TABLE sessions ADD COLUMN message_count INTEGER DEFAULT 0')
+                cursor.execute("ALTER TABLE sessions ADD COLUMN preview TEXT DEFAULT ''")
+                cursor.execute('ALTER TABLE sessions ADD COLUMN last_role TEXT')
+                cursor.execute('ALTER TABLE sessions ADD COLUMN total_chars INTEGER DEFAULT 0')
+
+            # 会话消息表（一条消息一行，追加写入）
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS session_messages (
+                    session_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT,
+                    created_at TEXT,
+                    content_chars INTEGER,
+                    content_preview TEXT,
+                    PRIMARY KEY (session_id, seq)
+                )
+            ''')
+            # 压缩存储的消息记下原文长度和预览，摘要重算时不用解压
+            cursor.execute('PRAGMA table_info(session_messages)')
+            message_columns = [col[1] for col in cursor.fetchall()]
+            if 'content_chars' not in message_columns:
+                cursor.execute('ALTER TABLE session_messages ADD COLUMN content_chars INTEGER')
+                cursor.execute('ALTER TABLE session_messages ADD COLUMN content_preview TEXT')
+            self._migrate_legacy_messages(cursor)
+            if summary_added:
+                self._refresh_local_summaries(cursor)
+
+            # 会话列表按 (updated_at, id) 游标分页，常用过滤列带上排序列建复合索引
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions(updated_at, id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_user_email ON sessions(user_email, updated_at, id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_user_id ON sessions(user_id, updated_at, id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_module ON sessions(module, updated_at, id)')
+
+            # 本地提示词表
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS local_prompts (
+                    module_id TEXT PRIMARY KEY,
+                    prompt TEXT,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # 本地模块表
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS local_modules (
+                    id TEXT PRIMARY KEY,
+                    name TEXT,
+                    icon TEXT,
+                    color TEXT,
+                    description TEXT,
+                    subtitle TEXT,
+                    sort_order INTEGER DEFAULT 99,
+                    is_active INTEGER DEFAULT 1,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # 预充值表（用户未注册时先存储，注册后自动发放）
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS pending_credits (
+                    id TEXT PRIMARY KEY,
+                    phone TEXT NOT NULL,
+                    credits INTEGER NOT NULL,
+                    reason TEXT DEFAULT '管理员预充值',
+                    admin_name TEXT DEFAULT 'admin',
+                    status TEXT DEFAULT 'pending',
+                    claimed_at TIMESTAMP,
+                    claimed_user_id TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # 为预充值表创建索引
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_pending_credits_phone ON pending_credits(phone)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_pending_credits_status ON pending_credits(status)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_pending_credits_phone_status ON pending_credits(phone, status)')
+
+            # 用户调研记录表
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS user_research_notes (
+                    id TEXT PRIMARY KEY,
+                    user_email TEXT NOT NULL,
+                    category TEXT NOT NULL,
+                    content TEXT,
+                    file_url TEXT,
+                    file_name TEXT,
+                    file_type TEXT,
+                    file_text_content TEXT,
+                    notes TEXT,
+                    created_by TEXT DEFAULT 'admin',
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_research_user ON user_research_notes(user_email)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_research_category ON user_research_notes(category)')
+
+            # 同步发件箱（回退写入待补写到 Supabase）
+            SyncOutbox.create_tables(cursor)
+
+            # 全文检索索引
+            SearchIndex.create_tables(cursor)
+
+            # 会话冷存储索引
+            SessionArchive.create_tables(cursor)
+
+            # AI 响应缓存（共享层）
+            AIResponseCache.create_tables(cursor)
+
+            # 单飞请求的结果
+            SingleFlight.create_tables(cursor)
+
+            # AI 调用台账
+            AICallLedger.create_tables(cursor)
+
+    def _migrate_legacy_messages(self, cursor):
+        """把 sessions.messages 中的旧 JSON 数组拆分到 session_messages（可重复执行）"""
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS local_modules (
-                id TEXT PRIMARY KEY,
-                name TEXT,
-                icon TEXT,
-                color TEXT,
-                description TEXT,
-                subtitle TEXT,
-                sort_order INTEGER DEFAULT 99,
-                is_active INTEGER DEFAULT 1,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
+            SELECT id, messages FROM sessions
+            WHERE messages IS NOT NULL AND messages != '' AND messages != '[]'
         ''')
+        rows = cursor.fetchall()
+        if not rows:
+            return
 
-        # 预充值表（用户未注册时先存储，注册后自动发放）
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS pending_credits (
-                id TEXT PRIMARY KEY,
-                phone TEXT NOT NULL,
-                credits INTEGER NOT NULL,
-                reason TEXT DEFAULT '管理员预充值',
-                admin_name TEXT DEFAULT 'admin',
-                status TEXT DEFAULT 'pending',
-                claimed_at TIMESTAMP,
-                claimed_user_id TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        migrated = []
+        for row in rows:
+            messages = self._safe_json_loads(row['messages'], [])
+            cursor.execute('SELECT 1 FROM session_messages WHERE session_id = ? LIMIT 1', (row['id'],))
+            if messages and not cursor.fetchone():
+                records = [
+                    self._encoded_message(row['id'], msg.get('role', 'user'), msg.get('content', ''), msg.get('timestamp'))
+                    for msg in messages
+                ]
+                cursor.executemany('''
+                    INSERT INTO session_messages
+                    (session_id, seq, role, content, created_at, content_chars, content_preview)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', [
+                    (row['id'], seq, r['role'], r['content'], r['created_at'],
+                     r.get('content_chars'), r.get('content_preview'))
+                    for seq, r in enumerate(records)
+                ])
+                migrated.append(row['id'])
+            cursor.execute("UPDATE sessions SET messages = '[]' WHERE id = ?", (row['id'],))
+
+        self._refresh_local_summaries(cursor, migrated)
+        print(f"[数据库] 已将 {len(migrated)} 个会话的消息迁移到 session_messages")
+
+    def _refresh_local_summaries(self, cursor, session_ids: List[str] = None):
+        """根据 session_messages 重算本地会话摘要列（session_ids 为空时重算全部）"""
+        where = ''
+        params = []
+        if session_ids is not None:
+            if not session_ids:
+                return
+            where = f"WHERE id IN ({','.join('?' * len(session_ids))})"
+            params = list(session_ids)
+        cursor.execute(f'''
+            UPDATE sessions SET
+                message_count = (SELECT COUNT(*) FROM session_messages m WHERE m.session_id = sessions.id),
+                total_chars = (
+                    SELECT COALESCE(SUM(COALESCE(m.content_chars, LENGTH(m.content))), 0)
+                    FROM session_messages m WHERE m.session_id = sessions.id
+                ),
+                last_role = (
+                    SELECT m.role FROM session_messages m WHERE m.session_id = sessions.id ORDER BY m.seq DESC LIMIT 1
+                ),
+                preview = COALESCE((
+                    SELECT COALESCE(m.content_preview, SUBSTR(m.content, 1, {self.PREVIEW_LENGTH})
+                        || CASE WHEN LENGTH(m.content) > {self.PREVIEW_LENGTH} THEN '...' ELSE '' END)
+                    FROM session_messages m
+                    WHERE m.session_id = sessions.id AND m.role = 'user'
+                    ORDER BY m.seq LIMIT 1
+                ), '')
+            {where}
+        ''', params)
+
+    @classmethod
+    def _make_preview(cls, content: str) -> str:
+        """消息预览：前 50 个字符"""
+        content = content or ''
+        return content[:cls.PREVIEW_LENGTH] + ('...' if len(content) > cls.PREVIEW_LENGTH else '')
+
+    @classmethod
+    def _summarize_messages(cls, messages: List[Dict]) -> Dict:
+        """由消息列表计算摘要（Supabase 未加摘要列时使用）"""
+        preview = ''
+        for msg in messages:
+            if msg.get('role') == 'user':
+                preview = cls._make_preview(msg.get('content', ''))
+                break
+        return {
+            'message_count': len(messages),
+            'preview': preview,
+            'last_role': messages[-1].get('role') if messages else None,
+            'total_chars': sum(len(msg.get('content') or '') for msg in messages)
+        }
 
-        # 为预充值表创建索引
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_pending_credits_phone ON pending_credits(phone)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_pending_credits_status ON pending_credits(status)')
+    @staticmethod
+    def _session_summary(row: Dict) -> Dict:
+        """会话列表项：基本信息 + 摘要列（不含消息正文）"""
+        summary = dict(row)
+        summary['session_id'] = summary['id']
+        summary['message_count'] = summary.get('message_count') or 0
+        summary['total_chars'] = summary.get('total_chars') or 0
+        summary['preview'] = summary.get('preview') or '新对话'
+        return summary
+
+    @staticmethod
+    def _to_message(row) -> Dict:
+        """消息行 -> 消息字典（与旧 messages 数组的元素格式一致，压缩内容在此解压）"""
+        return {
+            'role': row['role'],
+            'content': storage_codec.decode(row['content']) or '',
+            'timestamp': row['created_at']
+        }
 
-        # 用户调研记录表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_research_notes (
-                id TEXT PRIMARY KEY,
-                user_email TEXT NOT NULL,
-                category TEXT NOT NULL,
-                content TEXT,
-                file_url TEXT,
-                file_name TEXT,
-                file_type TEXT,
-                file_text_content TEXT,
-                notes TEXT,
-                created_by TEXT DEFAULT 'admin',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_research_user ON user_research_notes(user_email)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_research_category ON user_research_notes(category)')
+    @classmethod
+    def _encoded_message(cls, session_id: str, role: str, content: str, created_at: str) -> Dict:
+        """待落库的消息行：大文本压缩，并记下原文长度和预览（供摘要使用）"""
+        record = {'session_id': session_id, 'role': role, 'content': storage_codec.encode(content), 'created_at': created_at}
+        if storage_codec.is_encoded(record['content']):
+            record['content_chars'] = len(content)
+            record['content_preview'] = cls._make_preview(content)
+        return record
+
+    def _supabase_message(self, record: Dict) -> Dict:
+        """按 Supabase 是否支持压缩存储调整消息行（不支持时解压成明文、去掉辅助列）"""
+        if self.use_compressed_storage:
+            return record
+        record = dict(record, content=storage_codec.decode(record.get('content')))
+        record.pop('content_chars', None)
+        record.pop('content_preview', None)
+        return record
+
+    def _supabase_text(self, value: Optional[str]) -> Optional[str]:
+        """写入 Supabase 的大文本字段（文档、文件文本）：支持压缩存储时压缩，否则保持明文"""
+        if self.use_compressed_storage:
+            return storage_codec.encode(value)
+        return storage_codec.decode(value)
+
+    def _load_local_messages(self, cursor, session_ids: List[str]) -> Dict[str, List[Dict]]:
+        """批量读取 SQLite 中多个会话的消息"""
+        result = {sid: [] for sid in session_ids}
+        if not session_ids:
+            return result
+        placeholders = ','.join('?' * len(session_ids))
+        cursor.execute(f'''
+            SELECT session_id, role, content, created_at FROM session_messages
+            WHERE session_id IN ({placeholders})
+            ORDER BY session_id, seq
+        ''', list(session_ids))
+        for row in cursor.fetchall():
+            result[row['session_id']].append(self._to_message(row))
+        return result
 
-        conn.commit()
-        conn.close()
+    def _supabase_session_columns(self, columns: str) -> str:
+        """构造 Supabase 会话查询字段（嵌入 session_messages，同一次请求取回消息）"""
+        if self.use_message_table:
+            return f'{columns}, messages, session_messages(seq, role, content, created_at)'
+        return f'{columns}, messages'
+
+    def _messages_from_supabase_row(self, row: Dict) -> List[Dict]:
+        """从 Supabase 会话行中取出消息列表（兼容尚未迁移的 messages 数组）"""
+        rows = row.get('session_messages')
+        if rows:
+            return [self._to_message(r) for r in sorted(rows, key=lambda r: r['seq'])]
+
+        legacy = row.get('messages') or []
+        if isinstance(legacy, str):
+            legacy = self._safe_json_loads(legacy, [])
+        if legacy and self.use_message_table:
+            self._backfill_supabase_messages(row['id'], legacy)
+        return legacy
+
+    def _backfill_supabase_messages(self, session_id: str, messages: List[Dict]):
+        """读到未迁移的旧数组时，顺手写入 session_messages 并清空旧列"""
+        try:
+            self.supabase.table('session_messages').upsert([
+                dict(self._supabase_message(self._encoded_message(
+                    session_id, msg.get('role', 'user'), msg.get('content', ''), msg.get('timestamp')
+                )), seq=seq)
+                for seq, msg in enumerate(messages)
+            ], on_conflict='session_id,seq', ignore_duplicates=True).execute()
+            self.supabase.table('sessions').update({'messages': []}).eq('id', session_id).execute()
+            self._supabase_ok()
+        except Exception as e:
+            self._supabase_failed(e)
+            print(f"Supabase 迁移会话 {session_id} 的旧消息失败: {e}")
 
     # ========================================
     # 会话管理 - Supabase 优先
@@ -198,7 +622,7 @@ class Database:
         }
 
         # 优先尝试 Supabase
-        if self.use_supabase:
+        if self._supabase_available():
             try:
                 self.supabase.table('sessions').insert({
                     'id': session_id,
@@ -211,27 +635,47 @@ class Database:
                     'created_at': now,
                     'updated_at': now
                 }).execute()
+                self._supabase_ok()
+                self._remember_backend(session_id, 'supabase')
                 return session_id
             except Exception as e:
+                self._supabase_failed(e)
                 print(f"Supabase 创建会话失败，回退到 SQLite: {e}")
 
         # 回退到 SQLite
-        conn = self._get_conn()
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO sessions (id, module, user_id, user_email, collected_data, messages)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (session_id, module, user_id, user_email, json.dumps(collected_data, ensure_ascii=False), '[]'))
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO sessions (id, module, user_id, user_email, collected_data, messages)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (session_id, module, user_id, user_email, json.dumps(collected_data, ensure_ascii=False), '[]'))
+            if self.use_supabase:
+                self.outbox.enqueue(KIND_SESSION, session_id)
+        self._remember_backend(session_id, 'sqlite')
         return session_id
 
     def get_session(self, session_id: str) -> Optional[Dict]:
-        """获取会话详情"""
+        """获取会话详情（先查会话缓存，热表没有时查冷存储）"""
+        session = self.session_cache.get(session_id)
+        if session is not None:
+            return session
+
+        session = self._fetch_session(session_id) or self.archive.get_session(session_id)
+        if session is not None:
+            self.session_cache.put(session_id, session)
+        return session
+
+    def _fetch_session(self, session_id: str) -> Optional[Dict]:
+        """从存储读取会话详情"""
         # 优先尝试 Supabase
-        if self.use_supabase:
+        if self._supabase_holds(session_id):
             try:
-                result = self.supabase.table('sessions').select('*').eq('id', session_id).execute()
+                result = self.supabase.table('sessions').select(
+                    self._supabase_session_columns(
+                        'id, module, user_id, user_email, status, collected_data, output_document, created_at, updated_at'
+                    )
+                ).eq('id', session_id).execute()
+                self._supabase_ok()
                 if result.data:
                     row = result.data[0]
                     return {
@@ -241,20 +685,21 @@ class Database:
                         'user_email': row.get('user_email'),
                         'status': row.get('status', 'in_progress'),
                         'collected_data': row.get('collected_data') or {},
-                        'messages': row.get('messages') or [],
-                        'output_document': row.get('output_document'),
+                        'messages': self._messages_from_supabase_row(row),
+                        'output_document': storage_codec.decode(row.get('output_document')),
                         'created_at': row.get('created_at'),
                         'updated_at': row.get('updated_at')
                     }
             except Exception as e:
+                self._supabase_failed(e)
                 print(f"Supabase 获取会话失败，回退到 SQLite: {e}")
 
         # 回退到 SQLite
-        conn = self._get_conn()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM sessions WHERE id = ?', (session_id,))
-        row = cursor.fetchone()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM sessions WHERE id = ?', (session_id,))
+            row = cursor.fetchone()
+            messages = self._load_local_messages(cursor, [session_id])[session_id] if row else []
 
         if row:
             return {
@@ -264,50 +709,118 @@ class Database:
                 'user_email': row['user_email'],
                 'status': row['status'],
                 'collected_data': self._safe_json_loads(row['collected_data'], {}),
-                'messages': self._safe_json_loads(row['messages'], []),
-                'output_document': row['output_document'],
+                'messages': messages,
+                'output_document': storage_codec.decode(row['output_document']),
                 'created_at': row['created_at'],
                 'updated_at': row['updated_at']
             }
         return None
 
     def add_message(self, session_id: str, role: str, content: str) -> bool:
-        """添加消息到会话"""
-        session = self.get_session(session_id)
-        if not session:
+        """追加一条消息（只插入一行，不回写整个消息列表）"""
+        now = datetime.now().isoformat()
+        # 已归档的会话先恢复到热表再写（热表已没有该会话，Supabase 会话直接写会被外键拒绝）
+        if self.archive.contains(session_id) and not self.archive.restore(session_id):
             return False
+        if not self._insert_message(session_id, role, content, now):
+            return False
+        self.search_index.index_message(session_id, role, content, now)
 
-        messages = session['messages']
-        messages.append({
-            'role': role,
-            'content': content,
-            'timestamp': datetime.now().isoformat()
-        })
+        with self._message_totals_lock:
+            totals = self._message_totals.get(session_id)
 
-        now = datetime.now().isoformat()
+        def apply(cached: Dict):
+            # 前缀和与缓存中的消息列表对齐时顺带追加（缓存有两层，只追加一次）
+            if totals is not None and len(totals) == len(cached['messages']):
+                totals.append(content)
+            cached['messages'].append({'role': role, 'content': content, 'timestamp': now})
+            cached['updated_at'] = now
 
-        # 优先尝试 Supabase
-        if self.use_supabase:
+        self.session_cache.update(session_id, apply)
+        return True
+
+    def _insert_message(self, session_id: str, role: str, content: str, now: str) -> bool:
+        """写入一条消息行"""
+
+        # 优先尝试 Supabase（seq 与 updated_at 由触发器维护）
+        record = self._encoded_message(session_id, role, content, now)
+        on_supabase = self._supabase_holds(session_id)
+        if on_supabase and self.use_message_table:
             try:
-                self.supabase.table('sessions').update({
-                    'messages': messages,
-                    'updated_at': now
-                }).eq('id', session_id).execute()
+                self.supabase.table('session_messages').insert(self._supabase_message(record)).execute()
+                self._supabase_ok()
                 return True
             except Exception as e:
+                if self._is_request_error(e):
+                    # 被拒绝（如会话不存在的外键冲突）：补写也会同样失败，不记入发件箱
+                    print(f"Supabase 拒绝添加消息: {e}")
+                    return False
+                self._supabase_failed(e)
                 print(f"Supabase 添加消息失败，回退到 SQLite: {e}")
+        elif on_supabase:
+            appended = self._append_legacy_message(session_id, role, content, now)
+            if appended is not None:
+                return appended
+
+        message = {key: value for key, value in record.items() if key != 'session_id'}
+        if self.use_supabase and self._session_backend(session_id) == 'supabase':
+            # 会话在 Supabase 上但暂时写不进去（故障或已熔断）：记入发件箱，恢复后补写
+            self.outbox.enqueue(KIND_MESSAGE, session_id, message)
+            return True
 
         # 回退到 SQLite
-        conn = self._get_conn()
-        cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE sessions
-            SET messages = ?, updated_at = CURRENT_TIMESTAMP
-            WHERE id = ?
-        ''', (json.dumps(messages, ensure_ascii=False), session_id))
-        conn.commit()
-        conn.close()
-        return True
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO session_messages
+                (session_id, seq, role, content, created_at, content_chars, content_preview)
+                SELECT ?, (SELECT COALESCE(MAX(seq), -1) + 1 FROM session_messages WHERE session_id = ?), ?, ?, ?, ?, ?
+                WHERE EXISTS (SELECT 1 FROM sessions WHERE id = ?)
+                RETURNING seq
+            ''', (session_id, session_id, role, record['content'], now,
+                  record.get('content_chars'), record.get('content_preview'), session_id))
+            row = cursor.fetchone()
+            if row:
+                cursor.execute('''
+                    UPDATE sessions SET
+                        updated_at = CURRENT_TIMESTAMP,
+                        message_count = COALESCE(message_count, 0) + 1,
+                        total_chars = COALESCE(total_chars, 0) + ?,
+                        last_role = ?,
+                        preview = CASE
+                            WHEN COALESCE(preview, '') = '' AND ? = 'user' THEN ? ELSE preview
+                        END
+                    WHERE id = ?
+                ''', (len(content or ''), role, role, self._make_preview(content), session_id))
+                if self.use_supabase:
+                    self.outbox.enqueue(KIND_MESSAGE, session_id, dict(message, seq=row['seq']))
+        return row is not None
+
+    def _append_legacy_message(self, session_id: str, role: str, content: str, now: str) -> Optional[bool]:
+        """
+        Supabase 尚未迁移 session_messages 时的旧写法（读改写 messages 数组）
+
+        返回 True 写入成功；False 会话不存在或请求被拒绝；None Supabase 故障（由调用方记入发件箱）
+        """
+        try:
+            result = self.supabase.table('sessions').select('messages').eq('id', session_id).execute()
+            self._supabase_ok()
+            if not result.data:
+                return False
+            messages = result.data[0].get('messages') or []
+            messages.append({'role': role, 'content': content, 'timestamp': now})
+            self.supabase.table('sessions').update({
+                'messages': messages,
+                'updated_at': now
+            }).eq('id', session_id).execute()
+            return True
+        except Exception as e:
+            if self._is_request_error(e):
+                print(f"Supabase 拒绝添加消息: {e}")
+                return False
+            self._supabase_failed(e)
+            print(f"Supabase 添加消息失败，回退到 SQLite: {e}")
+            return None
 
     def update_collected_data(self, session_id: str, new_data: dict) -> bool:
         """更新已收集的数据"""
@@ -319,60 +832,138 @@ class Database:
         collected_data.update(new_data)
 
         now = datetime.now().isoformat()
+        self._write_collected_data(session_id, collected_data, now)
+
+        def apply(cached: Dict):
+            cached['collected_data'] = dict(collected_data)
+            cached['updated_at'] = now
+
+        self.session_cache.update(session_id, apply)
+        return True
 
+    def _write_collected_data(self, session_id: str, collected_data: Dict, now: str):
+        """写入 collected_data"""
         # 优先尝试 Supabase
-        if self.use_supabase:
+        if self._supabase_holds(session_id):
             try:
                 self.supabase.table('sessions').update({
                     'collected_data': collected_data,
                     'updated_at': now
                 }).eq('id', session_id).execute()
-                return True
+                self._supabase_ok()
+                return
             except Exception as e:
+                self._supabase_failed(e)
                 print(f"Supabase 更新数据失败，回退到 SQLite: {e}")
 
         # 回退到 SQLite
-        conn = self._get_conn()
-        cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE sessions
-            SET collected_data = ?, updated_at = CURRENT_TIMESTAMP
-            WHERE id = ?
-        ''', (json.dumps(collected_data, ensure_ascii=False), session_id))
-        conn.commit()
-        conn.close()
-        return True
+        self._fallback_session_update(session_id, {'collected_data': collected_data, 'updated_at': now})
 
     def save_output_document(self, session_id: str, document: str) -> bool:
         """保存产出文档"""
         now = datetime.now().isoformat()
+        self._write_output_document(session_id, document, now)
+
+        def apply(cached: Dict):
+            cached['output_document'] = document
+            cached['status'] = 'completed'
+            cached['updated_at'] = now
 
+        self.session_cache.update(session_id, apply)
+        return True
+
+    def _write_output_document(self, session_id: str, document: str, now: str):
+        """写入产出文档"""
         # 优先尝试 Supabase
-        if self.use_supabase:
+        if self._supabase_holds(session_id):
             try:
                 self.supabase.table('sessions').update({
-                    'output_document': document,
+                    'output_document': self._supabase_text(document),
                     'status': 'completed',
                     'updated_at': now
                 }).eq('id', session_id).execute()
-                return True
+                self._supabase_ok()
+                return
             except Exception as e:
+                self._supabase_failed(e)
                 print(f"Supabase 保存文档失败，回退到 SQLite: {e}")
 
         # 回退到 SQLite
-        conn = self._get_conn()
-        cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE sessions
-            SET output_document = ?, status = 'completed', updated_at = CURRENT_TIMESTAMP
-            WHERE id = ?
-        ''', (document, session_id))
-        conn.commit()
-        conn.close()
+        self._fallback_session_update(session_id, {
+            'output_document': storage_codec.encode(document),
+            'status': 'completed',
+            'updated_at': now
+        })
+
+    def claim_session(self, session_id: str, user_id: str, user_email: str = None) -> bool:
+        """把无主会话关联到指定用户"""
+        # 优先尝试 Supabase
+        if self._supabase_holds(session_id):
+            try:
+                self.supabase.table('sessions').update({
+                    'user_id': user_id,
+                    'user_email': user_email or ''
+                }).eq('id', session_id).execute()
+                self._supabase_ok()
+                self.session_cache.invalidate(session_id)
+                return True
+            except Exception as e:
+                self._supabase_failed(e)
+                print(f"Supabase 关联会话失败，回退到 SQLite: {e}")
+
+        # 回退到 SQLite
+        self._fallback_session_update(session_id, {'user_id': user_id, 'user_email': user_email or ''})
+        self.session_cache.invalidate(session_id)
         return True
 
-    def get_messages_for_api(self, session_id: str, max_chars: int = 50000, module: str = '') -> List[Dict]:
-        """获取用于API调用的消息格式（智能压缩版）"""
+    def _fallback_session_update(self, session_id: str, fields: Dict):
+        """
+        回退写入会话字段
+
+        本地会话直接更新 SQLite（并记入发件箱，补写时带上最新整行）；
+        Supabase 上的会话本地没有这一行，只把要更新的字段记入发件箱
+        """
+        if self.use_supabase and self._session_backend(session_id) == 'supabase':
+            self.outbox.enqueue(KIND_SESSION_UPDATE, session_id, fields)
+            return
+
+        local_fields = {key: value for key, value in fields.items() if key != 'updated_at'}
+        assignments = ', '.join(f'{key} = ?' for key in local_fields)
+        values = [
+            json.dumps(value, ensure_ascii=False) if isinstance(value, dict) else value
+            for value in local_fields.values()
+        ]
+        with self.connection() as conn:
+            conn.execute(
+                f'UPDATE sessions SET {assignments}, updated_at = CURRENT_TIMESTAMP WHERE id = ?',
+                values + [session_id]
+            )
+            if self.use_supabase:
+                self.outbox.enqueue(KIND_SESSION, session_id)
+
+    def get_message_totals(self, session_id: str, messages: List[Dict]) -> MessageTotals:
+        """
+        会话消息的字符数 / token 数前缀和
+
+        add_message 时增量追加；其他 worker 追加的消息在这里只补算尾部，不重算整个历史
+        """
+        with self._message_totals_lock:
+            totals = self._message_totals.get(session_id)
+            if totals is None:
+                totals = MessageTotals()
+                self._message_totals[session_id] = totals
+            self._message_totals.move_to_end(session_id)
+            while len(self._message_totals) > self.MESSAGE_TOTALS_CACHE_SIZE:
+                self._message_totals.popitem(last=False)
+            return totals.sync(messages)
+
+    def get_messages_for_api(self, session_id: str, max_tokens: int = None, module: str = '') -> List[Dict]:
+        """
+        获取用于API调用的消息格式（智能压缩版）
+
+        Args:
+            max_tokens: 历史消息可用的 token 数，默认为整个上下文预算（见 token_budget）
+        """
         session = self.get_session(session_id)
         if not session:
             return []
@@ -381,11 +972,14 @@ class Database:
         if not all_messages:
             return []
 
-        # 计算总字符数
-        total_chars = sum(len(msg.get('content', '')) for msg in all_messages)
+        if max_tokens is None:
+            max_tokens = context_budget.total
+
+        # 累计 token 数直接取前缀和末项
+        totals = self.get_message_totals(session_id, all_messages)
 
         # 如果没超限，直接返回全部
-        if total_chars <= max_chars:
+        if totals.total_tokens <= max_tokens:
             return [{'role': msg['role'], 'content': msg['content']} for msg in all_messages]
 
         # 超限了，使用智能压缩
@@ -394,176 +988,332 @@ class Database:
             return context_compressor.compress_messages(
                 all_messages,
                 module=module or session.get('module', ''),
-                force=True
+                force=True,
+                max_tokens=max_tokens
             )
         except Exception as e:
             print(f"智能压缩失败，使用简单截断: {e}")
-            return self._simple_truncate(all_messages, max_chars)
+            return self._simple_truncate(all_messages, max_tokens, totals)
 
-    def _simple_truncate(self, messages: List[Dict], max_chars: int) -> List[Dict]:
+    def _simple_truncate(self, messages: List[Dict], max_tokens: int, totals: MessageTotals = None) -> List[Dict]:
         """智能截断（降级方案）- 保留关键上下文"""
         if not messages:
             return []
+        if totals is None or len(totals) != len(messages):
+            totals = MessageTotals().sync(messages)
 
         api_messages = []
 
         # 保留第一条
         first_msg = messages[0]
         api_messages.append({'role': first_msg['role'], 'content': first_msg['content']})
-        first_len = len(first_msg.get('content', ''))
+        first_tokens = totals.tokens[1]
 
-        # 提取用户输入摘要
+        # 提取用户输入摘要（只需要最近 10 条，从后往前找）
         user_inputs_summary = []
-        for msg in messages[1:]:
+        for msg in reversed(messages[1:]):
             if msg.get('role') == 'user':
-                content = msg.get('content', '')[:300]
+                content = truncate_tokens(msg.get('content', ''), 300)
                 user_inputs_summary.append(f"- {content}")
+                if len(user_inputs_summary) == 10:
+                    break
+        user_inputs_summary.reverse()
 
         if user_inputs_summary:
-            summary = "【历史对话摘要】用户之前提供的信息：\n" + "\n".join(user_inputs_summary[-10:])
+            summary = "【历史对话摘要】用户之前提供的信息：\n" + "\n".join(user_inputs_summary)
             api_messages.append({
                 'role': 'system',
                 'content': summary + "\n\n请基于以上信息继续对话，不要重复询问已提供的信息。"
             })
 
         # 计算剩余空间
-        used_chars = first_len + len(api_messages[-1]['content']) if len(api_messages) > 1 else first_len
-        remaining_chars = max_chars - used_chars - 1000
-
-        # 从最近的消息往前加
-        recent_messages = []
-        for msg in reversed(messages[1:]):
-            msg_len = len(msg.get('content', ''))
-            if remaining_chars >= msg_len:
-                recent_messages.insert(0, {'role': msg['role'], 'content': msg['content']})
-                remaining_chars -= msg_len
-            else:
-                break
+        used_tokens = first_tokens + (estimate_tokens(api_messages[-1]['content']) if len(api_messages) > 1 else 0)
+        remaining_tokens = max_tokens - used_tokens - 1000
 
-        api_messages.extend(recent_messages)
+        # 最近消息窗口：前缀和上二分查找能放下的最早一条
+        start = totals.window_start(remaining_tokens, lo=1, by='tokens')
+        api_messages.extend({'role': msg['role'], 'content': msg['content']} for msg in messages[start:])
         return api_messages
 
     def list_sessions(self, limit: int = 20) -> List[Dict]:
         """列出最近的会话"""
         # 优先尝试 Supabase
-        if self.use_supabase:
+        if self._supabase_available():
             try:
                 result = self.supabase.table('sessions').select(
                     'id, module, status, created_at, updated_at'
                 ).order('updated_at', desc=True).limit(limit).execute()
+                self._supabase_ok()
                 return result.data or []
             except Exception as e:
+                self._supabase_failed(e)
                 print(f"Supabase 列出会话失败，回退到 SQLite: {e}")
 
         # 回退到 SQLite
-        conn = self._get_conn()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, module, status, created_at, updated_at
-            FROM sessions
-            ORDER BY updated_at DESC
-            LIMIT ?
-        ''', (limit,))
-        rows = cursor.fetchall()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id, module, status, created_at, updated_at
+                FROM sessions
+                ORDER BY updated_at DESC
+                LIMIT ?
+            ''', (limit,))
+            rows = cursor.fetchall()
         return [dict(row) for row in rows]
 
+    # 管理后台会话列表字段
+    ADMIN_SESSION_COLUMNS = 'id, module, user_id, user_email, status, created_at, updated_at'
+    # 会话列表可按这些字段精确过滤
+    SESSION_FILTER_FIELDS = ('user_email', 'user_id', 'module', 'status')
+
     def get_all_sessions_for_admin(self, limit: int = 100) -> List[Dict]:
-        """管理后台：获取所有会话（含用户信息和消息）"""
+        """管理后台：获取最近的会话（含用户信息和摘要，不含消息正文）"""
+        return self.browse_sessions(limit=limit)['sessions']
+
+    def get_user_sessions(self, user_id: str, limit: int = 20) -> List[Dict]:
+        """获取指定用户的所有会话（带预览，不含消息正文）"""
+        sessions = self._list_session_summaries(
+            'id, module, status, created_at, updated_at', limit=limit, filters={'user_id': user_id}
+        )
+        # 合并冷存储中的会话（都比热表中的旧，热表不足一页时才会出现）
+        if len(sessions) < limit:
+            sessions.extend(self.archive.list_user_sessions(user_id, limit - len(sessions)))
+        return sessions
+
+    def get_sessions_by_email(self, user_email: str, limit: int = 500) -> List[Dict]:
+        """管理后台：直接查询某个用户邮箱的会话（摘要）"""
+        return self.browse_sessions(limit=limit, user_email=user_email)['sessions']
+
+    def browse_sessions(
+        self,
+        limit: int = 50,
+        cursor: str = None,
+        user_email: str = None,
+        user_id: str = None,
+        module: str = None,
+        status: str = None,
+        date_from: str = None,
+        date_to: str = None
+    ) -> Dict:
+        """
+        管理后台分页浏览会话（按 (updated_at, id) 倒序的游标分页）
+
+        Args:
+            limit: 每页条数
+            cursor: 上一页返回的 next_cursor，为空时从最新开始
+            user_email / user_id / module / status: 精确过滤
+            date_from / date_to: 按最后活跃时间（updated_at）过滤，YYYY-MM-DD 格式时 date_to 包含当天
+
+        Returns:
+            {'sessions': [...], 'next_cursor': str 或 None}
+
+        Raises:
+            ValueError: cursor 无法解析
+        """
+        filters = {
+            'user_email': user_email,
+            'user_id': user_id,
+            'module': module,
+            'status': status
+        }
+        after = self._decode_cursor(cursor) if cursor else None
+        if date_to and len(date_to) == 10:
+            date_to = (datetime.strptime(date_to, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+
+        # 多取一条判断是否还有下一页
+        sessions = self._list_session_summaries(
+            self.ADMIN_SESSION_COLUMNS, limit=limit + 1, filters=filters,
+            after=after, date_from=date_from, date_to=date_to
+        )
+        next_cursor = None
+        if len(sessions) > limit:
+            sessions = sessions[:limit]
+            last = sessions[-1]
+            next_cursor = self._encode_cursor(last['updated_at'], last['id'])
+        return {'sessions': sessions, 'next_cursor': next_cursor}
+
+    @staticmethod
+    def _encode_cursor(updated_at: str, session_id: str) -> str:
+        raw = json.dumps([updated_at, session_id], ensure_ascii=False).encode('utf-8')
+        return base64.urlsafe_b64encode(raw).decode('ascii')
+
+    @staticmethod
+    def _decode_cursor(cursor: str) -> Tuple[str, str]:
+        try:
+            updated_at, session_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+            return str(updated_at), str(session_id)
+        except Exception:
+            raise ValueError('无效的分页游标')
+
+    def _list_session_summaries(
+        self,
+        columns: str,
+        limit: int,
+        filters: Dict = None,
+        after: Tuple[str, str] = None,
+        date_from: str = None,
+        date_to: str = None
+    ) -> List[Dict]:
+        """按 (updated_at, id) 倒序列出会话摘要，过滤条件下推到存储层"""
+        filters = {key: value for key, value in (filters or {}).items()
+                   if value is not None and key in self.SESSION_FILTER_FIELDS}
+
         # 优先尝试 Supabase
-        if self.use_supabase:
+        if self._supabase_available():
             try:
-                result = self.supabase.table('sessions').select(
-                    'id, module, user_id, user_email, status, messages, created_at, updated_at'
-                ).order('updated_at', desc=True).limit(limit).execute()
+                if self.use_summary_columns:
+                    query = self.supabase.table('sessions').select(f'{columns}, {self.SUMMARY_COLUMNS}')
+                else:
+                    # 尚未加摘要列：取回消息现算（不返回消息正文）
+                    query = self.supabase.table('sessions').select(self._supabase_session_columns(columns))
+                for key, value in filters.items():
+                    query = query.eq(key, value)
+                if date_from:
+                    query = query.gte('updated_at', date_from)
+                if date_to:
+                    query = query.lt('updated_at', date_to)
+                if after:
+                    updated_at, session_id = after
+                    query = query.or_(
+                        f'updated_at.lt."{updated_at}",and(updated_at.eq."{updated_at}",id.lt."{session_id}")'
+                    )
+                result = query.order('updated_at', desc=True).order('id', desc=True).limit(limit).execute()
+                self._supabase_ok()
 
                 sessions = []
                 for row in (result.data or []):
-                    session_dict = dict(row)
-                    session_dict['session_id'] = session_dict['id']
-                    session_dict['messages'] = row.get('messages') or []
-                    session_dict['message_count'] = len(session_dict['messages'])
-                    sessions.append(session_dict)
+                    if not self.use_summary_columns:
+                        messages = self._messages_from_supabase_row(row)
+                        row = {key: value for key, value in row.items() if key not in ('messages', 'session_messages')}
+                        row.update(self._summarize_messages(messages))
+                    sessions.append(self._session_summary(row))
                 return sessions
             except Exception as e:
-                print(f"Supabase 获取管理会话失败，回退到 SQLite: {e}")
+                self._supabase_failed(e)
+                print(f"Supabase 获取会话列表失败，回退到 SQLite: {e}")
+
+        # 回退到 SQLite（走 (过滤列, updated_at, id) 索引）
+        conditions = [f'{key} = ?' for key in filters]
+        params = list(filters.values())
+        if date_from:
+            conditions.append('updated_at >= ?')
+            params.append(date_from)
+        if date_to:
+            conditions.append('updated_at < ?')
+            params.append(date_to)
+        if after:
+            conditions.append('(updated_at < ? OR (updated_at = ? AND id < ?))')
+            params.extend([after[0], after[0], after[1]])
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT {columns}, {self.SUMMARY_COLUMNS}
+                FROM sessions
+                {where}
+                ORDER BY updated_at DESC, id DESC
+                LIMIT ?
+            ''', params + [limit])
+            rows = cursor.fetchall()
+        return [self._session_summary(dict(row)) for row in rows]
 
-        # 回退到 SQLite
-        conn = self._get_conn()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, module, user_id, user_email, status, messages, created_at, updated_at
-            FROM sessions
-            ORDER BY updated_at DESC
-            LIMIT ?
-        ''', (limit,))
-        rows = cursor.fetchall()
-        conn.close()
+    def get_session_summaries(self, session_ids: List[str]) -> Dict[str, Dict]:
+        """按 id 批量获取会话摘要，返回 {session_id: summary}"""
+        session_ids = list(dict.fromkeys(session_ids))
+        if not session_ids:
+            return {}
 
-        result = []
-        for row in rows:
-            session_dict = dict(row)
-            session_dict['session_id'] = session_dict['id']
-            session_dict['messages'] = self._safe_json_loads(session_dict['messages'], [])
-            session_dict['message_count'] = len(session_dict['messages'])
-            result.append(session_dict)
-        return result
+        summaries = {}
 
-    def get_user_sessions(self, user_id: str, limit: int = 20) -> List[Dict]:
-        """获取指定用户的所有会话（带预览）"""
         # 优先尝试 Supabase
-        if self.use_supabase:
+        if self._supabase_available():
             try:
+                summary_columns = f', {self.SUMMARY_COLUMNS}' if self.use_summary_columns else ''
                 result = self.supabase.table('sessions').select(
-                    'id, module, status, messages, created_at, updated_at'
-                ).eq('user_id', user_id).order('updated_at', desc=True).limit(limit).execute()
-
-                sessions = []
-                for row in (result.data or []):
-                    session_dict = dict(row)
-                    messages = row.get('messages') or []
-                    session_dict['messages'] = messages
-
-                    # 生成预览
-                    preview = '新对话'
-                    for msg in messages:
-                        if msg.get('role') == 'user':
-                            content = msg.get('content', '')
-                            preview = content[:50] + ('...' if len(content) > 50 else '')
-                            break
-                    session_dict['preview'] = preview
-                    sessions.append(session_dict)
-                return sessions
+                    f'{self.ADMIN_SESSION_COLUMNS}{summary_columns}'
+                ).in_('id', session_ids).execute()
+                self._supabase_ok()
+                summaries = {row['id']: self._session_summary(row) for row in (result.data or [])}
+                missing = [sid for sid in session_ids if sid not in summaries]
+                if not missing:
+                    return summaries
+                # Supabase 中没有的（本地会话）继续查 SQLite
+                session_ids = missing
             except Exception as e:
-                print(f"Supabase 获取用户会话失败，回退到 SQLite: {e}")
+                self._supabase_failed(e)
+                print(f"Supabase 获取会话摘要失败，回退到 SQLite: {e}")
 
         # 回退到 SQLite
-        conn = self._get_conn()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, module, status, messages, created_at, updated_at
-            FROM sessions
-            WHERE user_id = ?
-            ORDER BY updated_at DESC
-            LIMIT ?
-        ''', (user_id, limit))
-        rows = cursor.fetchall()
-        conn.close()
-
-        result = []
-        for row in rows:
-            session_dict = dict(row)
-            messages = self._safe_json_loads(session_dict['messages'], [])
-            session_dict['messages'] = messages
-
-            preview = '新对话'
-            for msg in messages:
-                if msg.get('role') == 'user':
-                    content = msg.get('content', '')
-                    preview = content[:50] + ('...' if len(content) > 50 else '')
+        placeholders = ','.join('?' * len(session_ids))
+        with self.connection() as conn:
+            rows = conn.execute(f'''
+                SELECT {self.ADMIN_SESSION_COLUMNS}, {self.SUMMARY_COLUMNS}
+                FROM sessions WHERE id IN ({placeholders})
+            ''', session_ids).fetchall()
+        summaries.update({row['id']: self._session_summary(dict(row)) for row in rows})
+
+        # 热表中都没有的查冷存储
+        missing = [sid for sid in session_ids if sid not in summaries]
+        summaries.update(self.archive.get_summaries(missing))
+        return summaries
+
+    def get_session_messages(self, session_id: str) -> List[Dict]:
+        """按需获取单个会话的完整消息（会话列表不再带消息正文）"""
+        return self.get_messages_for_sessions([session_id]).get(session_id, [])
+
+    def _fetch_remote_messages(self, session_ids: List[str]) -> Dict[str, List[Dict]]:
+        """从 Supabase 读取会话消息，出错直接抛出（不回退，调用方决定如何处理）"""
+        result = {sid: [] for sid in session_ids}
+        if self.use_message_table:
+            # 分页读取（PostgREST 单次最多返回 1000 行）
+            offset = 0
+            while True:
+                rows = self.supabase.table('session_messages').select(
+                    'session_id, seq, role, content, created_at'
+                ).in_('session_id', session_ids).order('session_id').order('seq') \
+                    .range(offset, offset + self.MESSAGE_PAGE_SIZE - 1).execute()
+                for row in (rows.data or []):
+                    result[row['session_id']].append(self._to_message(row))
+                if len(rows.data or []) < self.MESSAGE_PAGE_SIZE:
                     break
-            session_dict['preview'] = preview
-            result.append(session_dict)
+                offset += self.MESSAGE_PAGE_SIZE
+            # 尚未拆分成消息行的旧会话
+            missing = [sid for sid in session_ids if not result[sid]]
+        else:
+            missing = session_ids
+        if missing:
+            legacy = self.supabase.table('sessions').select('id, messages').in_('id', missing).execute()
+            for row in (legacy.data or []):
+                result[row['id']] = self._messages_from_supabase_row(row)
+        return result
+
+    def get_messages_for_sessions(self, session_ids: List[str]) -> Dict[str, List[Dict]]:
+        """批量获取多个会话的完整消息，返回 {session_id: messages}"""
+        session_ids = list(dict.fromkeys(session_ids))
+        if not session_ids:
+            return {}
+
+        result = {sid: [] for sid in session_ids}
+        local_ids = [sid for sid in session_ids if self._session_backend(sid) == 'sqlite']
+        remote_ids = [sid for sid in session_ids if sid not in set(local_ids)]
+
+        # 优先尝试 Supabase
+        if remote_ids and self._supabase_available():
+            try:
+                result.update(self._fetch_remote_messages(remote_ids))
+                self._supabase_ok()
+                remote_ids = []
+            except Exception as e:
+                self._supabase_failed(e)
+                print(f"Supabase 获取会话消息失败，回退到 SQLite: {e}")
+
+        # 本地会话（以及 Supabase 不可用时）从 SQLite 读取
+        with self.connection() as conn:
+            result.update(self._load_local_messages(conn.cursor(), local_ids + remote_ids))
+
+        # 热表中没有消息的可能已归档
+        result.update(self.archive.get_messages([sid for sid in session_ids if not result[sid]]))
         return result
 
     # ========================================
@@ -573,14 +1323,12 @@ class Database:
     def save_local_prompt(self, module_id: str, prompt: str) -> bool:
         """保存提示词到本地 SQLite"""
         try:
-            conn = self._get_conn()
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT OR REPLACE INTO local_prompts (module_id, prompt, updated_at)
-                VALUES (?, ?, CURRENT_TIMESTAMP)
-            ''', (module_id, prompt))
-            conn.commit()
-            conn.close()
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    INSERT OR REPLACE INTO local_prompts (module_id, prompt, updated_at)
+                    VALUES (?, ?, CURRENT_TIMESTAMP)
+                ''', (module_id, prompt))
             return True
         except Exception as e:
             print(f"保存本地提示词失败: {e}")
@@ -589,11 +1337,10 @@ class Database:
     def get_local_prompt(self, module_id: str) -> Optional[str]:
         """从本地获取提示词"""
         try:
-            conn = self._get_conn()
-            cursor = conn.cursor()
-            cursor.execute('SELECT prompt FROM local_prompts WHERE module_id = ?', (module_id,))
-            row = cursor.fetchone()
-            conn.close()
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT prompt FROM local_prompts WHERE module_id = ?', (module_id,))
+                row = cursor.fetchone()
             return row['prompt'] if row else None
         except Exception as e:
             print(f"获取本地提示词失败: {e}")
@@ -620,17 +1367,15 @@ class Database:
             # 🔴 规范化手机号（去除空格和横杠），确保与查询时格式一致
             phone = phone.strip().replace(' ', '').replace('-', '')
 
-            conn = self._get_conn()
-            cursor = conn.cursor()
+            with self.connection() as conn:
+                cursor = conn.cursor()
 
-            record_id = str(uuid.uuid4())
-            cursor.execute('''
-                INSERT INTO pending_credits (id, phone, credits, reason, admin_name, status, created_at)
-                VALUES (?, ?, ?, ?, ?, 'pending', CURRENT_TIMESTAMP)
-            ''', (record_id, phone, credits, reason, admin_name))
+                record_id = str(uuid.uuid4())
+                cursor.execute('''
+                    INSERT INTO pending_credits (id, phone, credits, reason, admin_name, status, created_at)
+                    VALUES (?, ?, ?, ?, ?, 'pending', CURRENT_TIMESTAMP)
+                ''', (record_id, phone, credits, reason, admin_name))
 
-            conn.commit()
-            conn.close()
             return True, f"已为手机号 {phone} 预充值 {credits} 积分，用户注册后自动到账", record_id
         except Exception as e:
             print(f"添加预充值记录失败: {e}")
@@ -649,16 +1394,15 @@ class Database:
             # 🔴 规范化手机号
             phone = phone.strip().replace(' ', '').replace('-', '')
 
-            conn = self._get_conn()
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT id, phone, credits, reason, admin_name, status, created_at
-                FROM pending_credits
-                WHERE phone = ? AND status = 'pending'
-                ORDER BY created_at ASC
-            ''', (phone,))
-            rows = cursor.fetchall()
-            conn.close()
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT id, phone, credits, reason, admin_name, status, created_at
+                    FROM pending_credits
+                    WHERE phone = ? AND status = 'pending'
+                    ORDER BY created_at ASC
+                ''', (phone,))
+                rows = cursor.fetchall()
             return [dict(row) for row in rows]
         except Exception as e:
             print(f"获取预充值记录失败: {e}")
@@ -668,6 +1412,9 @@ class Database:
         """
         领取预充值积分（用户注册时调用）
 
+        一条 UPDATE ... RETURNING 完成领取：只改 status = 'pending' 的记录，
+        并发注册时同一条记录只会被领取一次
+
         Args:
             phone: 手机号
             user_id: 用户ID
@@ -678,50 +1425,28 @@ class Database:
             # 🔴 规范化手机号
             phone = phone.strip().replace(' ', '').replace('-', '')
 
-            conn = self._get_conn()
-            cursor = conn.cursor()
-
-            # 获取所有待发放的记录
-            cursor.execute('''
-                SELECT id, credits, reason, admin_name, created_at
-                FROM pending_credits
-                WHERE phone = ? AND status = 'pending'
-            ''', (phone,))
-            rows = cursor.fetchall()
-
-            if not rows:
-                conn.close()
-                return 0, []
-
-            total_credits = 0
-            claimed_records = []
-
-            for row in rows:
-                record = dict(row)
-                total_credits += record['credits']
-                claimed_records.append(record)
-
-                # 标记为已领取
-                cursor.execute('''
+            with self.connection(immediate=True) as conn:
+                rows = conn.execute('''
                     UPDATE pending_credits
                     SET status = 'claimed', claimed_at = CURRENT_TIMESTAMP, claimed_user_id = ?
-                    WHERE id = ?
-                ''', (user_id, record['id']))
+                    WHERE phone = ? AND status = 'pending'
+                    RETURNING id, credits, reason, admin_name, created_at
+                ''', (user_id, phone)).fetchall()
 
-            conn.commit()
-            conn.close()
-            return total_credits, claimed_records
+            claimed_records = [dict(row) for row in rows]
+            return sum(record['credits'] for record in claimed_records), claimed_records
         except Exception as e:
             print(f"领取预充值积分失败: {e}")
             return 0, []
 
-    def rollback_pending_credits(self, record_ids: List[str]) -> bool:
+    def rollback_pending_credits(self, record_ids: List[str], user_id: str = None) -> bool:
         """
         回滚预充值记录状态（当 add_credits 失败时调用）
-        将 claimed 状态改回 pending
+        将 claimed 状态改回 pending（一条 UPDATE，只回滚仍为 claimed 的记录）
 
         Args:
             record_ids: 需要回滚的记录 ID 列表
+            user_id: 传入时只回滚该用户领取的记录
 
         Returns: 是否成功
         """
@@ -729,24 +1454,53 @@ class Database:
             return True
 
         try:
-            conn = self._get_conn()
-            cursor = conn.cursor()
-
-            for record_id in record_ids:
-                cursor.execute('''
+            user_guard = 'AND claimed_user_id = ?' if user_id else ''
+            with self.connection() as conn:
+                rows = conn.execute(f'''
                     UPDATE pending_credits
                     SET status = 'pending', claimed_at = NULL, claimed_user_id = NULL
-                    WHERE id = ?
-                ''', (record_id,))
+                    WHERE id IN (SELECT value FROM json_each(?)) AND status = 'claimed' {user_guard}
+                    RETURNING id
+                ''', [json.dumps(list(record_ids))] + ([user_id] if user_id else [])).fetchall()
 
-            conn.commit()
-            conn.close()
-            print(f"[预充值] 回滚了 {len(record_ids)} 条记录")
+            print(f"[预充值] 回滚了 {len(rows)} 条记录")
             return True
         except Exception as e:
             print(f"回滚预充值记录失败: {e}")
             return False
 
+    def add_pending_credits_bulk(self, records: List[Dict], reason: str = "管理员预充值",
+                                 admin_name: str = "admin") -> Tuple[bool, str, List[str]]:
+        """
+        批量添加预充值记录（一个事务、一次 executemany）
+
+        Args:
+            records: [{'phone': 手机号, 'credits': 积分, 'reason': 可选}]
+            reason: 默认充值原因
+            admin_name: 操作管理员
+
+        Returns: (成功?, 消息, 预充值ID列表（与 records 顺序一致）)
+        """
+        if not records:
+            return True, "没有需要预充值的记录", []
+
+        try:
+            rows = [
+                (str(uuid.uuid4()), str(record['phone']).strip().replace(' ', '').replace('-', ''),
+                 int(record['credits']), record.get('reason') or reason, admin_name)
+                for record in records
+            ]
+            with self.connection() as conn:
+                conn.executemany('''
+                    INSERT INTO pending_credits (id, phone, credits, reason, admin_name, status, created_at)
+                    VALUES (?, ?, ?, ?, ?, 'pending', CURRENT_TIMESTAMP)
+                ''', rows)
+
+            return True, f"已为 {len(rows)} 个手机号预充值，用户注册后自动到账", [row[0] for row in rows]
+        except Exception as e:
+            print(f"批量添加预充值记录失败: {e}")
+            return False, f"批量预充值失败: {e}", []
+
     def get_all_pending_credits(self, status: str = None, limit: int = 100) -> List[Dict]:
         """
         获取所有预充值记录（管理后台用）
@@ -758,27 +1512,26 @@ class Database:
         Returns: 预充值记录列表
         """
         try:
-            conn = self._get_conn()
-            cursor = conn.cursor()
-
-            if status:
-                cursor.execute('''
-                    SELECT id, phone, credits, reason, admin_name, status, claimed_at, claimed_user_id, created_at
-                    FROM pending_credits
-                    WHERE status = ?
-                    ORDER BY created_at DESC
-                    LIMIT ?
-                ''', (status, limit))
-            else:
-                cursor.execute('''
-                    SELECT id, phone, credits, reason, admin_name, status, claimed_at, claimed_user_id, created_at
-                    FROM pending_credits
-                    ORDER BY created_at DESC
-                    LIMIT ?
-                ''', (limit,))
-
-            rows = cursor.fetchall()
-            conn.close()
+            with self.connection() as conn:
+                cursor = conn.cursor()
+
+                if status:
+                    cursor.execute('''
+                        SELECT id, phone, credits, reason, admin_name, status, claimed_at, claimed_user_id, created_at
+                        FROM pending_credits
+                        WHERE status = ?
+                        ORDER BY created_at DESC
+                        LIMIT ?
+                    ''', (status, limit))
+                else:
+                    cursor.execute('''
+                        SELECT id, phone, credits, reason, admin_name, status, claimed_at, claimed_user_id, created_at
+                        FROM pending_credits
+                        ORDER BY created_at DESC
+                        LIMIT ?
+                    ''', (limit,))
+
+                rows = cursor.fetchall()
             return [dict(row) for row in rows]
         except Exception as e:
             print(f"获取预充值记录列表失败: {e}")
@@ -791,27 +1544,60 @@ class Database:
     def get_research_notes_by_user(self, user_email: str) -> List[Dict]:
         """获取用户的所有调研记录（按时间倒序）"""
         # 优先尝试 Supabase
-        if self.use_supabase:
+        if self._supabase_available():
             try:
                 result = self.supabase.table('user_research_notes').select('*') \
                     .eq('user_email', user_email) \
                     .order('created_at', desc=True) \
                     .execute()
-                return result.data or []
+                self._supabase_ok()
+                return [self._decode_note(note) for note in (result.data or [])]
             except Exception as e:
+                self._supabase_failed(e)
                 print(f"Supabase 获取调研记录失败，回退到 SQLite: {e}")
 
         # 回退到 SQLite
-        conn = self._get_conn()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT * FROM user_research_notes
-            WHERE user_email = ?
-            ORDER BY created_at DESC
-        ''', (user_email,))
-        rows = cursor.fetchall()
-        conn.close()
-        return [dict(row) for row in rows]
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT * FROM user_research_notes
+                WHERE user_email = ?
+                ORDER BY created_at DESC
+            ''', (user_email,))
+            rows = cursor.fetchall()
+        return [self._decode_note(dict(row)) for row in rows]
+
+    def get_all_research_notes(self) -> List[Dict]:
+        """获取全部调研记录（重建搜索索引用）"""
+        # 优先尝试 Supabase
+        if self._supabase_available():
+            try:
+                notes = []
+                offset = 0
+                while True:
+                    result = self.supabase.table('user_research_notes').select('*') \
+                        .order('created_at').order('id') \
+                        .range(offset, offset + self.MESSAGE_PAGE_SIZE - 1).execute()
+                    notes.extend(self._decode_note(note) for note in (result.data or []))
+                    if len(result.data or []) < self.MESSAGE_PAGE_SIZE:
+                        break
+                    offset += self.MESSAGE_PAGE_SIZE
+                self._supabase_ok()
+                return notes
+            except Exception as e:
+                self._supabase_failed(e)
+                print(f"Supabase 获取调研记录失败，回退到 SQLite: {e}")
+
+        # 回退到 SQLite
+        with self.connection() as conn:
+            rows = conn.execute('SELECT * FROM user_research_notes ORDER BY created_at').fetchall()
+        return [self._decode_note(dict(row)) for row in rows]
+
+    @staticmethod
+    def _decode_note(note: Dict) -> Dict:
+        """调研记录读出后解压文件文本"""
+        note['file_text_content'] = storage_codec.decode(note.get('file_text_content'))
+        return note
 
     def create_research_note(
         self,
@@ -828,58 +1614,69 @@ class Database:
         """创建新的调研记录"""
         note_id = str(uuid.uuid4())
         now = datetime.now().isoformat()
+        note = {
+            'id': note_id,
+            'user_email': user_email,
+            'category': category,
+            'content': content,
+            'file_url': file_url,
+            'file_name': file_name,
+            'file_type': file_type,
+            'file_text_content': file_text_content,
+            'notes': notes,
+            'created_by': created_by,
+            'created_at': now,
+            'updated_at': now
+        }
 
         # 优先尝试 Supabase
-        if self.use_supabase:
+        saved = False
+        if self._supabase_available():
             try:
-                self.supabase.table('user_research_notes').insert({
-                    'id': note_id,
-                    'user_email': user_email,
-                    'category': category,
-                    'content': content,
-                    'file_url': file_url,
-                    'file_name': file_name,
-                    'file_type': file_type,
-                    'file_text_content': file_text_content,
-                    'notes': notes,
-                    'created_by': created_by,
-                    'created_at': now,
-                    'updated_at': now
-                }).execute()
-                return note_id
+                self.supabase.table('user_research_notes').insert(
+                    dict(note, file_text_content=self._supabase_text(file_text_content))
+                ).execute()
+                self._supabase_ok()
+                saved = True
             except Exception as e:
+                self._supabase_failed(e)
                 print(f"Supabase 创建调研记录失败，回退到 SQLite: {e}")
 
         # 回退到 SQLite
-        conn = self._get_conn()
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO user_research_notes
-            (id, user_email, category, content, file_url, file_name, file_type,
-             file_text_content, notes, created_by, created_at, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (note_id, user_email, category, content, file_url, file_name,
-              file_type, file_text_content, notes, created_by, now, now))
-        conn.commit()
-        conn.close()
+        if not saved:
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    INSERT INTO user_research_notes
+                    (id, user_email, category, content, file_url, file_name, file_type,
+                     file_text_content, notes, created_by, created_at, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (note_id, user_email, category, content, file_url, file_name,
+                      file_type, storage_codec.encode(file_text_content), notes, created_by, now, now))
+                if self.use_supabase:
+                    self.outbox.enqueue(KIND_RESEARCH_NOTE, note_id)
+
+        self.search_index.index_research_note(note)
         return note_id
 
     def delete_research_note(self, note_id: str) -> bool:
         """删除调研记录"""
+        self.search_index.remove(SOURCE_RESEARCH_NOTE, note_id)
+
         # 优先尝试 Supabase
-        if self.use_supabase:
+        if self._supabase_available():
             try:
                 self.supabase.table('user_research_notes').delete().eq('id', note_id).execute()
+                self._supabase_ok()
                 return True
             except Exception as e:
+                self._supabase_failed(e)
                 print(f"Supabase 删除调研记录失败，回退到 SQLite: {e}")
 
         # 回退到 SQLite
-        conn = self._get_conn()
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM user_research_notes WHERE id = ?', (note_id,))
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM user_research_notes WHERE id = ?', (note_id,))
         return True
 
     def get_research_notes_text_for_analysis(self, user_email: str) -> str:
@@ -0,0 +1,29 @@
+-- 大文本压缩存储：超过阈值的消息正文以 "\x1b" 开头的压缩串存储（应用层编解码，见 modules/storage_codec.py）
+-- 压缩行额外记录原文字符数和预览，触发器维护会话摘要时不用解压
+-- 依赖 add_session_summary_columns.sql（需先执行）；执行前应用会把写入 Supabase 的内容保持明文
+ALTER TABLE public.session_messages ADD COLUMN IF NOT EXISTS content_chars INTEGER;
+ALTER TABLE public.session_messages ADD COLUMN IF NOT EXISTS content_preview TEXT;
+
+COMMENT ON COLUMN public.session_messages.content_chars IS '压缩存储时的原文字符数（未压缩为 NULL）';
+COMMENT ON COLUMN public.session_messages.content_preview IS '压缩存储时的原文前 50 个字符（未压缩为 NULL）';
+
+CREATE OR REPLACE FUNCTION public.session_messages_after_insert()
+RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE public.sessions
+    SET updated_at = NOW(),
+        message_count = COALESCE(message_count, 0) + 1,
+        total_chars = COALESCE(total_chars, 0) + COALESCE(NEW.content_chars, char_length(NEW.content), 0),
+        last_role = NEW.role,
+        preview = CASE
+            WHEN COALESCE(preview, '') = '' AND NEW.role = 'user'
+            THEN COALESCE(
+                NEW.content_preview,
+                LEFT(NEW.content, 50) || CASE WHEN char_length(NEW.content) > 50 THEN '...' ELSE '' END
+            )
+            ELSE preview
+        END
+    WHERE id = NEW.session_id;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
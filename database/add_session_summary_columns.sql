@@ -0,0 +1,75 @@
+-- 会话摘要列：会话列表只读这几列，不再加载消息正文
+-- 依赖 create_session_messages_table.sql（需先执行）
+ALTER TABLE public.sessions ADD COLUMN IF NOT EXISTS message_count INTEGER DEFAULT 0;
+ALTER TABLE public.sessions ADD COLUMN IF NOT EXISTS preview TEXT DEFAULT '';
+ALTER TABLE public.sessions ADD COLUMN IF NOT EXISTS last_role VARCHAR(20);
+ALTER TABLE public.sessions ADD COLUMN IF NOT EXISTS total_chars INTEGER DEFAULT 0;
+
+COMMENT ON COLUMN public.sessions.message_count IS '消息条数（插入消息时由触发器维护）';
+COMMENT ON COLUMN public.sessions.preview IS '第一条用户消息的前 50 个字符';
+COMMENT ON COLUMN public.sessions.last_role IS '最后一条消息的角色';
+COMMENT ON COLUMN public.sessions.total_chars IS '全部消息的字符数';
+
+-- BEFORE 触发器只负责分配序号（upsert 冲突跳过的行也会经过 BEFORE 触发器）
+CREATE OR REPLACE FUNCTION public.session_messages_before_insert()
+RETURNS TRIGGER AS $$
+BEGIN
+    -- 同一会话的并发写入串行化，保证 seq 连续
+    PERFORM pg_advisory_xact_lock(hashtext(NEW.session_id));
+
+    IF NEW.seq IS NULL THEN
+        SELECT COALESCE(MAX(seq), -1) + 1 INTO NEW.seq
+        FROM public.session_messages
+        WHERE session_id = NEW.session_id;
+    END IF;
+
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+-- AFTER 触发器只对真正插入的行刷新会话摘要和更新时间
+CREATE OR REPLACE FUNCTION public.session_messages_after_insert()
+RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE public.sessions
+    SET updated_at = NOW(),
+        message_count = COALESCE(message_count, 0) + 1,
+        total_chars = COALESCE(total_chars, 0) + COALESCE(char_length(NEW.content), 0),
+        last_role = NEW.role,
+        preview = CASE
+            WHEN COALESCE(preview, '') = '' AND NEW.role = 'user'
+            THEN LEFT(NEW.content, 50) || CASE WHEN char_length(NEW.content) > 50 THEN '...' ELSE '' END
+            ELSE preview
+        END
+    WHERE id = NEW.session_id;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_session_messages_after_insert ON public.session_messages;
+CREATE TRIGGER trg_session_messages_after_insert
+    AFTER INSERT ON public.session_messages
+    FOR EACH ROW EXECUTE FUNCTION public.session_messages_after_insert();
+
+-- ========================================
+-- 回填已有会话的摘要（可重复执行）
+-- ========================================
+UPDATE public.sessions s
+SET message_count = agg.message_count,
+    total_chars = agg.total_chars,
+    last_role = agg.last_role,
+    preview = COALESCE(agg.preview, '')
+FROM (
+    SELECT
+        m.session_id,
+        COUNT(*) AS message_count,
+        COALESCE(SUM(char_length(m.content)), 0) AS total_chars,
+        (ARRAY_AGG(m.role ORDER BY m.seq DESC))[1] AS last_role,
+        (ARRAY_AGG(
+            LEFT(m.content, 50) || CASE WHEN char_length(m.content) > 50 THEN '...' ELSE '' END
+            ORDER BY m.seq
+        ) FILTER (WHERE m.role = 'user'))[1] AS preview
+    FROM public.session_messages m
+    GROUP BY m.session_id
+) agg
+WHERE s.id = agg.session_id;
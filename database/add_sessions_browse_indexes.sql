@@ -0,0 +1,15 @@
+-- 管理后台会话分页索引：按 (updated_at, id) 倒序游标分页，常用过滤列 + 排序列复合索引
+CREATE INDEX IF NOT EXISTS idx_sessions_updated
+    ON public.sessions (updated_at DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_sessions_user_email
+    ON public.sessions (user_email, updated_at DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_sessions_user_id
+    ON public.sessions (user_id, updated_at DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_sessions_module
+    ON public.sessions (module, updated_at DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_sessions_status
+    ON public.sessions (status, updated_at DESC, id DESC);
@@ -0,0 +1,80 @@
+-- 创建会话消息表（一条消息一行，替代 sessions.messages JSON 数组的整体读改写）
+CREATE TABLE IF NOT EXISTS public.session_messages (
+    session_id TEXT NOT NULL REFERENCES public.sessions(id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    role VARCHAR(20) NOT NULL,
+    content TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    PRIMARY KEY (session_id, seq)
+);
+
+-- 插入时自动分配序号并刷新会话更新时间（应用端只需一次 INSERT）
+CREATE OR REPLACE FUNCTION public.session_messages_before_insert()
+RETURNS TRIGGER AS $$
+BEGIN
+    -- 同一会话的并发写入串行化，保证 seq 连续
+    PERFORM pg_advisory_xact_lock(hashtext(NEW.session_id));
+
+    IF NEW.seq IS NULL THEN
+        SELECT COALESCE(MAX(seq), -1) + 1 INTO NEW.seq
+        FROM public.session_messages
+        WHERE session_id = NEW.session_id;
+    END IF;
+
+    UPDATE public.sessions SET updated_at = NOW() WHERE id = NEW.session_id;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_session_messages_before_insert ON public.session_messages;
+CREATE TRIGGER trg_session_messages_before_insert
+    BEFORE INSERT ON public.session_messages
+    FOR EACH ROW EXECUTE FUNCTION public.session_messages_before_insert();
+
+-- 启用 RLS
+ALTER TABLE public.session_messages ENABLE ROW LEVEL SECURITY;
+
+-- 创建策略：允许所有操作（通过 service_role key）
+CREATE POLICY "Allow all operations for service role" ON public.session_messages
+    FOR ALL
+    USING (true)
+    WITH CHECK (true);
+
+-- 添加注释
+COMMENT ON TABLE public.session_messages IS '会话消息表 - 每条消息一行，按 (session_id, seq) 排序';
+COMMENT ON COLUMN public.session_messages.seq IS '会话内消息序号（从 0 开始，插入时自动分配）';
+COMMENT ON COLUMN public.session_messages.role IS '角色：user / assistant / system';
+
+-- ========================================
+-- 迁移：把 sessions.messages 中已有的 JSON 数组拆成消息行
+-- 可重复执行；已迁移的会话会被跳过
+-- ========================================
+BEGIN;
+
+-- 迁移时不触发 updated_at 刷新，保留会话原有的活跃时间
+ALTER TABLE public.session_messages DISABLE TRIGGER trg_session_messages_before_insert;
+
+INSERT INTO public.session_messages (session_id, seq, role, content, created_at)
+SELECT
+    s.id,
+    (m.ordinality - 1)::INTEGER,
+    COALESCE(m.value->>'role', 'user'),
+    COALESCE(m.value->>'content', ''),
+    COALESCE((m.value->>'timestamp')::TIMESTAMP WITH TIME ZONE, s.created_at)
+FROM public.sessions s
+CROSS JOIN LATERAL jsonb_array_elements(s.messages) WITH ORDINALITY AS m(value, ordinality)
+WHERE jsonb_typeof(s.messages) = 'array'
+  AND jsonb_array_length(s.messages) > 0
+  AND NOT EXISTS (SELECT 1 FROM public.session_messages sm WHERE sm.session_id = s.id)
+ON CONFLICT (session_id, seq) DO NOTHING;
+
+ALTER TABLE public.session_messages ENABLE TRIGGER trg_session_messages_before_insert;
+
+-- 迁移完成后清空旧列（保留列本身，兼容旧版本代码读取）
+UPDATE public.sessions s
+SET messages = '[]'::jsonb
+WHERE jsonb_typeof(s.messages) = 'array'
+  AND jsonb_array_length(s.messages) > 0
+  AND EXISTS (SELECT 1 FROM public.session_messages sm WHERE sm.session_id = s.id);
+
+COMMIT;
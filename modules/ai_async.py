@@ -0,0 +1,259 @@
+"""
+异步流式引擎 - asgi.py 的流式对话通过它请求 AI 服务商
+基于 httpx.AsyncClient：一个事件循环里同时挂起成千上万个流，不再每个流占一个 greenlet + 一条阻塞连接；
+请求体、选路 / 熔断、首字统计、续写去重都与同步的 AIService 共用
+"""
+import logging
+import time
+from typing import AsyncGenerator, Dict, List
+
+import httpx
+
+from config import Config
+from modules.ai_gateway import AIGatewayError
+from modules.ai_hedge import StreamInterrupted
+from modules.ai_ledger import AICallRecord, ai_ledger, STATUS_OK, STATUS_ERROR, STATUS_INTERRUPTED, STATUS_CANCELLED
+from modules.ai_profiles import ai_profiles, PROFILE_INTERACTIVE_CHAT
+from modules.ai_router import ai_router
+from modules.ai_scheduler import ai_scheduler
+from modules.ai_service import ai_service, OverlapTrimmer, RESUME_PROMPT
+from modules.sse_codec import SSEDecoder
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncAIStreamer:
+    """
+    异步流式请求
+
+    - 每个 base URL 一个 AsyncClient（keep-alive 连接池），只在事件循环内使用
+    - 背压：只有上一段被消费（写给客户端）后才读上游的下一段，慢客户端不会让内存堆积
+    - 出首字前失败切换服务商；出首字后中断交给其他服务商续写（对冲模式只在同步路径上使用）
+    """
+
+    def __init__(self, max_connections: int = 1000, max_keepalive: int = 100):
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._stats = {'streams': 0, 'active': 0, 'peak_active': 0, 'failovers': 0, 'resumed': 0, 'failed': 0}
+
+    def _client(self, base_url: str) -> httpx.AsyncClient:
+        key = base_url.rstrip('/')
+        client = self._clients.get(key)
+        if client is None:
+            client = self._clients[key] = httpx.AsyncClient(
+                base_url=key,
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_keepalive),
+                timeout=httpx.Timeout(60, connect=10)
+            )
+        return client
+
+    async def aclose(self):
+        """关闭所有连接（ASGI lifespan shutdown 时调用）"""
+        clients, self._clients = list(self._clients.values()), {}
+        for client in clients:
+            await client.aclose()
+
+    async def _stream_request(
+        self,
+        api_name: str,
+        api_key: str,
+        base_url: str,
+        payload: dict,
+        timeout: float,
+        record: AICallRecord = None
+    ) -> AsyncGenerator[str, None]:
+        """
+        发起一次异步流式请求，逐段产出内容（与 AIService._stream_request 对应）
+
+        非 200 抛 AIGatewayError，网络错误抛 httpx.HTTPError
+        """
+        model_name = payload.get('model')
+        if record is not None:
+            record.attempt(api_name)
+        started = time.monotonic()
+        has_content = False
+        finished = False
+        reported = False
+        headers = {
+            'Authorization': f'Bearer {api_key}',
+            'Content-Type': 'application/json'
+        }
+        # 与同步网关共用服务商配额（对话是 interactive，取配额不会等待）
+        provider = base_url.rstrip('/')
+        ai_scheduler.acquire(provider)
+        try:
+            async with self._client(base_url).stream(
+                'POST', '/chat/completions', json=payload, headers=headers,
+                timeout=httpx.Timeout(timeout, connect=10)
+            ) as response:
+                ai_scheduler.record_response(provider, response.status_code, response.headers.get('Retry-After'))
+                if response.status_code != 200:
+                    body = (await response.aread()).decode('utf-8', errors='replace')
+                    raise AIGatewayError(response.status_code, body)
+
+                # 按网络读到的批次解析，同一批的多帧合成一段产出；
+                # [DONE] 之后也读完响应体（decoder 忽略其余数据），连接才能回到 keep-alive 池
+                decoder = SSEDecoder()
+                async for data in response.aiter_bytes():
+                    if decoder.done:
+                        continue
+                    content = decoder.feed(data)
+                    if content:
+                        if not has_content:
+                            has_content = True
+                            ttft = time.monotonic() - started
+                            ai_service.ttft.record(api_name, model_name, ttft)
+                            ai_router.record_success(api_name, model_name, ttft=ttft)
+                            if record is not None:
+                                record.first_token(api_name, ttft)
+                        yield content
+                finished = True
+            if has_content:
+                ai_router.record_latency(api_name, model_name, time.monotonic() - started)
+            else:
+                ai_router.record_failure(api_name, model_name, '流式响应无内容')
+        except AIGatewayError as e:
+            reported = True
+            ai_router.record_failure(api_name, model_name, str(e), e.status_code)
+            raise
+        except httpx.HTTPError as e:
+            reported = True
+            ai_router.record_failure(api_name, model_name, str(e) or type(e).__name__)
+            raise
+        finally:
+            if not reported and not finished and not has_content:
+                # 出首字前被放弃（客户端断开），不算服务商的错
+                ai_router.record_abandoned(api_name)
+
+    async def chat_stream(
+        self,
+        messages: List[Dict],
+        system_prompt: str,
+        model: str = None,
+        temperature: float = None,
+        max_tokens: int = None,
+        images: List[str] = None,
+        profile: str = PROFILE_INTERACTIVE_CHAT
+    ) -> AsyncGenerator[str, None]:
+        """流式对话（与 AIService.chat_stream 一致：失败时产出以 [ERROR] 开头的一段）"""
+        call = ai_profiles[profile]
+        payload = ai_service.build_stream_payload(messages, system_prompt, model, temperature, max_tokens, images, profile)
+        model_name = payload['model']
+        self._stats['streams'] += 1
+        self._stats['active'] += 1
+        self._stats['peak_active'] = max(self._stats['peak_active'], self._stats['active'])
+        record = ai_ledger.begin(call, model_name)
+        # 生成器没跑完就被关闭（客户端断开）时按 cancelled 记账
+        status = STATUS_CANCELLED
+        emitted = []
+        try:
+            failed = None
+            apis, forced = ai_service.route(model_name, timeout_extra=30, timeout=call.timeout)
+            for index, (api_name, api_key, base_url, timeout) in enumerate(apis):
+                if not forced and not ai_router.acquire(api_name):
+                    logger.info(f"[{api_name}] 熔断中，跳过")
+                    continue
+                if index > 0:
+                    self._stats['failovers'] += 1
+                logger.info(f"[{api_name}] 异步流式请求，模型: {model_name}，包含图片: {bool(images)}")
+                try:
+                    async for content in self._stream_request(api_name, api_key, base_url, payload, timeout, record):
+                        emitted.append(content)
+                        yield content
+                    if emitted:
+                        status = STATUS_OK
+                        return
+                    logger.warning(f"[{api_name}] 流式响应无内容")
+                except AIGatewayError as e:
+                    logger.warning(f"[{api_name}] 流式请求失败: {e.status_code}, {e.body[:200]}")
+                except httpx.HTTPError as e:
+                    logger.warning(f"[{api_name}] 流式网络错误: {e!r}")
+                    if emitted:
+                        failed = api_name
+                        break
+
+            if emitted:
+                try:
+                    async for content in self._resume_stream(payload, ''.join(emitted), failed, call.timeout,
+                                                             record):
+                        emitted.append(content)
+                        yield content
+                    status = STATUS_OK
+                    return
+                except StreamInterrupted as e:
+                    logger.warning(f"AI 回复中断且续写失败: {e}")
+                    self._stats['failed'] += 1
+                    status = STATUS_INTERRUPTED
+                    yield "[ERROR]AI 回复中断，请重试"
+                    return
+
+            self._stats['failed'] += 1
+            status = STATUS_ERROR
+            yield "[ERROR]所有 AI API 均不可用，请稍后重试"
+        except Exception:
+            status = STATUS_ERROR
+            raise
+        finally:
+            self._stats['active'] -= 1
+            record.finish(status, payload, ''.join(emitted))
+
+    async def _resume_stream(self, payload: dict, partial: str, failed: str, timeout: float = None,
+                             record: AICallRecord = None) -> AsyncGenerator[str, None]:
+        """续写中断的回复（与 AIService._resume_stream 对应），续写也失败时抛 StreamInterrupted"""
+        if not ai_service.stream_resume:
+            raise StreamInterrupted(failed, Exception('未开启续写'))
+
+        self._stats['resumed'] += 1
+        model_name = payload.get('model')
+        last_error: Exception = Exception('没有可用的服务商')
+        for _ in range(max(2, len(ai_service._apis()))):
+            apis, forced = ai_service.route(model_name, timeout_extra=30, timeout=timeout)
+            apis = [api for api in apis if api[0] != failed] + [api for api in apis if api[0] == failed]
+            api = next((api for api in apis if forced or ai_router.acquire(api[0])), None)
+            if api is None:
+                break
+            api_name, api_key, base_url, api_timeout = api
+
+            resume_payload = dict(payload, messages=payload['messages'] + [
+                {'role': 'assistant', 'content': partial},
+                {'role': 'user', 'content': RESUME_PROMPT}
+            ])
+            logger.info(f"[{api_name}] 续写中断的回复（{failed} 中断，已输出 {len(partial)} 字）")
+
+            trimmer = OverlapTrimmer(partial)
+            produced = []
+            try:
+                async for piece in self._stream_request(api_name, api_key, base_url, resume_payload, api_timeout,
+                                                        record):
+                    text = trimmer.feed(piece)
+                    if text:
+                        produced.append(text)
+                        yield text
+                text = trimmer.finish()
+                if text:
+                    produced.append(text)
+                    yield text
+                if produced:
+                    return
+                # 续写没有补充任何内容，回复仍是截断的，换下一个服务商
+                logger.warning(f"[{api_name}] 续写无内容")
+                last_error = Exception('续写无内容')
+                failed = api_name
+            except (AIGatewayError, httpx.HTTPError) as e:
+                logger.warning(f"[{api_name}] 续写失败: {e!r}")
+                last_error = e
+                partial += ''.join(produced)
+                failed = api_name
+
+        raise StreamInterrupted(failed, last_error)
+
+    def stats(self) -> Dict:
+        stats = dict(self._stats)
+        stats['providers'] = list(self._clients)
+        return stats
+
+
+# 单例实例
+async_ai_streamer = AsyncAIStreamer(Config.AI_ASYNC_MAX_CONNECTIONS, Config.AI_ASYNC_MAX_KEEPALIVE)
@@ -0,0 +1,199 @@
+"""
+AI 响应缓存 - 内部 AI 调用（记忆提取、上下文摘要、信息图分析）按请求内容寻址复用结果
+键为 (模型, temperature, max_tokens, messages) 的 SHA-256；只缓存调用方标记为可缓存的请求，
+面向用户的对话不走缓存。两层：进程内 LRU + 本地 SQLite 共享层（同一台机器的 gunicorn worker 共用）
+"""
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from config import Config
+from modules.storage_codec import storage_codec
+
+
+class AIResponseCache:
+    """
+    内容寻址的 AI 响应缓存
+
+    - key()：由请求体算出缓存键，请求内容逐字节相同才会命中
+    - get()：先查进程内 LRU，再查 SQLite 共享层（命中后回填 LRU）；过期条目视为未命中
+    - put()：只存非空的成功结果；共享层每写入 PRUNE_EVERY 次清理一次过期和超量的条目
+    - 共享层出错只计数、不影响调用（缓存失效就当没命中）
+    """
+
+    PRUNE_EVERY = 100
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        max_size: int = 500,
+        ttl: float = 86400,
+        shared: bool = True,
+        max_rows: int = 20000
+    ):
+        self.enabled = enabled
+        self.max_size = max_size
+        self.ttl = ttl
+        self.shared = shared
+        self.max_rows = max_rows
+        self._lru: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._puts_since_prune = 0
+        self._stats = {'memory_hits': 0, 'shared_hits': 0, 'misses': 0, 'puts': 0, 'shared_errors': 0}
+
+    @staticmethod
+    def create_tables(cursor):
+        """建表（由 Database._init_db 调用）"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS ai_response_cache (
+                key TEXT PRIMARY KEY,
+                model TEXT,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                expires_at REAL NOT NULL,
+                hits INTEGER DEFAULT 0
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_ai_response_cache_expires ON ai_response_cache(expires_at)')
+
+    @staticmethod
+    def key(model: str, messages: List[Dict], temperature: float = None, max_tokens: int = None) -> str:
+        """缓存键：请求内容的规范化 JSON 的 SHA-256"""
+        canonical = json.dumps(
+            {'model': model, 'temperature': temperature, 'max_tokens': max_tokens, 'messages': messages},
+            ensure_ascii=False, sort_keys=True, separators=(',', ':')
+        )
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def _count(self, field: str):
+        with self._lock:
+            self._stats[field] += 1
+
+    def _remember(self, key: str, response: str, expires_at: float):
+        with self._lock:
+            self._lru[key] = (expires_at, response)
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.max_size:
+                self._lru.popitem(last=False)
+
+    # ========================================
+    # 读写
+    # ========================================
+
+    def get(self, key: str) -> Optional[str]:
+        """命中返回缓存的响应文本，否则返回 None"""
+        if not self.enabled:
+            return None
+
+        now = time.time()
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._lru.move_to_end(key)
+                    self._stats['memory_hits'] += 1
+                    return entry[1]
+                del self._lru[key]
+
+        if self.shared:
+            try:
+                from database import db
+                with db.connection() as conn:
+                    row = conn.execute(
+                        'SELECT response, expires_at FROM ai_response_cache WHERE key = ? AND expires_at > ?',
+                        (key, now)
+                    ).fetchone()
+                    if row:
+                        conn.execute('UPDATE ai_response_cache SET hits = hits + 1 WHERE key = ?', (key,))
+                if row:
+                    response = storage_codec.decode(row['response'])
+                    self._remember(key, response, row['expires_at'])
+                    self._count('shared_hits')
+                    return response
+            except Exception as e:
+                self._count('shared_errors')
+                print(f"⚠️ AI 响应缓存读取失败: {e}")
+
+        self._count('misses')
+        return None
+
+    def put(self, key: str, response: str, model: str = None):
+        """写入缓存（空结果不缓存）"""
+        if not self.enabled or not response:
+            return
+
+        now = time.time()
+        expires_at = now + self.ttl
+        self._remember(key, response, expires_at)
+        self._count('puts')
+
+        if not self.shared:
+            return
+        try:
+            from database import db
+            with db.connection() as conn:
+                conn.execute('''
+                    INSERT OR REPLACE INTO ai_response_cache (key, model, response, created_at, expires_at)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (key, model, storage_codec.encode(response), now, expires_at))
+            with self._lock:
+                self._puts_since_prune += 1
+                prune = self._puts_since_prune >= self.PRUNE_EVERY
+                if prune:
+                    self._puts_since_prune = 0
+            if prune:
+                self.prune()
+        except Exception as e:
+            self._count('shared_errors')
+            print(f"⚠️ AI 响应缓存写入失败: {e}")
+
+    def prune(self) -> int:
+        """清理共享层的过期条目，超过 max_rows 时删掉最早过期的，返回删除条数"""
+        from database import db
+        with db.connection() as conn:
+            deleted = conn.execute('DELETE FROM ai_response_cache WHERE expires_at <= ?', (time.time(),)).rowcount
+            total = conn.execute('SELECT COUNT(*) FROM ai_response_cache').fetchone()[0]
+            if total > self.max_rows:
+                deleted += conn.execute('''
+                    DELETE FROM ai_response_cache WHERE key IN (
+                        SELECT key FROM ai_response_cache ORDER BY expires_at LIMIT ?
+                    )
+                ''', (total - self.max_rows,)).rowcount
+        return deleted
+
+    def clear(self):
+        """清空两层缓存"""
+        with self._lock:
+            self._lru.clear()
+        if self.shared:
+            from database import db
+            with db.connection() as conn:
+                conn.execute('DELETE FROM ai_response_cache')
+
+    # ========================================
+    # 统计
+    # ========================================
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['memory_entries'] = len(self._lru)
+        lookups = stats['memory_hits'] + stats['shared_hits'] + stats['misses']
+        stats['hit_rate'] = round((stats['memory_hits'] + stats['shared_hits']) / lookups, 4) if lookups else 0.0
+        stats['enabled'] = self.enabled
+        stats['shared'] = self.shared
+        stats['ttl'] = self.ttl
+        return stats
+
+
+# 单例实例
+ai_cache = AIResponseCache(
+    enabled=Config.AI_CACHE_ENABLED,
+    max_size=Config.AI_CACHE_SIZE,
+    ttl=Config.AI_CACHE_TTL,
+    shared=Config.AI_CACHE_SHARED,
+    max_rows=Config.AI_CACHE_MAX_ROWS
+)
@@ -0,0 +1,254 @@
+"""
+AI 服务商网关 - 按 base URL 复用 keep-alive 连接池
+所有对 CloseAI / 云雾等 OpenAI 兼容接口的 HTTP 请求都经过这里，免去每次请求的 TCP + TLS 握手
+"""
+import logging
+import socket
+import threading
+import time
+from typing import Dict
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import DecodeError, ProtocolError, ReadTimeoutError, SSLError
+
+from config import Config
+from modules.ai_scheduler import ai_scheduler
+
+logger = logging.getLogger(__name__)
+
+
+class AIGatewayError(Exception):
+    """AI 接口返回非 200"""
+
+    def __init__(self, status_code: int, body: str):
+        super().__init__(f"AI 接口错误: {status_code} - {body[:200]}")
+        self.status_code = status_code
+        self.body = body
+
+
+class AIGateway:
+    """
+    AI 请求网关
+
+    - 每个 base URL 一个 requests.Session，连接池大小与 gunicorn 每个 worker 的并发连接数匹配
+    - warm_up() 在启动时预先建立连接（后台线程，不阻塞启动）
+    - stats() 给出每个服务商的请求数、新建连接数、连接复用率、空闲 / 占用连接数
+    """
+
+    def __init__(self, pool_maxsize: int = 100, warm_connections: int = 2):
+        self.pool_maxsize = pool_maxsize
+        self.warm_connections = warm_connections
+        self._sessions: Dict[str, requests.Session] = {}
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict] = {}
+
+    @staticmethod
+    def _key(base_url: str) -> str:
+        return base_url.rstrip('/')
+
+    def session(self, base_url: str) -> requests.Session:
+        """取得某个 base URL 的共享会话（首次使用时创建）"""
+        key = self._key(base_url)
+        session = self._sessions.get(key)
+        if session is not None:
+            return session
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                # 失败切换由调用方处理，这里不做自动重试
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize, max_retries=0)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._sessions[key] = session
+                self._stats[key] = {'requests': 0, 'errors': 0, 'in_flight': 0, 'peak_in_flight': 0,
+                                    'total_seconds': 0.0}
+        return session
+
+    def _track(self, key: str, field: str, delta=1):
+        with self._lock:
+            stats = self._stats[key]
+            stats[field] += delta
+            if field == 'in_flight' and stats['in_flight'] > stats['peak_in_flight']:
+                stats['peak_in_flight'] = stats['in_flight']
+
+    # ========================================
+    # 请求
+    # ========================================
+
+    def post(
+        self,
+        base_url: str,
+        api_key: str,
+        payload: dict,
+        timeout: float,
+        path: str = '/chat/completions',
+        stream: bool = False
+    ) -> requests.Response:
+        """
+        发起 POST 请求（异常与 requests.post 一致）
+
+        stream=True 时调用方读完或关闭响应后连接才归还连接池；
+        发出前按当前优先级向 ai_scheduler 取服务商配额（可能抛 AISchedulerTimeout），响应状态回报给它
+        """
+        key = self._key(base_url)
+        session = self.session(base_url)
+        headers = {
+            'Authorization': f'Bearer {api_key}',
+            'Content-Type': 'application/json'
+        }
+        ai_scheduler.acquire(key)
+        started = time.monotonic()
+        self._track(key, 'in_flight')
+        try:
+            response = session.post(f'{key}{path}', headers=headers, json=payload, timeout=timeout, stream=stream)
+            ai_scheduler.record_response(key, response.status_code, response.headers.get('Retry-After'))
+            return response
+        except Exception:
+            self._track(key, 'errors')
+            raise
+        finally:
+            self._track(key, 'in_flight', -1)
+            self._track(key, 'requests')
+            self._track(key, 'total_seconds', time.monotonic() - started)
+
+    @staticmethod
+    def iter_raw(response: requests.Response, chunk_size: int = 65536):
+        """
+        逐批读取流式响应体：每次返回当前已到达的全部数据（最多 chunk_size 字节），不按行切分
+
+        urllib3 2.x 用 read1()，服务端一次推来的多帧一批处理；旧版 urllib3 退回 iter_lines()
+        """
+        raw = response.raw
+        if hasattr(raw, 'read1'):
+            while True:
+                # 与 requests 的 iter_content 一样把 urllib3 异常转成 requests 异常，调用方按原样捕获
+                try:
+                    data = raw.read1(chunk_size, decode_content=True)
+                except ProtocolError as e:
+                    raise requests.exceptions.ChunkedEncodingError(e)
+                except DecodeError as e:
+                    raise requests.exceptions.ContentDecodingError(e)
+                except ReadTimeoutError as e:
+                    raise requests.exceptions.ConnectionError(e)
+                except SSLError as e:
+                    raise requests.exceptions.SSLError(e)
+                if not data:
+                    return
+                yield data
+        else:
+            for line in response.iter_lines():
+                yield line + b'\n'
+
+    @staticmethod
+    def release(response: requests.Response, drain: bool = True):
+        """
+        流式响应用完后调用，把连接还给连接池
+
+        drain=True：已读到 [DONE]，读掉剩余字节（通常只剩结束块）后连接可复用；
+        drain=False：中途放弃（如客户端断开），直接断开连接，不等上游生成完
+        """
+        if drain:
+            try:
+                # 读完后连接已回到连接池，不能再 close()（会把池里的连接一起断开）
+                response.raw.drain_conn()
+                return
+            except Exception:
+                pass
+        response.close()
+
+    @staticmethod
+    def abort(response: requests.Response):
+        """
+        立即断开流式响应的连接（可从其他线程调用）
+
+        先 shutdown 底层 socket，让正在阻塞读取的线程马上返回，再关闭响应；连接不会回到连接池
+        """
+        try:
+            sock = response.raw._connection.sock
+            if sock is not None:
+                sock.shutdown(socket.SHUT_RDWR)
+        except Exception:
+            pass
+        try:
+            response.close()
+        except Exception:
+            pass
+
+    def chat_completion(self, base_url: str, api_key: str, payload: dict, timeout: float = 120) -> Dict:
+        """非流式 chat/completions，返回解析后的 JSON（非 200 抛 AIGatewayError）"""
+        response = self.post(base_url, api_key, payload, timeout)
+        if response.status_code != 200:
+            raise AIGatewayError(response.status_code, response.text)
+        return response.json()
+
+    # ========================================
+    # 预热
+    # ========================================
+
+    def warm_up(self, base_urls, background: bool = True):
+        """预先建立到各服务商的连接（GET /models，结果不关心，只为完成握手并留在连接池）"""
+        base_urls = [url for url in dict.fromkeys(base_urls) if url]
+        if not base_urls or self.warm_connections <= 0:
+            return
+
+        def open_connection(base_url: str):
+            try:
+                self.session(base_url).get(f'{self._key(base_url)}/models', timeout=5).close()
+            except Exception as e:
+                logger.info(f"[AI 网关] 预热连接失败 {base_url}: {e}")
+
+        def run():
+            # 同时发出多个请求才会建立多条连接（串行请求会复用同一条）
+            workers = [
+                threading.Thread(target=open_connection, args=(base_url,), daemon=True)
+                for base_url in base_urls
+                for _ in range(self.warm_connections)
+            ]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            logger.info(f"[AI 网关] 连接预热完成: {', '.join(base_urls)}")
+
+        if background:
+            threading.Thread(target=run, daemon=True).start()
+        else:
+            run()
+
+    # ========================================
+    # 统计
+    # ========================================
+
+    def stats(self) -> Dict:
+        result = {}
+        with self._lock:
+            items = [(key, dict(self._stats[key]), self._sessions[key]) for key in self._sessions]
+        for key, stats, session in items:
+            created = 0
+            pooled_requests = 0
+            idle = 0
+            adapter = session.get_adapter(key)
+            pools = adapter.poolmanager.pools
+            for pool_key in list(pools.keys()):
+                pool = pools.get(pool_key)
+                if pool is None:
+                    continue
+                created += pool.num_connections
+                pooled_requests += pool.num_requests
+                idle += sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool else 0
+            stats['connections_created'] = created
+            stats['idle_connections'] = idle
+            stats['pool_maxsize'] = self.pool_maxsize
+            # 复用率：没有新建连接就完成的请求占比
+            stats['reuse_rate'] = round(1 - created / pooled_requests, 4) if pooled_requests else 0.0
+            # 流式请求只计到收到响应头为止
+            total_seconds = stats.pop('total_seconds')
+            stats['avg_response_seconds'] = round(total_seconds / stats['requests'], 3) if stats['requests'] else 0.0
+            result[key] = stats
+        return result
+
+
+# 单例实例
+ai_gateway = AIGateway(Config.AI_POOL_MAXSIZE, Config.AI_POOL_WARM_CONNECTIONS)
@@ -0,0 +1,189 @@
+"""
+AI 对冲请求 - 主用服务商迟迟没有首字时，同一请求再发给备用服务商，先出首字的胜出
+对冲延迟取主用服务商历史首字耗时（TTFT）的分位数，落败的请求立即断开连接
+"""
+import contextvars
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, Generator, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 样本少于这个数时分位数不可信，使用默认延迟
+MIN_SAMPLES = 20
+
+
+class StreamInterrupted(Exception):
+    """流式输出已产出内容后中途出错"""
+
+    def __init__(self, provider: str, error: Exception):
+        super().__init__(f"{provider} 输出中途出错: {error}")
+        self.provider = provider
+        self.error = error
+
+
+class CancelToken:
+    """取消标记：set() 时执行已登记的回调（用于断开落败请求的连接，打断阻塞中的读取）"""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._callbacks: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    def is_set(self) -> bool:
+        return self._event.is_set()
+
+    def on_cancel(self, callback: Callable[[], None]):
+        """登记取消回调；已取消时立即执行"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def set(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.debug(f"取消回调执行失败: {e}")
+
+
+class TTFTTracker:
+    """按 (服务商, 模型) 记录最近的首字耗时（秒）"""
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self._samples: Dict[Tuple[str, str], deque] = {}
+        self._lock = threading.Lock()
+
+    def record(self, provider: str, model: str, seconds: float):
+        key = (provider, model)
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def percentile(self, provider: str, model: str, pct: float) -> Optional[float]:
+        """最近样本的分位数，样本不足返回 None"""
+        with self._lock:
+            samples = sorted(self._samples.get((provider, model), ()))
+        if len(samples) < MIN_SAMPLES:
+            return None
+        index = min(len(samples) - 1, max(0, int(round(pct / 100 * len(samples))) - 1))
+        return samples[index]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            items = [(key, sorted(samples)) for key, samples in self._samples.items()]
+        result = {}
+        for (provider, model), samples in items:
+            if not samples:
+                continue
+            result[f'{provider}/{model}'] = {
+                'samples': len(samples),
+                'p50': round(samples[len(samples) // 2], 3),
+                'p95': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 3),
+                'max': round(samples[-1], 3)
+            }
+        return result
+
+
+def hedged_stream(
+    attempts: List[Tuple[str, Callable[[CancelToken], Iterable[str]]]],
+    hedge_delay: float
+) -> Generator[str, None, None]:
+    """
+    对冲执行多个流式请求，输出胜出者的内容
+
+    Args:
+        attempts: [(名称, fn)]，按优先级排列；fn(cancel) 返回内容片段的迭代器，
+                  拿到连接后应通过 cancel.on_cancel() 登记断开连接的回调
+        hedge_delay: 前一个请求超过这么多秒还没有首字，就启动下一个
+
+    规则：
+        - 最先产出首个片段的请求胜出，其余请求立即取消
+        - 某个请求在出首字前失败，不等延迟直接启动下一个
+        - 胜出者中途出错时抛出 StreamInterrupted（已输出的内容无法撤回，由调用方决定是否续写）
+        - 调用方提前关闭生成器时取消所有请求
+    """
+    events = queue.Queue()
+    cancels: List[CancelToken] = []
+
+    def run(index: int, fn: Callable[[CancelToken], Iterable[str]], cancel: CancelToken):
+        try:
+            for piece in fn(cancel):
+                if cancel.is_set():
+                    break
+                events.put(('data', index, piece))
+            events.put(('done', index, None))
+        except Exception as e:
+            if not cancel.is_set():
+                events.put(('error', index, e))
+
+    def start_next():
+        index = len(cancels)
+        cancel = CancelToken()
+        cancels.append(cancel)
+        if index > 0:
+            logger.info(f"[对冲] {attempts[index - 1][0]} {hedge_delay:.1f}s 内无首字或已失败，同时请求 {attempts[index][0]}")
+        # 在调用方的上下文里执行（沿用 ai_scheduler 的优先级）
+        context = contextvars.copy_context()
+        threading.Thread(target=context.run, args=(run, index, attempts[index][1], cancel), daemon=True).start()
+        return time.monotonic() + hedge_delay
+
+    winner = None
+    finished = set()
+    try:
+        if not attempts:
+            return
+        hedge_at = start_next()
+        while True:
+            timeout = None
+            if winner is None and len(cancels) < len(attempts):
+                timeout = max(0.0, hedge_at - time.monotonic())
+            try:
+                kind, index, value = events.get(timeout=timeout)
+            except queue.Empty:
+                hedge_at = start_next()
+                continue
+
+            if winner is None:
+                if kind == 'data':
+                    winner = index
+                    for other, cancel in enumerate(cancels):
+                        if other != index:
+                            cancel.set()
+                    if len(cancels) > 1:
+                        logger.info(f"[对冲] {attempts[index][0]} 先出首字，取消其余请求")
+                    yield value
+                    continue
+                if kind == 'error':
+                    logger.warning(f"[对冲] {attempts[index][0]} 请求失败: {value}")
+                finished.add(index)
+                if len(cancels) < len(attempts):
+                    hedge_at = start_next()
+                elif len(finished) == len(cancels):
+                    return
+                continue
+
+            if index != winner:
+                continue
+            if kind == 'data':
+                yield value
+            elif kind == 'done':
+                return
+            else:
+                raise StreamInterrupted(attempts[index][0], value)
+    finally:
+        for cancel in cancels:
+            cancel.set()
@@ -0,0 +1,358 @@
+"""
+AI 调用台账 - 每次 AI 调用一条记录（服务商、模型、配置档、token 用量、首字耗时、总耗时、状态、切换次数）
+记录先放进内存队列，由后台线程批量写入本地 SQLite，不占用请求路径；管理后台按时间窗口汇总分位数
+"""
+import atexit
+import threading
+import time
+from typing import Dict, List, Sequence
+from urllib.parse import urlparse
+
+from config import Config
+from modules.ai_profiles import AIProfile, profile_usage, usage_tokens
+from modules.ai_scheduler import ai_scheduler
+
+# 调用结果
+STATUS_OK = 'ok'                    # 正常完成
+STATUS_ERROR = 'error'              # 所有服务商都失败
+STATUS_INTERRUPTED = 'interrupted'  # 流式输出中途断开且续写失败
+STATUS_CANCELLED = 'cancelled'      # 客户端中途断开
+STATUS_REJECTED = 'rejected'        # 排队等并发槽 / 服务商配额超时，请求没有发出
+
+# 汇总时可用的分组字段
+GROUP_FIELDS = ('provider', 'model', 'profile', 'priority', 'status')
+
+
+class AICallRecord:
+    """
+    一次 AI 调用的计时（由 AICallLedger.begin() 创建）
+
+    - attempt()：每向一个服务商发出一次请求调用一次（切换、对冲、续写都算），hops = 次数 - 1
+    - first_token()：本次调用第一次收到内容时记录首字耗时（从该次请求发出算起，不传时按最近一次 attempt() 算）
+      和实际服务的服务商
+    - finish()：调用结束时写入台账，只生效一次；成功时同时计入配置档用量（profile_usage）
+    - 总耗时从 begin() 算起，包含排队、切换服务商和续写
+    """
+
+    __slots__ = ('ledger', 'profile', 'model', 'priority', 'provider', 'attempts', 'ttft', 'started',
+                 'attempt_started', 'finished', '_lock')
+
+    def __init__(self, ledger: 'AICallLedger', profile: AIProfile, model: str, priority: str):
+        self.ledger = ledger
+        self.profile = profile
+        self.model = model
+        self.priority = priority
+        self.provider = None
+        self.attempts = 0
+        self.ttft = None
+        self.started = time.monotonic()
+        self.attempt_started = self.started
+        self.finished = False
+        self._lock = threading.Lock()
+
+    def attempt(self, provider: str):
+        with self._lock:
+            self.attempts += 1
+            if self.ttft is None:
+                self.provider = provider
+                self.attempt_started = time.monotonic()
+
+    def first_token(self, provider: str, seconds: float = None):
+        with self._lock:
+            if self.ttft is None:
+                self.ttft = seconds if seconds is not None else time.monotonic() - self.attempt_started
+                self.provider = provider
+
+    def finish(self, status: str, payload: dict = None, content: str = '', usage: dict = None,
+               finish_reason: str = None):
+        with self._lock:
+            if self.finished:
+                return
+            self.finished = True
+        latency = time.monotonic() - self.started
+        if status == STATUS_OK and payload is not None:
+            profile_usage.record_response(self.profile, payload, content, usage, finish_reason)
+        if payload is not None:
+            prompt_tokens, completion_tokens, estimated = usage_tokens(payload, content, usage)
+        else:
+            prompt_tokens, completion_tokens, estimated = 0, 0, False
+        self.ledger.append((
+            time.time(), self.provider, self.model, self.profile.name, self.priority, status,
+            prompt_tokens, completion_tokens, int(estimated),
+            round(self.ttft * 1000) if self.ttft is not None else None,
+            round(latency * 1000), max(0, self.attempts - 1)
+        ))
+
+
+class AICallLedger:
+    """
+    只追加的 AI 调用台账（本地 SQLite，同一台机器的 worker 共用）
+
+    - append() 只把记录放进内存队列；积压超过 max_pending 时丢弃新记录并计数，不阻塞调用方
+    - 后台线程每 interval 秒（或攒满 batch_size 条）用一次 executemany 写入；每小时清理超过保留天数的记录
+    - rollup() 按时间窗口和分组字段汇总调用数、错误率、切换率、token 用量和首字 / 总耗时分位数
+    """
+
+    PRUNE_INTERVAL = 3600
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        batch_size: int = 200,
+        interval: float = 2.0,
+        max_pending: int = 10000,
+        retention_days: float = 30
+    ):
+        self.enabled = enabled
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_pending = max_pending
+        self.retention_days = retention_days
+        self._pending: List[tuple] = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._is_started = False
+        self._stop_flag = False
+        self._thread = None
+        self._last_prune = 0.0
+        self._stats = {'recorded': 0, 'written': 0, 'dropped': 0, 'batches': 0, 'failed_batches': 0,
+                       'last_flush_at': None, 'last_error': None}
+
+    @staticmethod
+    def create_tables(cursor):
+        """建表（由 Database._init_db 调用）"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS ai_call_ledger (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_at REAL NOT NULL,
+                provider TEXT,
+                model TEXT,
+                profile TEXT,
+                priority TEXT,
+                status TEXT NOT NULL,
+                prompt_tokens INTEGER DEFAULT 0,
+                completion_tokens INTEGER DEFAULT 0,
+                estimated INTEGER DEFAULT 0,
+                ttft_ms INTEGER,
+                latency_ms INTEGER,
+                hops INTEGER DEFAULT 0
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_ai_call_ledger_created ON ai_call_ledger(created_at)')
+
+    @staticmethod
+    def provider_name(base_url: str) -> str:
+        """直接调用网关的地方（信息图、管理后台分析）用的服务商名称，与 AIService 的命名一致"""
+        key = (base_url or '').rstrip('/')
+        if key == (Config.CLOSEAI_BASE_URL or '').rstrip('/'):
+            return 'CloseAI'
+        if key == (Config.YUNWU_BASE_URL or '').rstrip('/'):
+            return '云雾'
+        return urlparse(key).netloc or key
+
+    # ========================================
+    # 记录
+    # ========================================
+
+    def begin(self, profile: AIProfile, model: str, priority: str = None) -> AICallRecord:
+        """开始一次调用（priority 不传时取当前调度槽的优先级）"""
+        return AICallRecord(self, profile, model, priority or ai_scheduler.current_priority())
+
+    def append(self, row: tuple):
+        if not self.enabled:
+            return
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                self._stats['dropped'] += 1
+                return
+            self._pending.append(row)
+            self._stats['recorded'] += 1
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self._wakeup.set()
+        self.start()
+
+    def flush(self) -> int:
+        """把队列里的记录写入 SQLite，返回写入条数（写入失败的一批丢弃并计数）"""
+        with self._lock:
+            rows, self._pending = self._pending, []
+        if not rows:
+            return 0
+        try:
+            from database import db
+            with db.connection() as conn:
+                conn.executemany('''
+                    INSERT INTO ai_call_ledger (created_at, provider, model, profile, priority, status,
+                        prompt_tokens, completion_tokens, estimated, ttft_ms, latency_ms, hops)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', rows)
+        except Exception as e:
+            with self._lock:
+                self._stats['failed_batches'] += 1
+                self._stats['last_error'] = str(e)
+            print(f"⚠️ AI 调用台账写入失败（丢弃 {len(rows)} 条）: {e}")
+            return 0
+        with self._lock:
+            self._stats['written'] += len(rows)
+            self._stats['batches'] += 1
+            self._stats['last_flush_at'] = time.time()
+        return len(rows)
+
+    def prune(self) -> int:
+        """删除超过保留天数的记录，返回删除条数"""
+        from database import db
+        with db.connection() as conn:
+            return conn.execute(
+                'DELETE FROM ai_call_ledger WHERE created_at < ?', (time.time() - self.retention_days * 86400,)
+            ).rowcount
+
+    def _run(self):
+        while not self._stop_flag:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+            if self.retention_days and time.monotonic() - self._last_prune > self.PRUNE_INTERVAL:
+                self._last_prune = time.monotonic()
+                try:
+                    self.prune()
+                except Exception as e:
+                    print(f"⚠️ AI 调用台账清理失败: {e}")
+
+    def start(self):
+        """启动写入线程（首次记录时自动启动，重复调用无副作用）；进程退出前写完剩余记录"""
+        if self._is_started:
+            return
+        with self._lock:
+            if self._is_started:
+                return
+            self._is_started = True
+        self._stop_flag = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def stop(self):
+        self._stop_flag = True
+        self._is_started = False
+        self._wakeup.set()
+
+    # ========================================
+    # 汇总
+    # ========================================
+
+    # 分位数（按 int(n * p) 取排序后的第几条，与旧版本保持一致）
+    PERCENTILES = (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))
+
+    def max_hours(self) -> float:
+        """汇总时间窗口上限：不超过保留天数（未设置保留天数时 90 天）"""
+        return (self.retention_days or 90) * 24
+
+    def _percentile_rows(self, conn, metric: str, group_by: List[str], where: str, params: list) -> Dict[tuple, Dict]:
+        """
+        一次查询取出各组 metric 的分位数：窗口函数在 SQLite 内排序编号，每组只返回分位数所在的几行
+
+        返回 {分组键: {'p50': .., 'p95': .., 'p99': ..}}
+        """
+        partition = f"PARTITION BY {', '.join(group_by)}" if group_by else ''
+        ranks = ', '.join(
+            f'MIN(n - 1, CAST(n * {fraction} AS INTEGER)) + 1' for _, fraction in self.PERCENTILES
+        )
+        columns = ''.join(f'{field}, ' for field in group_by)
+        sql = f'''
+            SELECT {columns}value, rn, n FROM (
+                SELECT {columns}{metric} AS value,
+                       ROW_NUMBER() OVER ({partition} ORDER BY {metric}) AS rn,
+                       COUNT(*) OVER ({partition}) AS n
+                FROM ai_call_ledger WHERE {where} AND {metric} IS NOT NULL
+            ) WHERE rn IN ({ranks})
+        '''
+        result: Dict[tuple, Dict] = {}
+        for row in conn.execute(sql, params):
+            key = tuple(row[field] for field in group_by)
+            entry = result.setdefault(key, {})
+            n = row['n']
+            for name, fraction in self.PERCENTILES:
+                if min(n - 1, int(n * fraction)) + 1 == row['rn']:
+                    entry[name] = row['value']
+        return result
+
+    def rollup(self, hours: float = 24, group_by: Sequence[str] = ('provider', 'model', 'profile'),
+               profile: str = None) -> List[Dict]:
+        """
+        最近 hours 小时的汇总（耗时单位毫秒），按调用数从多到少排列
+
+        计数、求和在 SQL 里 GROUP BY 完成，分位数用窗口函数在 SQLite 内计算，不把明细行取进 Python；
+        hours 不超过保留天数。首字耗时只统计有输出的调用；本 worker 队列里还没写入的记录先写入再汇总
+        """
+        group_by = [field for field in group_by if field in GROUP_FIELDS]
+        hours = min(hours, self.max_hours())
+        self.flush()
+        where = 'created_at >= ?'
+        params = [time.time() - hours * 3600]
+        if profile:
+            where += ' AND profile = ?'
+            params.append(profile)
+
+        columns = ''.join(f'{field}, ' for field in group_by)
+        group_clause = f"GROUP BY {', '.join(group_by)}" if group_by else ''
+        sql = f'''
+            SELECT {columns}
+                   COUNT(*) AS calls,
+                   SUM(status != ?) AS errors,
+                   SUM(hops > 0) AS failovers,
+                   SUM(hops) AS hops,
+                   SUM(estimated) AS estimated,
+                   SUM(prompt_tokens) AS prompt_tokens,
+                   SUM(completion_tokens) AS completion_tokens,
+                   MAX(ttft_ms) AS ttft_max,
+                   MAX(latency_ms) AS latency_max
+            FROM ai_call_ledger WHERE {where} {group_clause}
+        '''
+
+        from database import db
+        with db.connection() as conn:
+            groups = [dict(row) for row in conn.execute(sql, [STATUS_OK, *params])]
+            ttft = self._percentile_rows(conn, 'ttft_ms', group_by, where, params)
+            latency = self._percentile_rows(conn, 'latency_ms', group_by, where, params)
+
+        empty = {name: None for name, _ in self.PERCENTILES}
+        result = []
+        for group in groups:
+            calls = group['calls']
+            if not calls:
+                continue
+            key = tuple(group[field] for field in group_by)
+            entry = {field: group[field] for field in group_by}
+            entry.update({
+                'calls': calls,
+                'errors': group['errors'] or 0,
+                'error_rate': round((group['errors'] or 0) / calls, 4),
+                'failover_rate': round((group['failovers'] or 0) / calls, 4),
+                'avg_hops': round((group['hops'] or 0) / calls, 3),
+                'prompt_tokens': group['prompt_tokens'] or 0,
+                'completion_tokens': group['completion_tokens'] or 0,
+                'estimated_calls': group['estimated'] or 0,
+                'ttft_ms': dict(empty, **ttft.get(key, {}), max=group['ttft_max']),
+                'latency_ms': dict(empty, **latency.get(key, {}), max=group['latency_max'])
+            })
+            result.append(entry)
+        result.sort(key=lambda entry: entry['calls'], reverse=True)
+        return result
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending'] = len(self._pending)
+        stats['enabled'] = self.enabled
+        stats['running'] = self._is_started
+        stats['retention_days'] = self.retention_days
+        return stats
+
+
+# 单例实例
+ai_ledger = AICallLedger(
+    enabled=Config.AI_LEDGER_ENABLED,
+    batch_size=Config.AI_LEDGER_BATCH_SIZE,
+    interval=Config.AI_LEDGER_FLUSH_INTERVAL,
+    retention_days=Config.AI_LEDGER_RETENTION_DAYS
+)
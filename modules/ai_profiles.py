@@ -0,0 +1,166 @@
+"""
+AI 调用配置档 - 每类调用各自的生成上限、温度、超时、模型和停止序列
+JSON 提取只需要几百 token，不再和对话一样申请 16000；实际用量按配置档统计，便于调整上限
+"""
+import json
+import threading
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+from config import Config
+from modules.token_budget import estimate_tokens
+
+PROFILE_INTERACTIVE_CHAT = 'interactive_chat'
+PROFILE_EXTRACTION = 'extraction'
+PROFILE_SUMMARY = 'summary'
+PROFILE_INFOGRAPHIC = 'infographic'
+PROFILE_ADMIN_REPORT = 'admin_report'
+
+
+class AIProfile:
+    """
+    一类 AI 调用的参数
+
+    - model：AVAILABLE_MODELS 里的简称（flash / pro）或完整模型名；None 表示用 DEFAULT_MODEL
+    - timeout：每个服务商的超时秒数；None 表示用服务商默认值（见 AIService._apis）
+    - stop：停止序列，None 表示不传
+    """
+
+    __slots__ = ('name', 'model', 'max_tokens', 'temperature', 'timeout', 'stop')
+
+    def __init__(self, name: str, model: Optional[str], max_tokens: int, temperature: float,
+                 timeout: Optional[float] = None, stop: Optional[List[str]] = None):
+        self.name = name
+        self.model = model
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.timeout = timeout
+        self.stop = stop
+
+    def model_name(self, model: str = None) -> str:
+        """实际模型名：调用方指定的优先，其次是配置档的，都没有时用 DEFAULT_MODEL；简称按 AVAILABLE_MODELS 展开"""
+        model = model or self.model or Config.DEFAULT_MODEL
+        return Config.AVAILABLE_MODELS.get(model, model)
+
+    def apply(self, payload: dict) -> dict:
+        """把生成参数写入请求体（调用方已在 payload 里给出的不覆盖）"""
+        payload.setdefault('max_tokens', self.max_tokens)
+        payload.setdefault('temperature', self.temperature)
+        if self.stop:
+            payload.setdefault('stop', self.stop)
+        return payload
+
+    def to_dict(self) -> Dict:
+        return {
+            'model': self.model,
+            'max_tokens': self.max_tokens,
+            'temperature': self.temperature,
+            'timeout': self.timeout,
+            'stop': self.stop
+        }
+
+
+DEFAULT_PROFILES = {
+    # 用户对话：回复常带表格和完整方案，上限保持 16000（与 AI_OUTPUT_RESERVE_TOKENS 一致）；超时沿用服务商默认值（流式另加 30 秒）
+    # 模型跟随 DEFAULT_MODEL
+    PROFILE_INTERACTIVE_CHAT: AIProfile(PROFILE_INTERACTIVE_CHAT, None, 16000, 0.7),
+    # 记忆提取：只返回一个 JSON 对象
+    PROFILE_EXTRACTION: AIProfile(PROFILE_EXTRACTION, 'flash', 600, 0.2, timeout=30),
+    # 上下文摘要：要求 500 字以内
+    PROFILE_SUMMARY: AIProfile(PROFILE_SUMMARY, None, 1000, 0.3, timeout=45),
+    # 信息图：结构化 JSON
+    PROFILE_INFOGRAPHIC: AIProfile(PROFILE_INFOGRAPHIC, 'gemini-2.0-flash', 2000, 0.3, timeout=60),
+    # 管理后台分析报告（用户画像 / 洞察 / 工具需求）
+    PROFILE_ADMIN_REPORT: AIProfile(PROFILE_ADMIN_REPORT, 'gpt-4o', 3000, 0.7, timeout=120),
+}
+
+
+def load_profiles(overrides: str = '') -> Dict[str, AIProfile]:
+    """默认配置档 + AI_PROFILE_OVERRIDES（JSON，如 {"extraction": {"max_tokens": 400}}）"""
+    profiles = {name: AIProfile(name, **profile.to_dict()) for name, profile in DEFAULT_PROFILES.items()}
+    if not overrides:
+        return profiles
+    try:
+        for name, fields in json.loads(overrides).items():
+            if name not in profiles:
+                print(f"⚠️ 未知的 AI 配置档: {name}")
+                continue
+            base = profiles[name].to_dict()
+            base.update({key: value for key, value in fields.items() if key in base})
+            profiles[name] = AIProfile(name, **base)
+    except (ValueError, TypeError, AttributeError) as e:
+        print(f"⚠️ AI_PROFILE_OVERRIDES 解析失败，使用默认配置档: {e}")
+    return profiles
+
+
+def usage_tokens(payload: dict, content: str, usage: dict = None) -> Tuple[int, int, bool]:
+    """(prompt_tokens, completion_tokens, 是否为估算值)：有服务商返回的 usage 用实际值，否则（流式）按文本估算"""
+    if usage:
+        return usage.get('prompt_tokens', 0) or 0, usage.get('completion_tokens', 0) or 0, False
+    prompt_tokens = sum(
+        estimate_tokens(msg['content']) if isinstance(msg.get('content'), str) else 0
+        for msg in payload.get('messages', [])
+    )
+    return prompt_tokens, estimate_tokens(content), True
+
+
+class ProfileUsage:
+    """
+    按配置档统计实际 token 用量（单个 worker 内）
+
+    服务商返回 usage 时用实际值，流式回复没有 usage，按输出文本估算（estimated 计数）；
+    hit_limit 为生成达到 max_tokens 被截断的次数，偏多说明上限太紧
+    """
+
+    def __init__(self, window: int = 500):
+        self.window = window
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict] = {}
+
+    def record(self, profile: str, prompt_tokens: int, completion_tokens: int,
+               max_tokens: int = None, estimated: bool = False, finish_reason: str = None):
+        with self._lock:
+            stats = self._stats.get(profile)
+            if stats is None:
+                stats = self._stats[profile] = {
+                    'calls': 0, 'estimated': 0, 'hit_limit': 0,
+                    'prompt_tokens': 0, 'completion_tokens': 0,
+                    'recent': deque(maxlen=self.window)
+                }
+            stats['calls'] += 1
+            stats['estimated'] += 1 if estimated else 0
+            stats['prompt_tokens'] += prompt_tokens or 0
+            stats['completion_tokens'] += completion_tokens or 0
+            if finish_reason == 'length' or (max_tokens and completion_tokens and completion_tokens >= max_tokens):
+                stats['hit_limit'] += 1
+            stats['recent'].append(completion_tokens or 0)
+
+    def record_response(self, profile: AIProfile, payload: dict, content: str, usage: dict = None,
+                        finish_reason: str = None):
+        """记录一次调用的用量：有服务商返回的 usage 用实际值，否则（流式）按文本估算"""
+        prompt_tokens, completion_tokens, estimated = usage_tokens(payload, content, usage)
+        self.record(profile.name, prompt_tokens, completion_tokens, payload.get('max_tokens'),
+                    estimated=estimated, finish_reason=finish_reason)
+
+    def stats(self) -> Dict:
+        result = {}
+        with self._lock:
+            items = [(name, dict(stats), sorted(stats['recent'])) for name, stats in self._stats.items()]
+        for name, stats, recent in items:
+            stats.pop('recent')
+            calls = stats['calls']
+            stats['avg_prompt_tokens'] = round(stats.pop('prompt_tokens') / calls) if calls else 0
+            stats['avg_completion_tokens'] = round(stats.pop('completion_tokens') / calls) if calls else 0
+            if recent:
+                stats['p95_completion_tokens'] = recent[min(len(recent) - 1, int(len(recent) * 0.95))]
+                stats['max_completion_tokens'] = recent[-1]
+            profile = ai_profiles.get(name)
+            if profile is not None:
+                stats['max_tokens'] = profile.max_tokens
+            result[name] = stats
+        return result
+
+
+# 单例实例
+ai_profiles = load_profiles(Config.AI_PROFILE_OVERRIDES)
+profile_usage = ProfileUsage()
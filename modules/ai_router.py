@@ -0,0 +1,205 @@
+"""
+AI 服务商路由 - 按实时延迟和错误率为每个请求挑选服务商
+每个 (服务商, 模型) 维护首字耗时、总耗时、错误率的 EWMA；每个服务商一个熔断器，
+连续失败或被限流（429）时熔断，冷却后放一个真实请求探测
+"""
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from config import Config
+from modules.circuit_breaker import CircuitBreaker
+
+
+class ProviderModelStats:
+    """某服务商某模型的滑动统计（EWMA）"""
+
+    def __init__(self):
+        self.ttft: Optional[float] = None       # 首字耗时；非流式请求按整个响应耗时计
+        self.latency: Optional[float] = None    # 总耗时
+        self.error_rate = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.last_sample_at = 0.0
+        self.last_error: Optional[str] = None
+
+    @staticmethod
+    def _ewma(current: Optional[float], value: float, alpha: float) -> float:
+        return value if current is None else alpha * value + (1 - alpha) * current
+
+    def success(self, alpha: float, ttft: Optional[float], latency: Optional[float]):
+        if ttft is not None:
+            self.ttft = self._ewma(self.ttft, ttft, alpha)
+        if latency is not None:
+            self.latency = self._ewma(self.latency, latency, alpha)
+        self.error_rate = (1 - alpha) * self.error_rate
+        self.requests += 1
+        self.last_sample_at = time.monotonic()
+
+    def failure(self, alpha: float, error: str, rate_limited: bool):
+        self.error_rate = alpha + (1 - alpha) * self.error_rate
+        self.requests += 1
+        self.errors += 1
+        if rate_limited:
+            self.rate_limited += 1
+        self.last_error = error[:200]
+        self.last_sample_at = time.monotonic()
+
+    def to_dict(self) -> Dict:
+        return {
+            'ttft': round(self.ttft, 3) if self.ttft is not None else None,
+            'latency': round(self.latency, 3) if self.latency is not None else None,
+            'error_rate': round(self.error_rate, 4),
+            'requests': self.requests,
+            'errors': self.errors,
+            'rate_limited': self.rate_limited,
+            'last_error': self.last_error
+        }
+
+
+class AIRouter:
+    """
+    自适应路由
+
+    - rank()：按预估首字耗时排序可用服务商，预估值 = EWMA 首字耗时 / (1 - EWMA 错误率)
+    - 没有样本、或样本超过 explore_after 秒没更新的服务商排在最前，用真实请求重新测一次
+    - 熔断中的服务商不参与排序；全部熔断时按默认顺序硬试（总比直接失败好）
+    - 真正发请求前调用 acquire()，半开状态下只有一个请求能拿到探测机会，结果必须回报
+    """
+
+    def __init__(
+        self,
+        alpha: float = 0.2,
+        breaker_threshold: int = 3,
+        breaker_reset: float = 30.0,
+        explore_after: float = 300.0
+    ):
+        self.alpha = alpha
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self.explore_after = explore_after
+        self._stats: Dict[Tuple[str, str], ProviderModelStats] = {}
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def _breaker(self, provider: str) -> CircuitBreaker:
+        breaker = self._breakers.get(provider)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.get(provider)
+                if breaker is None:
+                    breaker = self._breakers[provider] = CircuitBreaker(
+                        f'AI 服务商 {provider}',
+                        failure_threshold=self.breaker_threshold,
+                        reset_timeout=self.breaker_reset
+                    )
+        return breaker
+
+    def _model_stats(self, provider: str, model: str) -> ProviderModelStats:
+        key = (provider, model)
+        stats = self._stats.get(key)
+        if stats is None:
+            with self._lock:
+                stats = self._stats.setdefault(key, ProviderModelStats())
+        return stats
+
+    def _score(self, provider: str, model: str) -> float:
+        """预估首字耗时（秒），越小越好；需要重新探测的返回 -1，最近只有失败的排最后"""
+        stats = self._stats.get((provider, model))
+        if stats is None or time.monotonic() - stats.last_sample_at > self.explore_after:
+            return -1.0
+        if stats.ttft is None:
+            return float('inf')
+        return stats.ttft / max(0.05, 1 - stats.error_rate)
+
+    # ========================================
+    # 选路
+    # ========================================
+
+    def rank(self, apis: Sequence[tuple], model: str) -> Tuple[List[tuple], bool]:
+        """
+        对 (名称, ...) 元组列表排序
+
+        Returns:
+            (排好序的列表, forced)；forced=True 表示全部熔断、按默认顺序硬试，调用方不再 acquire()
+        """
+        candidates = [(index, api) for index, api in enumerate(apis) if self._breaker(api[0]).available()]
+        if not candidates:
+            return list(apis), True
+        # 同分时保持默认顺序
+        candidates.sort(key=lambda item: (self._score(item[1][0], model), item[0]))
+        return [api for _, api in candidates], False
+
+    def acquire(self, provider: str) -> bool:
+        """发请求前调用：熔断中返回 False；冷却结束时当前调用者负责探测"""
+        return self._breaker(provider).allow_request()
+
+    # ========================================
+    # 回报结果
+    # ========================================
+
+    def record_success(self, provider: str, model: str, ttft: Optional[float] = None, latency: Optional[float] = None):
+        """请求成功（流式请求在拿到首字时回报 ttft，结束时再回报 latency）"""
+        self._breaker(provider).record_success()
+        stats = self._model_stats(provider, model)
+        with self._lock:
+            stats.success(self.alpha, ttft, latency)
+
+    def record_latency(self, provider: str, model: str, latency: float):
+        """流式请求结束时补报总耗时（成功已在首字时回报）"""
+        stats = self._model_stats(provider, model)
+        with self._lock:
+            stats.latency = stats._ewma(stats.latency, latency, self.alpha)
+
+    def record_failure(self, provider: str, model: str, error: str, status_code: Optional[int] = None):
+        """请求失败；429 直接熔断（限流期间再发也是失败）"""
+        breaker = self._breaker(provider)
+        if status_code == 429:
+            breaker.trip()
+        else:
+            breaker.record_failure()
+        stats = self._model_stats(provider, model)
+        with self._lock:
+            stats.failure(self.alpha, error, status_code == 429)
+
+    def record_abandoned(self, provider: str):
+        """请求在出结果前被放弃（对冲落败、客户端断开）：不计入统计，若它是半开探测则稍后重新探测"""
+        breaker = self._breaker(provider)
+        if breaker.state == CircuitBreaker.HALF_OPEN:
+            breaker.record_failure()
+
+    # ========================================
+    # 路由表
+    # ========================================
+
+    def table(self) -> Dict:
+        """当前路由表：各服务商熔断状态、各模型统计和当前排序"""
+        with self._lock:
+            stats_items = list(self._stats.items())
+            breakers = dict(self._breakers)
+        models: Dict[str, Dict] = {}
+        for (provider, model), stats in stats_items:
+            entry = stats.to_dict()
+            score = self._score(provider, model)
+            entry['score'] = round(score, 3) if 0 <= score < float('inf') else None
+            models.setdefault(model, {'providers': {}})['providers'][provider] = entry
+        for model, info in models.items():
+            order, forced = self.rank([(name,) for name in breakers], model)
+            info['order'] = [api[0] for api in order]
+            info['forced'] = forced
+        return {
+            'providers': {name: breaker.stats() for name, breaker in breakers.items()},
+            'models': models,
+            'alpha': self.alpha,
+            'explore_after': self.explore_after
+        }
+
+
+# 单例实例
+ai_router = AIRouter(
+    alpha=Config.AI_ROUTER_EWMA_ALPHA,
+    breaker_threshold=Config.AI_BREAKER_THRESHOLD,
+    breaker_reset=Config.AI_BREAKER_RESET,
+    explore_after=Config.AI_ROUTER_EXPLORE_AFTER
+)
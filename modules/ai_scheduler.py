@@ -0,0 +1,264 @@
+"""
+AI 请求调度 - 按优先级分配并发和服务商配额，让后台任务给用户对话让路
+三个优先级：interactive（用户对话）> analysis（管理后台分析、信息图）> background（记忆提取、上下文摘要）
+每类有并发上限；每个服务商一个令牌桶，被限流（429）时降速并暂停，之后逐步恢复
+"""
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional, Tuple
+
+from config import Config
+
+PRIORITY_INTERACTIVE = 'interactive'
+PRIORITY_ANALYSIS = 'analysis'
+PRIORITY_BACKGROUND = 'background'
+PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_ANALYSIS, PRIORITY_BACKGROUND)
+
+# 当前调用所在的调度槽：(优先级, 等待截止时间)；未设置即为 interactive
+_current: ContextVar[Optional[Tuple[str, float]]] = ContextVar('ai_scheduler_slot', default=None)
+
+
+class AISchedulerTimeout(Exception):
+    """排队等待并发槽或服务商配额超时"""
+
+
+class TokenBucket:
+    """
+    单个服务商的令牌桶（AIMD）
+
+    - 每秒补充 rate 个令牌，最多 burst 个；interactive 可以透支（最多透支 burst 个），其他优先级要有余量才能取
+    - 429：速率减半（不低于 min_rate）、清空余量，并暂停到 Retry-After（默认 backoff 秒）
+    - 成功：速率每次恢复 base_rate 的 5%，直到回到 base_rate
+    """
+
+    def __init__(self, rate: float, burst: float, min_rate: float, backoff: float = 5.0):
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.backoff = backoff
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.waiting = {priority: 0 for priority in PRIORITIES}
+        self.granted = 0
+        self.rate_limited = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def refill(self, now: float):
+        if now > self.updated:
+            start = max(self.updated, self.blocked_until)
+            if now > start:
+                self.tokens = min(self.burst, self.tokens + (now - start) * self.rate)
+            self.updated = now
+
+    def ready_in(self, now: float, need: float) -> float:
+        """还要多少秒才有 need 个令牌（0 表示现在就够）"""
+        if now < self.blocked_until:
+            return self.blocked_until - now + max(0.0, need - self.tokens) / self.rate
+        return max(0.0, need - self.tokens) / self.rate
+
+    def on_success(self):
+        self.rate = min(self.base_rate, self.rate + self.base_rate * 0.05)
+
+    def on_rate_limited(self, now: float, retry_after: Optional[float]):
+        self.rate_limited += 1
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = min(self.tokens, 0.0)
+        self.blocked_until = max(self.blocked_until, now + (retry_after if retry_after is not None else self.backoff))
+
+    def stats(self, now: float) -> Dict:
+        return {
+            'rate': round(self.rate, 3),
+            'base_rate': self.base_rate,
+            'tokens': round(self.tokens, 2),
+            'blocked_for': round(max(0.0, self.blocked_until - now), 1),
+            'waiting': dict(self.waiting),
+            'granted': self.granted,
+            'rate_limited': self.rate_limited,
+            'avg_wait': round(self.wait_total / self.granted, 3) if self.granted else 0.0,
+            'max_wait': round(self.wait_max, 3)
+        }
+
+
+class AIScheduler:
+    """
+    优先级调度
+
+    - slot(priority)：进入某个优先级的并发槽（超过上限时排队），期间本调用发出的 AI 请求都按该优先级取配额；
+      嵌套调用沿用外层的槽（如后台任务里调用 ai_service.chat）
+    - acquire(provider)：AI 网关发请求前调用；interactive 从不等待，其他优先级在更高优先级有人排队时让行
+    - record_response(provider, status)：AI 网关收到响应后调用，429 触发降速
+    - 计数均为单个 worker 内（每个 gunicorn worker 各有一份配额）
+    """
+
+    def __init__(
+        self,
+        concurrency: Dict[str, int] = None,
+        rate: float = 5.0,
+        burst: float = 20.0,
+        reserve: float = 0.3,
+        max_wait: float = 60.0
+    ):
+        # 并发上限（0 表示不限）
+        self.concurrency = dict(concurrency or {})
+        self.rate = rate
+        self.burst = burst
+        # background 取令牌后桶里至少还要留给 interactive 的令牌数
+        self.reserve = burst * reserve
+        self.max_wait = max_wait
+        self._cond = threading.Condition()
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._classes = {
+            priority: {'active': 0, 'queued': 0, 'peak_queued': 0, 'granted': 0, 'timeouts': 0,
+                       'wait_total': 0.0, 'wait_max': 0.0}
+            for priority in PRIORITIES
+        }
+
+    def _bucket(self, provider: str) -> TokenBucket:
+        bucket = self._buckets.get(provider)
+        if bucket is None:
+            bucket = self._buckets[provider] = TokenBucket(self.rate, self.burst, min_rate=self.rate * 0.1)
+        return bucket
+
+    @staticmethod
+    def current_priority() -> str:
+        current = _current.get()
+        return current[0] if current else PRIORITY_INTERACTIVE
+
+    # ========================================
+    # 并发槽
+    # ========================================
+
+    @contextmanager
+    def slot(self, priority: str, max_wait: float = None):
+        """
+        进入并发槽（上下文管理器），排队超过 max_wait 秒抛 AISchedulerTimeout
+
+        interactive 不设置上下文（默认即 interactive），流式生成器里使用也不会跨上下文重置
+        """
+        if _current.get() is not None:
+            yield
+            return
+
+        started = time.monotonic()
+        deadline = started + (self.max_wait if max_wait is None else max_wait)
+        limit = self.concurrency.get(priority, 0)
+        stats = self._classes[priority]
+        with self._cond:
+            stats['queued'] += 1
+            stats['peak_queued'] = max(stats['peak_queued'], stats['queued'])
+            try:
+                while limit and stats['active'] >= limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        stats['timeouts'] += 1
+                        raise AISchedulerTimeout(f'{priority} 类 AI 请求排队超时（并发上限 {limit}）')
+                    self._cond.wait(remaining)
+            finally:
+                stats['queued'] -= 1
+            waited = time.monotonic() - started
+            stats['active'] += 1
+            stats['granted'] += 1
+            stats['wait_total'] += waited
+            stats['wait_max'] = max(stats['wait_max'], waited)
+
+        token = _current.set((priority, deadline)) if priority != PRIORITY_INTERACTIVE else None
+        try:
+            yield
+        finally:
+            if token is not None:
+                _current.reset(token)
+            with self._cond:
+                stats['active'] -= 1
+                self._cond.notify_all()
+
+    # ========================================
+    # 服务商配额
+    # ========================================
+
+    def acquire(self, provider: str):
+        """取一个令牌；非 interactive 在截止时间前拿不到时抛 AISchedulerTimeout"""
+        current = _current.get()
+        priority, deadline = current if current else (PRIORITY_INTERACTIVE, None)
+        started = time.monotonic()
+        with self._cond:
+            bucket = self._bucket(provider)
+            if priority == PRIORITY_INTERACTIVE:
+                bucket.refill(started)
+                bucket.tokens = max(bucket.tokens - 1, -bucket.burst)
+                bucket.granted += 1
+                return
+
+            need = 1 + (self.reserve if priority == PRIORITY_BACKGROUND else 0)
+            higher = PRIORITIES[:PRIORITIES.index(priority)]
+            bucket.waiting[priority] += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    bucket.refill(now)
+                    # 更高优先级在等同一服务商时先让它拿
+                    ready_in = bucket.ready_in(now, need)
+                    if ready_in <= 0 and not any(bucket.waiting[p] for p in higher):
+                        bucket.tokens -= 1
+                        break
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        raise AISchedulerTimeout(f'{priority} 类 AI 请求等待服务商配额超时: {provider}')
+                    self._cond.wait(min(remaining, max(0.05, ready_in)))
+            finally:
+                bucket.waiting[priority] -= 1
+            waited = time.monotonic() - started
+            bucket.granted += 1
+            bucket.wait_total += waited
+            bucket.wait_max = max(bucket.wait_max, waited)
+            self._cond.notify_all()
+
+    def record_response(self, provider: str, status_code: int, retry_after: str = None):
+        """回报响应状态：429 降速暂停，2xx 逐步恢复"""
+        if status_code == 429:
+            try:
+                seconds = float(retry_after) if retry_after else None
+            except ValueError:
+                seconds = None
+            with self._cond:
+                self._bucket(provider).on_rate_limited(time.monotonic(), seconds)
+            print(f"⚠️ AI 服务商被限流: {provider}，降速至 {self._buckets[provider].rate:.2f} 次/秒")
+        elif 200 <= status_code < 300:
+            with self._cond:
+                self._bucket(provider).on_success()
+                self._cond.notify_all()
+
+    # ========================================
+    # 统计
+    # ========================================
+
+    def stats(self) -> Dict:
+        now = time.monotonic()
+        with self._cond:
+            classes = {}
+            for priority, stats in self._classes.items():
+                entry = {key: value for key, value in stats.items() if key not in ('wait_total', 'wait_max')}
+                entry['limit'] = self.concurrency.get(priority, 0)
+                entry['avg_wait'] = round(stats['wait_total'] / stats['granted'], 3) if stats['granted'] else 0.0
+                entry['max_wait'] = round(stats['wait_max'], 3)
+                classes[priority] = entry
+            providers = {name: bucket.stats(now) for name, bucket in self._buckets.items()}
+        return {'classes': classes, 'providers': providers}
+
+
+# 单例实例
+ai_scheduler = AIScheduler(
+    concurrency={
+        PRIORITY_INTERACTIVE: 0,
+        PRIORITY_ANALYSIS: Config.AI_SCHEDULER_ANALYSIS_CONCURRENCY,
+        PRIORITY_BACKGROUND: Config.AI_SCHEDULER_BACKGROUND_CONCURRENCY
+    },
+    rate=Config.AI_PROVIDER_RATE,
+    burst=Config.AI_PROVIDER_BURST,
+    reserve=Config.AI_SCHEDULER_RESERVE,
+    max_wait=Config.AI_SCHEDULER_MAX_WAIT
+)
@@ -1,28 +1,113 @@
 """
-AI服务模块 - 双 API 自动切换（云雾优先，CloseAI 备用）
+AI服务模块 - 双 API 自动切换（顺序由 ai_router 按实时首字耗时和错误率决定）
 支持普通请求、流式输出和多模态（图片+文本）
 """
 import os
 import time
-import json
 import base64
 import requests
 import logging
 from typing import List, Dict, Optional, Generator
 from config import Config
+from modules.ai_gateway import ai_gateway, AIGatewayError
+from modules.ai_hedge import CancelToken, StreamInterrupted, TTFTTracker, hedged_stream
+from modules.ai_cache import ai_cache
+from modules.ai_ledger import AICallRecord, ai_ledger, STATUS_OK, STATUS_ERROR, STATUS_INTERRUPTED, \
+    STATUS_CANCELLED, STATUS_REJECTED
+from modules.ai_profiles import ai_profiles, PROFILE_INTERACTIVE_CHAT
+from modules.ai_router import ai_router
+from modules.ai_scheduler import ai_scheduler, AISchedulerTimeout, PRIORITY_INTERACTIVE
+from modules.sse_codec import SSEDecoder
 
 # 配置日志
 logger = logging.getLogger(__name__)
 
 
+# 流式输出中断后请求续写时追加的指令
+RESUME_PROMPT = '你上一条回复因网络中断在上面的位置被截断了。请紧接着最后一个字继续写完，不要重复已经写过的内容，不要加任何说明或开场白。'
+
+
+class ProviderUnavailable(Exception):
+    """服务商熔断中，本次请求跳过它"""
+
+
+class OverlapTrimmer:
+    """
+    去掉续写开头与已输出内容重叠的部分
+
+    - 模型从头重写：逐字吞掉与已输出内容一致的前缀，从第一个不同的字开始输出
+    - 模型重复了结尾几个字：去掉与已输出结尾重合的最长前缀（至少 min_overlap 字才算重合）
+    只缓冲开头 head_chars 个字用于判断，之后直接透传；同步和异步续写共用
+    """
+
+    def __init__(self, partial: str, head_chars: int = 64, min_overlap: int = 4):
+        self.partial = partial
+        self.head_chars = head_chars
+        self.min_overlap = min_overlap
+        self._head = ''
+        self._state = 'head'
+        self._position = 0
+
+    def feed(self, text: str) -> str:
+        """输入续写的一段，返回应当输出的部分（可能为空）"""
+        if self._state == 'pass':
+            return text
+        if self._state == 'replay':
+            return self._replay(text)
+        self._head += text
+        if len(self._head) < self.head_chars:
+            return ''
+        return self._decide()
+
+    def finish(self) -> str:
+        """续写结束，返回缓冲中剩余应输出的部分"""
+        if self._state == 'head':
+            return self._decide()
+        return ''
+
+    def _decide(self) -> str:
+        head, partial = self._head, self.partial
+        common = 0
+        for a, b in zip(partial, head):
+            if a != b:
+                break
+            common += 1
+
+        if common >= self.min_overlap and common >= min(len(partial), len(head), 16):
+            # 从头重写：继续逐字比对，直到与已输出内容不一致或已输出内容比对完
+            self._state = 'replay'
+            self._position = common
+            return self._replay(head[common:])
+
+        self._state = 'pass'
+        overlap = 0
+        for k in range(min(len(partial), len(head)), self.min_overlap - 1, -1):
+            if partial.endswith(head[:k]):
+                overlap = k
+                break
+        return head[overlap:]
+
+    def _replay(self, text: str) -> str:
+        matched = 0
+        for a, b in zip(self.partial[self._position:], text):
+            if a != b:
+                break
+            matched += 1
+        self._position += matched
+        text = text[matched:]
+        if text or self._position >= len(self.partial):
+            self._state = 'pass'
+        return text
+
+
 class AIService:
     """AI对话服务，支持双 API 自动切换"""
 
     def __init__(self):
-        # 主用 API：CloseAI（更快）
+        # 默认顺序第一：CloseAI（实际顺序由 ai_router 决定）
         self.primary_api_key = Config.CLOSEAI_API_KEY
         self.primary_base_url = Config.CLOSEAI_BASE_URL
-        # 备用 API：云雾（便宜）
+        # 默认顺序第二：云雾（便宜）
         self.backup_api_key = Config.YUNWU_API_KEY
         self.backup_base_url = Config.YUNWU_BASE_URL
 
@@ -30,8 +115,138 @@ class AIService:
         self.available_models = Config.AVAILABLE_MODELS
 
         # 超时设置（云雾稍慢，给更多时间）
-        self.primary_timeout = 30  # 云雾超时 30 秒
-        self.backup_timeout = 60   # CloseAI 超时 60 秒
+        self.primary_timeout = 30  # CloseAI 超时 30 秒
+        self.backup_timeout = 60   # 云雾超时 60 秒
+
+        # 对冲请求：主用超过延迟还没有首字就同时请求备用，先出首字的胜出
+        self.hedge_enabled = Config.AI_HEDGE_ENABLED
+        self.hedge_percentile = Config.AI_HEDGE_PERCENTILE
+        self.hedge_delay = Config.AI_HEDGE_DELAY
+        self.hedge_min_delay = Config.AI_HEDGE_MIN_DELAY
+        # 首字耗时（TTFT），对冲延迟据此计算
+        self.ttft = TTFTTracker()
+        # 流式输出中途断开时，把已输出的部分交给其他服务商续写
+        self.stream_resume = Config.AI_STREAM_RESUME
+
+    def _apis(self, timeout_extra: int = 0, timeout: float = None) -> List[tuple]:
+        """默认顺序的 (名称, key, base_url, 超时)，未配置 key 的跳过；timeout 为配置档指定的超时（替代服务商默认值）"""
+        apis = []
+        if self.primary_api_key:
+            apis.append(("CloseAI", self.primary_api_key, self.primary_base_url,
+                         (timeout or self.primary_timeout) + timeout_extra))
+        if self.backup_api_key:
+            apis.append(("云雾", self.backup_api_key, self.backup_base_url,
+                         (timeout or self.backup_timeout) + timeout_extra))
+        return apis
+
+    def route(self, model_name: str, timeout_extra: int = 0, timeout: float = None) -> tuple:
+        """本次请求的服务商顺序，返回 (apis, forced)；forced 表示全部熔断、不再检查熔断器"""
+        apis, forced = ai_router.rank(self._apis(timeout_extra, timeout), model_name)
+        logger.info(f"[路由] 模型: {model_name}，顺序: {' → '.join(api[0] for api in apis)}{'（全部熔断，强制尝试）' if forced else ''}")
+        return apis, forced
+
+    def _get_hedge_delay(self, api_name: str, model_name: str) -> float:
+        """对冲延迟：主用服务商该模型首字耗时的分位数，样本不足时用默认值"""
+        delay = self.ttft.percentile(api_name, model_name, self.hedge_percentile)
+        if delay is None:
+            delay = self.hedge_delay
+        return max(self.hedge_min_delay, delay)
+
+    def _stream_request(
+        self,
+        api_name: str,
+        api_key: str,
+        base_url: str,
+        payload: dict,
+        timeout: int,
+        cancel: CancelToken = None,
+        record: AICallRecord = None
+    ) -> Generator[str, None, None]:
+        """
+        发起一次流式请求，逐段产出内容，并记录首字耗时（record 为本次调用的台账记录）
+
+        非 200 抛 AIGatewayError，网络错误抛 requests 异常；cancel 置位后断开连接
+        """
+        model_name = payload.get('model')
+        if record is not None:
+            record.attempt(api_name)
+        started = time.monotonic()
+        response = None
+        has_content = False
+        finished = False
+        reported = False
+        try:
+            response = ai_gateway.post(base_url, api_key, payload, timeout, stream=True)
+            if cancel is not None:
+                cancel.on_cancel(lambda: ai_gateway.abort(response))
+            if response.status_code != 200:
+                raise AIGatewayError(response.status_code, response.text)
+
+            # 迭代器留在变量里：break 后若被回收，urllib3 会把没读完结束块的连接提前放回连接池
+            # 按网络读到的批次解析，同一批的多帧合成一段产出
+            decoder = SSEDecoder()
+            chunks = ai_gateway.iter_raw(response)
+            for data in chunks:
+                content = decoder.feed(data)
+                if content:
+                    if not has_content:
+                        has_content = True
+                        ttft = time.monotonic() - started
+                        self.ttft.record(api_name, model_name, ttft)
+                        ai_router.record_success(api_name, model_name, ttft=ttft)
+                        if record is not None:
+                            record.first_token(api_name, ttft)
+                    yield content
+                if decoder.done:
+                    break
+            finished = True
+            if has_content:
+                ai_router.record_latency(api_name, model_name, time.monotonic() - started)
+            else:
+                ai_router.record_failure(api_name, model_name, '流式响应无内容')
+        except AIGatewayError as e:
+            reported = True
+            ai_router.record_failure(api_name, model_name, str(e), e.status_code)
+            raise
+        except AISchedulerTimeout:
+            # 排队等配额超时，请求没有发出，不算服务商的错
+            reported = True
+            ai_router.record_abandoned(api_name)
+            raise
+        except Exception as e:
+            reported = True
+            if cancel is not None and cancel.is_set():
+                ai_router.record_abandoned(api_name)
+            else:
+                ai_router.record_failure(api_name, model_name, str(e))
+            raise
+        finally:
+            if not reported and not finished and not has_content:
+                # 出首字前被放弃（客户端断开 / 对冲落败），不算服务商的错
+                ai_router.record_abandoned(api_name)
+            # 连接归还连接池（客户端中途断开时生成器关闭也会走到这里）
+            if response is not None:
+                if cancel is not None and cancel.is_set():
+                    ai_gateway.abort(response)
+                else:
+                    ai_gateway.release(response, drain=finished)
+
+    def _hedged(self, payload: dict, timeout_extra: int = 0, timeout: float = None,
+                record: AICallRecord = None) -> Generator[str, None, None]:
+        """对冲执行流式请求（payload 需带 stream=True）"""
+        apis, forced = self.route(payload.get('model'), timeout_extra, timeout)
+        if not apis:
+            return iter(())
+        delay = self._get_hedge_delay(apis[0][0], payload.get('model'))
+
+        def attempt(api: tuple, cancel: CancelToken):
+            if not forced and not ai_router.acquire(api[0]):
+                raise ProviderUnavailable(f'{api[0]} 熔断中')
+            return self._stream_request(*api[:3], payload, api[3], cancel=cancel, record=record)
+
+        attempts = [(api[0], lambda cancel, api=api: attempt(api, cancel)) for api in apis]
+        logger.info(f"[对冲] 模型: {payload.get('model')}，对冲延迟: {delay:.2f}s")
+        return hedged_stream(attempts, delay)
 
     def _call_api(
         self,
@@ -39,118 +254,161 @@ class AIService:
         base_url: str,
         payload: dict,
         timeout: int,
-        api_name: str
+        api_name: str,
+        record: AICallRecord = None
     ) -> Optional[str]:
         """
-        调用单个 API
+        调用单个 API（成功时结束 record，记下服务商返回的 token 用量）
 
         Returns:
             成功返回内容，失败返回 None
         """
-        headers = {
-            'Authorization': f'Bearer {api_key}',
-            'Content-Type': 'application/json'
-        }
-
+        model_name = payload.get('model')
+        if record is not None:
+            record.attempt(api_name)
+        started = time.monotonic()
         try:
-            logger.info(f"[{api_name}] 发起请求，模型: {payload.get('model')}")
-            response = requests.post(
-                f'{base_url}/chat/completions',
-                headers=headers,
-                json=payload,
-                timeout=timeout
-            )
+            logger.info(f"[{api_name}] 发起请求，模型: {model_name}")
+            response = ai_gateway.post(base_url, api_key, payload, timeout)
 
             if response.status_code == 200:
                 data = response.json()
-                content = data['choices'][0]['message'].get('content', '')
+                choice = data['choices'][0]
+                content = choice['message'].get('content', '')
                 if content:
                     logger.info(f"[{api_name}] 响应成功，长度: {len(content)}")
+                    # 非流式请求整个响应一起到达，首字耗时即总耗时
+                    elapsed = time.monotonic() - started
+                    ai_router.record_success(api_name, model_name, ttft=elapsed, latency=elapsed)
+                    if record is not None:
+                        record.first_token(api_name, elapsed)
+                        record.finish(STATUS_OK, payload, content, data.get('usage'), choice.get('finish_reason'))
                     return content
                 else:
                     logger.warning(f"[{api_name}] 响应内容为空")
+                    ai_router.record_failure(api_name, model_name, '响应内容为空')
                     return None
             else:
                 logger.warning(f"[{api_name}] 请求失败: {response.status_code}")
+                ai_router.record_failure(api_name, model_name, response.text, response.status_code)
                 return None
 
+        except AISchedulerTimeout:
+            # 排队等配额超时，请求没有发出：不算服务商的错，也不再尝试其他服务商
+            ai_router.record_abandoned(api_name)
+            raise
         except requests.exceptions.Timeout:
             logger.warning(f"[{api_name}] 请求超时 ({timeout}s)")
+            ai_router.record_failure(api_name, model_name, f'请求超时 ({timeout}s)')
             return None
         except requests.exceptions.RequestException as e:
             logger.warning(f"[{api_name}] 网络错误: {e}")
+            ai_router.record_failure(api_name, model_name, str(e))
             return None
         except Exception as e:
             logger.warning(f"[{api_name}] 未知错误: {e}")
+            ai_router.record_failure(api_name, model_name, str(e))
             return None
 
     def chat(
         self,
         messages: List[Dict],
         system_prompt: str,
-        model: str = 'flash',
-        temperature: float = 0.7,
-        max_tokens: int = 16000
+        model: str = None,
+        temperature: float = None,
+        max_tokens: int = None,
+        cacheable: bool = False,
+        profile: str = PROFILE_INTERACTIVE_CHAT
     ) -> str:
         """
         发送对话请求（双 API 自动切换）
 
-        策略：云雾优先 → 失败/超时自动切换 CloseAI
+        策略：按 ai_router 给出的顺序依次尝试，失败/超时自动切换下一个；熔断中的服务商跳过
+
+        Args:
+            model / temperature / max_tokens: 不传时取配置档（见 ai_profiles）的值
+            cacheable: 内部调用（记忆提取、摘要等）传 True，请求内容完全相同时直接复用缓存的结果（见 ai_cache）
+            profile: 调用类别（interactive_chat / extraction / summary ...），决定生成上限、温度、超时等
         """
-        model_name = self.available_models.get(model, self.default_model)
+        call = ai_profiles[profile]
+        model_name = self.available_models.get(model, self.default_model) if model else call.model_name()
 
         full_messages = [
             {'role': 'system', 'content': system_prompt}
         ] + messages
 
-        payload = {
-            'model': model_name,
-            'messages': full_messages,
-            'temperature': temperature,
-            'max_tokens': max_tokens
-        }
-
-        # 1. 尝试 CloseAI（主用，更快）
-        if self.primary_api_key:
-            content = self._call_api(
-                self.primary_api_key,
-                self.primary_base_url,
-                payload,
-                self.primary_timeout,
-                "CloseAI"
-            )
+        payload = {'model': model_name, 'messages': full_messages}
+        if temperature is not None:
+            payload['temperature'] = temperature
+        if max_tokens is not None:
+            payload['max_tokens'] = max_tokens
+        call.apply(payload)
+
+        if cacheable:
+            cache_key = ai_cache.key(model_name, full_messages, payload['temperature'], payload['max_tokens'])
+            content = ai_cache.get(cache_key)
+            if content is not None:
+                logger.info(f"[缓存] 命中，模型: {model_name}")
+                return content
+        # 在后台任务的调度槽里调用时沿用其优先级（见 ai_scheduler）
+        record = ai_ledger.begin(call, model_name)
+        try:
+            with ai_scheduler.slot(PRIORITY_INTERACTIVE):
+                content = self._chat_uncached(payload, call.timeout, record)
+        except AISchedulerTimeout:
+            # 请求没有发出，不计 token
+            record.finish(STATUS_REJECTED)
+            raise
+        except Exception:
+            record.finish(STATUS_ERROR, payload)
+            raise
+        if cacheable:
+            ai_cache.put(cache_key, content, model_name)
+        return content
+
+    def _chat_uncached(self, payload: dict, timeout: float, record: AICallRecord) -> str:
+        """chat() 的实际请求部分（成功时结束 record，失败由 chat() 结束）"""
+        model_name = payload['model']
+        if self.hedge_enabled:
+            # 对冲模式：上游改用流式，才能按首字判断胜负、随时断开落败请求
+            try:
+                content = ''.join(self._stream_with_failover(dict(payload, stream=True), timeout=timeout,
+                                                             record=record))
+            except StreamInterrupted as e:
+                logger.warning(f"AI 回复中断且续写失败: {e}")
+                content = None
             if content:
+                record.finish(STATUS_OK, payload, content)
                 return content
-            logger.info("CloseAI 失败，切换到云雾...")
+            raise Exception("所有 AI API 均不可用，请稍后重试")
 
-        # 2. 尝试云雾（备用）
-        if self.backup_api_key:
-            content = self._call_api(
-                self.backup_api_key,
-                self.backup_base_url,
-                payload,
-                self.backup_timeout,
-                "云雾"
-            )
+        # 按路由顺序依次尝试
+        apis, forced = self.route(model_name, timeout=timeout)
+        for api_name, api_key, base_url, timeout in apis:
+            if not forced and not ai_router.acquire(api_name):
+                logger.info(f"[{api_name}] 熔断中，跳过")
+                continue
+            content = self._call_api(api_key, base_url, payload, timeout, api_name, record)
             if content:
                 return content
+            logger.info(f"{api_name} 失败，切换下一个服务商...")
 
-        # 3. 都失败了
+        # 都失败了
         raise Exception("所有 AI API 均不可用，请稍后重试")
 
-    def chat_stream(
+    def build_stream_payload(
         self,
         messages: List[Dict],
         system_prompt: str,
-        model: str = 'flash',
-        temperature: float = 0.7,
-        max_tokens: int = 16000,
-        images: List[str] = None  # Base64 图片列表
-    ) -> Generator[str, None, None]:
-        """
-        流式对话请求（双 API 自动切换）- 支持多模态
-        """
-        model_name = self.available_models.get(model, self.default_model)
+        model: str = None,
+        temperature: float = None,
+        max_tokens: int = None,
+        images: List[str] = None,
+        profile: str = PROFILE_INTERACTIVE_CHAT
+    ) -> Dict:
+        """组装流式请求体（最后一条用户消息带图片时转成多模态格式），asgi.py 的异步引擎也用它"""
+        call = ai_profiles[profile]
+        model_name = self.available_models.get(model, self.default_model) if model else call.model_name()
 
         # 构建消息（支持多模态）
         full_messages = [
@@ -218,75 +476,198 @@ class AIService:
         payload = {
             'model': model_name,
             'messages': full_messages,
-            'temperature': temperature,
-            'max_tokens': max_tokens,
             'stream': True
         }
+        if temperature is not None:
+            payload['temperature'] = temperature
+        if max_tokens is not None:
+            payload['max_tokens'] = max_tokens
+        return call.apply(payload)
 
-        # 尝试的 API 列表（CloseAI 优先）
-        apis = []
-        if self.primary_api_key:
-            apis.append(("CloseAI", self.primary_api_key, self.primary_base_url, self.primary_timeout + 30))
-        if self.backup_api_key:
-            apis.append(("云雾", self.backup_api_key, self.backup_base_url, self.backup_timeout + 30))
-
-        for api_name, api_key, base_url, timeout in apis:
-            headers = {
-                'Authorization': f'Bearer {api_key}',
-                'Content-Type': 'application/json'
-            }
+    def chat_stream(
+        self,
+        messages: List[Dict],
+        system_prompt: str,
+        model: str = None,
+        temperature: float = None,
+        max_tokens: int = None,
+        images: List[str] = None,  # Base64 图片列表
+        profile: str = PROFILE_INTERACTIVE_CHAT
+    ) -> Generator[str, None, None]:
+        """
+        流式对话请求（双 API 自动切换）- 支持多模态
+        """
+        call = ai_profiles[profile]
+        payload = self.build_stream_payload(messages, system_prompt, model, temperature, max_tokens, images, profile)
+        model_name = payload['model']
+        has_images = images and len(images) > 0
+
+        emitted = []
+        record = ai_ledger.begin(call, model_name)
+        # 生成器没跑完就被关闭（客户端断开）时按 cancelled 记账
+        status = STATUS_CANCELLED
+        try:
+            try:
+                with ai_scheduler.slot(PRIORITY_INTERACTIVE):
+                    for content in self._stream_with_failover(payload, timeout_extra=30, has_images=has_images,
+                                                              timeout=call.timeout, record=record):
+                        emitted.append(content)
+                        yield content
+            except StreamInterrupted as e:
+                logger.warning(f"AI 回复中断且续写失败: {e}")
+                status = STATUS_INTERRUPTED
+                yield "[ERROR]AI 回复中断，请重试"
+                return
+            except Exception:
+                status = STATUS_ERROR
+                raise
+            if emitted:
+                status = STATUS_OK
+                return
+
+            # 所有 API 都失败
+            status = STATUS_ERROR
+            yield "[ERROR]所有 AI API 均不可用，请稍后重试"
+        finally:
+            record.finish(status, payload, ''.join(emitted))
+
+    def _stream_with_failover(
+        self,
+        payload: dict,
+        timeout_extra: int = 0,
+        has_images: bool = False,
+        timeout: float = None,
+        record: AICallRecord = None
+    ) -> Generator[str, None, None]:
+        """
+        流式输出（payload 需带 stream=True）
 
-            has_images = images and len(images) > 0
-            logger.info(f"[{api_name}] 流式请求，模型: {model_name}，包含图片: {has_images}")
+        出首字前失败：切换下一个服务商（对冲模式下由 hedged_stream 处理）；
+        出首字后中断：把已输出的部分交给其他服务商续写，续写也失败时抛 StreamInterrupted；
+        所有服务商都没有输出时直接结束
+        """
+        model_name = payload.get('model')
+        emitted = []
 
+        if self.hedge_enabled:
+            logger.info(f"[对冲] 流式请求，模型: {model_name}，包含图片: {has_images}")
             try:
-                response = requests.post(
-                    f'{base_url}/chat/completions',
-                    headers=headers,
-                    json=payload,
-                    timeout=timeout,
-                    stream=True
-                )
-
-                if response.status_code != 200:
-                    logger.warning(f"[{api_name}] 流式请求失败: {response.status_code}, {response.text[:200]}")
+                for content in self._hedged(payload, timeout_extra, timeout, record):
+                    emitted.append(content)
+                    yield content
+                return
+            except StreamInterrupted as e:
+                logger.warning(f"[{e.provider}] 流式输出中断: {e.error}")
+                failed = e.provider
+        else:
+            # 按路由顺序依次尝试
+            failed = None
+            apis, forced = self.route(model_name, timeout_extra, timeout)
+            for api_name, api_key, base_url, api_timeout in apis:
+                if not forced and not ai_router.acquire(api_name):
+                    logger.info(f"[{api_name}] 熔断中，跳过")
                     continue
+                logger.info(f"[{api_name}] 流式请求，模型: {model_name}，包含图片: {has_images}")
 
-                # 成功，开始流式输出
-                has_content = False
-                for line in response.iter_lines():
-                    if line:
-                        line = line.decode('utf-8')
-                        if line.startswith('data: '):
-                            data_str = line[6:]
-                            if data_str == '[DONE]':
-                                break
-                            try:
-                                data = json.loads(data_str)
-                                delta = data.get('choices', [{}])[0].get('delta', {})
-                                content = delta.get('content', '')
-                                if content:
-                                    has_content = True
-                                    yield content
-                            except json.JSONDecodeError:
-                                continue
-
-                if has_content:
-                    logger.info(f"[{api_name}] 流式响应完成")
-                    return
-                else:
-                    logger.warning(f"[{api_name}] 流式响应无内容")
+                try:
+                    for content in self._stream_request(api_name, api_key, base_url, payload, api_timeout,
+                                                        record=record):
+                        emitted.append(content)
+                        yield content
+
+                    if emitted:
+                        logger.info(f"[{api_name}] 流式响应完成")
+                        return
+                    else:
+                        logger.warning(f"[{api_name}] 流式响应无内容")
+                        continue
+
+                except AIGatewayError as e:
+                    logger.warning(f"[{api_name}] 流式请求失败: {e.status_code}, {e.body[:200]}")
+                    continue
+                except requests.exceptions.Timeout:
+                    logger.warning(f"[{api_name}] 流式请求超时")
+                    if emitted:
+                        failed = api_name
+                        break
+                    continue
+                except requests.exceptions.RequestException as e:
+                    logger.warning(f"[{api_name}] 流式网络错误: {e}")
+                    if emitted:
+                        failed = api_name
+                        break
                     continue
 
-            except requests.exceptions.Timeout:
-                logger.warning(f"[{api_name}] 流式请求超时")
-                continue
-            except requests.exceptions.RequestException as e:
-                logger.warning(f"[{api_name}] 流式网络错误: {e}")
-                continue
+        if emitted:
+            yield from self._resume_stream(payload, ''.join(emitted), failed, timeout_extra, timeout, record)
+
+    def _resume_stream(
+        self,
+        payload: dict,
+        partial: str,
+        failed: str,
+        timeout_extra: int = 0,
+        timeout: float = None,
+        record: AICallRecord = None
+    ) -> Generator[str, None, None]:
+        """
+        续写中断的流式回复：把已输出的部分作为 assistant 消息，请其他服务商接着写
 
-        # 所有 API 都失败
-        yield "[ERROR]所有 AI API 均不可用，请稍后重试"
+        续写开头与已输出内容重叠的部分会被去掉（见 _skip_overlap），用户看到的回复不重复、不断档；
+        中断的服务商排到最后；续写再次中断会带上新输出的部分继续续写；续写没有补充内容也算失败
+        """
+        if not self.stream_resume:
+            raise StreamInterrupted(failed, Exception('未开启续写'))
+
+        model_name = payload.get('model')
+        last_error: Exception = Exception('没有可用的服务商')
+        for _ in range(max(2, len(self._apis()))):
+            apis, forced = self.route(model_name, timeout_extra, timeout)
+            apis = [api for api in apis if api[0] != failed] + [api for api in apis if api[0] == failed]
+            api = next((api for api in apis if forced or ai_router.acquire(api[0])), None)
+            if api is None:
+                break
+            api_name, api_key, base_url, api_timeout = api
+
+            resume_payload = dict(payload, messages=payload['messages'] + [
+                {'role': 'assistant', 'content': partial},
+                {'role': 'user', 'content': RESUME_PROMPT}
+            ])
+            logger.info(f"[{api_name}] 续写中断的回复（{failed} 中断，已输出 {len(partial)} 字）")
+
+            produced = []
+            try:
+                stream = self._stream_request(api_name, api_key, base_url, resume_payload, api_timeout,
+                                              record=record)
+                for content in self._skip_overlap(partial, stream):
+                    produced.append(content)
+                    yield content
+                if produced:
+                    logger.info(f"[{api_name}] 续写完成，补充 {sum(len(c) for c in produced)} 字")
+                    return
+                # 续写没有补充任何内容，回复仍是截断的，换下一个服务商
+                logger.warning(f"[{api_name}] 续写无内容")
+                last_error = Exception('续写无内容')
+                failed = api_name
+            except (AIGatewayError, requests.exceptions.RequestException) as e:
+                logger.warning(f"[{api_name}] 续写失败: {e}")
+                last_error = e
+                partial += ''.join(produced)
+                failed = api_name
+
+        raise StreamInterrupted(failed, last_error)
+
+    @staticmethod
+    def _skip_overlap(partial: str, pieces) -> Generator[str, None, None]:
+        """去掉续写开头与已输出内容重叠的部分（见 OverlapTrimmer）"""
+        trimmer = OverlapTrimmer(partial)
+        for piece in pieces:
+            text = trimmer.feed(piece)
+            if text:
+                yield text
+        text = trimmer.finish()
+        if text:
+            yield text
 
     def get_available_models(self) -> Dict[str, str]:
         """获取可用模型列表"""
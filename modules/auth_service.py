@@ -122,7 +122,7 @@ class AuthService:
                                 # 🔴 add_credits 失败，回滚预充值记录状态
                                 print(f"[注册] add_credits 失败: {msg}，回滚预充值记录")
                                 record_ids = [r['id'] for r in pending_records]
-                                db.rollback_pending_credits(record_ids)
+                                db.rollback_pending_credits(record_ids, user_id=response.user.id)
                                 pending_credits = 0  # 重置，避免误导用户
                                 pending_records = []
                     except Exception as pending_err:
@@ -563,6 +563,94 @@ class AuthService:
             print(f"通过手机号查找用户失败: {e}")
             return None
 
+    def find_users_by_phones(self, phones: List[str]) -> Optional[Dict[str, Dict]]:
+        """批量通过手机号查找用户（一次查询），返回 {规范化手机号: 用户数据}，查询失败返回 None"""
+        phones = list(dict.fromkeys(
+            p.strip().replace(' ', '').replace('-', '') for p in phones if p
+        ))
+        if not phones:
+            return {}
+
+        users = {}
+        try:
+            # 分批查询，避免 URL 过长
+            for start in range(0, len(phones), 200):
+                response = self.admin_client.table('profiles').select('*') \
+                    .in_('phone', phones[start:start + 200]).execute()
+                for user in (response.data or []):
+                    users.setdefault(user.get('phone'), user)
+        except Exception as e:
+            print(f"批量通过手机号查找用户失败: {e}")
+            return None
+        return users
+
+    def add_credits_by_phones(self, phones: List[str], amount: int, reason: str = "管理员批量充值",
+                              admin_name: str = "admin") -> List[Tuple[str, bool, str, int, Optional[Dict]]]:
+        """
+        批量通过手机号充值（支持预充值）
+
+        已注册用户逐个充值（余额乐观锁需要逐个更新）；
+        未注册的手机号一次批量写入预充值记录，并合并记一条管理员日志
+
+        Returns: [(手机号, 成功?, 消息, 新余额或预充值积分, 用户数据或None)]，与 phones 顺序一致
+        """
+        users = self.find_users_by_phones(phones)
+        if users is None:
+            # 查不到注册状态时不能当作未注册去预充值
+            return [(phone, False, "查询用户失败，请重试", 0, None) for phone in phones]
+        results = {}
+
+        pending_phones = []
+        for index, phone in enumerate(phones):
+            normalized = phone.strip().replace(' ', '').replace('-', '')
+            user = users.get(normalized)
+            if not user:
+                pending_phones.append((index, normalized))
+                continue
+
+            user_name = user.get('nickname') or user.get('email', '未知用户')
+            success, msg, new_balance = self.add_credits(user.get('id'), amount, reason)
+            if success:
+                try:
+                    from modules.admin_log_service import admin_log_service
+                    admin_log_service.log_credits_add(
+                        admin_name=admin_name,
+                        target_user=f"{user_name} ({phone})",
+                        cat_coins=0,
+                        credits=amount,
+                        reason=reason
+                    )
+                except Exception as log_err:
+                    print(f"记录管理员操作日志失败: {log_err}")
+                results[index] = (phone, True, f"成功为 {user_name} 充值 {amount} 积分", new_balance, user)
+            else:
+                results[index] = (phone, False, msg, 0, user)
+
+        if pending_phones:
+            from database import db
+            success, msg, _ = db.add_pending_credits_bulk(
+                [{'phone': phone, 'credits': amount} for _, phone in pending_phones],
+                reason=reason,
+                admin_name=admin_name
+            )
+            for index, phone in pending_phones:
+                results[index] = (phones[index], success, msg, amount if success else 0, None)
+
+            if success:
+                try:
+                    from modules.admin_log_service import admin_log_service
+                    admin_log_service.log_credits_add(
+                        admin_name=admin_name,
+                        target_user=f"预充值 {len(pending_phones)} 个手机号",
+                        cat_coins=0,
+                        credits=amount * len(pending_phones),
+                        reason=f"{reason}（预充值-待用户注册，每人 {amount} 积分）"
+                    )
+                except Exception as log_err:
+                    print(f"记录管理员操作日志失败: {log_err}")
+
+        return [results[index] for index in range(len(phones))]
+
     def add_credits_by_phone(self, phone: str, amount: int, reason: str = "管理员充值",
                              admin_name: str = "admin") -> Tuple[bool, str, int, Optional[Dict]]:
         """
@@ -129,21 +129,19 @@ class ButtonConfigService:
         """初始化本地 SQLite 表"""
         try:
             from database import db
-            conn = db._get_conn()
-            cursor = conn.cursor()
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS admin_buttons (
-                    id TEXT PRIMARY KEY,
-                    name TEXT NOT NULL,
-                    icon TEXT,
-                    prompt TEXT,
-                    is_active INTEGER DEFAULT 1,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            conn.commit()
-            conn.close()
+            with db.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS admin_buttons (
+                        id TEXT PRIMARY KEY,
+                        name TEXT NOT NULL,
+                        icon TEXT,
+                        prompt TEXT,
+                        is_active INTEGER DEFAULT 1,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
         except Exception as e:
             print(f"初始化本地 admin_buttons 表失败: {e}")
 
@@ -166,11 +164,10 @@ class ButtonConfigService:
             # 使用本地 SQLite
             try:
                 from database import db
-                conn = db._get_conn()
-                cursor = conn.cursor()
-                cursor.execute('SELECT * FROM admin_buttons WHERE is_active = 1')
-                rows = cursor.fetchall()
-                conn.close()
+                with db.connection() as conn:
+                    cursor = conn.cursor()
+                    cursor.execute('SELECT * FROM admin_buttons WHERE is_active = 1')
+                    rows = cursor.fetchall()
                 for row in rows:
                     buttons[row['id']] = dict(row)
             except Exception as e:
@@ -199,11 +196,10 @@ class ButtonConfigService:
         else:
             try:
                 from database import db
-                conn = db._get_conn()
-                cursor = conn.cursor()
-                cursor.execute('SELECT * FROM admin_buttons WHERE id = ?', (button_id,))
-                row = cursor.fetchone()
-                conn.close()
+                with db.connection() as conn:
+                    cursor = conn.cursor()
+                    cursor.execute('SELECT * FROM admin_buttons WHERE id = ?', (button_id,))
+                    row = cursor.fetchone()
                 if row:
                     btn = dict(row)
                     self._cache[button_id] = btn
@@ -253,31 +249,28 @@ class ButtonConfigService:
         # 回退到本地 SQLite
         try:
             from database import db
-            conn = db._get_conn()
-            cursor = conn.cursor()
+            with db.connection(immediate=True) as conn:
+                cursor = conn.cursor()
 
-            cursor.execute('SELECT id FROM admin_buttons WHERE id = ?', (button_id,))
-            existing = cursor.fetchone()
+                cursor.execute('SELECT id FROM admin_buttons WHERE id = ?', (button_id,))
+                existing = cursor.fetchone()
 
-            if existing:
-                cursor.execute('''
-                    UPDATE admin_buttons SET name = ?, icon = ?, prompt = ?, is_active = ?, updated_at = CURRENT_TIMESTAMP
-                    WHERE id = ?
-                ''', (update_data.get('name'), update_data.get('icon'), update_data.get('prompt'),
-                      1 if update_data.get('is_active', True) else 0, button_id))
-            else:
-                default = DEFAULT_BUTTON_CONFIGS.get(button_id, {})
-                cursor.execute('''
-                    INSERT INTO admin_buttons (id, name, icon, prompt, is_active)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (button_id,
-                      update_data.get('name', default.get('name', button_id)),
-                      update_data.get('icon', default.get('icon', '📋')),
-                      update_data.get('prompt', default.get('prompt', '')),
-                      1 if update_data.get('is_active', True) else 0))
-
-            conn.commit()
-            conn.close()
+                if existing:
+                    cursor.execute('''
+                        UPDATE admin_buttons SET name = ?, icon = ?, prompt = ?, is_active = ?, updated_at = CURRENT_TIMESTAMP
+                        WHERE id = ?
+                    ''', (update_data.get('name'), update_data.get('icon'), update_data.get('prompt'),
+                          1 if update_data.get('is_active', True) else 0, button_id))
+                else:
+                    default = DEFAULT_BUTTON_CONFIGS.get(button_id, {})
+                    cursor.execute('''
+                        INSERT INTO admin_buttons (id, name, icon, prompt, is_active)
+                        VALUES (?, ?, ?, ?, ?)
+                    ''', (button_id,
+                          update_data.get('name', default.get('name', button_id)),
+                          update_data.get('icon', default.get('icon', '📋')),
+                          update_data.get('prompt', default.get('prompt', '')),
+                          1 if update_data.get('is_active', True) else 0))
 
             if button_id in self._cache:
                 del self._cache[button_id]
@@ -0,0 +1,127 @@
+"""
+熔断器 - 远端存储故障时直接走本地备用，不再每个请求都等超时
+closed（正常）→ 连续失败达到阈值 → open（直接跳过）→ 冷却结束 → half_open（探测一次）→ 成功则恢复
+调用方需在每次成功后调用 record_success()，否则零星的失败会累计起来
+"""
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+
+class CircuitBreaker:
+    """
+    熔断器
+
+    - 连续 failure_threshold 次失败（且都在 failure_window 秒内）即打开，任何一次成功都会清零计数
+    - 打开后 reset_timeout 秒内 allow_request() 一律返回 False
+    - 冷却结束后只放一个调用者执行健康探测（probe），其余调用者继续走备用
+      探测成功关闭熔断器，失败则重新计时
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 3,
+        reset_timeout: float = 30.0,
+        failure_window: float = 60.0,
+        probe: Optional[Callable[[], None]] = None
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failure_window = failure_window
+        self.probe = probe
+
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = []
+        self._opened_at = 0.0
+        self._stats = {'opened': 0, 'short_circuited': 0, 'probes': 0, 'probe_failures': 0}
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    def available(self) -> bool:
+        """不改变状态地判断：关闭，或已过冷却期等待探测（用于排序，真正发请求前仍要调用 allow_request）"""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            return self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout
+
+    def allow_request(self) -> bool:
+        """是否允许访问远端"""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.HALF_OPEN or time.monotonic() - self._opened_at < self.reset_timeout:
+                self._stats['short_circuited'] += 1
+                return False
+            # 冷却结束，由当前调用者负责探测
+            self._state = self.HALF_OPEN
+            self._stats['probes'] += 1
+
+        if self.probe is None:
+            # 没有探测函数时，用本次真实请求作为探测，结果由 record_success / record_failure 决定
+            return True
+
+        try:
+            self.probe()
+        except Exception as e:
+            print(f"⚠️ {self.name} 健康探测失败，继续熔断: {e}")
+            with self._lock:
+                self._stats['probe_failures'] += 1
+                self._open()
+            return False
+
+        print(f"✅ {self.name} 健康探测成功，恢复访问")
+        self.record_success()
+        return True
+
+    def record_success(self):
+        with self._lock:
+            if self._state == self.OPEN:
+                # 熔断前发出、熔断后才返回的请求不算恢复，恢复由半开探测决定
+                return
+            self._state = self.CLOSED
+            self._failures = []
+
+    def record_failure(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                self._open()
+                return
+            if self._state == self.OPEN:
+                return
+            self._failures = [t for t in self._failures if now - t < self.failure_window]
+            self._failures.append(now)
+            if len(self._failures) >= self.failure_threshold:
+                print(f"⚠️ {self.name} 连续失败 {len(self._failures)} 次，熔断 {self.reset_timeout:.0f} 秒")
+                self._open()
+
+    def trip(self):
+        """立即打开熔断器（如启动时远端不可达）"""
+        with self._lock:
+            self._open()
+
+    def _open(self):
+        """调用方需持有锁"""
+        if self._state != self.OPEN:
+            self._stats['opened'] += 1
+        self._state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._failures = []
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['state'] = self._state
+            stats['recent_failures'] = len(self._failures)
+            if self._state == self.OPEN:
+                stats['retry_in'] = round(max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at)), 1)
+        return stats
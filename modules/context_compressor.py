@@ -7,6 +7,12 @@ import logging
 from typing import List, Dict, Optional
 from datetime import datetime
 
+from config import Config
+from modules.ai_profiles import PROFILE_SUMMARY
+from modules.ai_scheduler import ai_scheduler, PRIORITY_BACKGROUND
+from modules.message_totals import MessageTotals
+from modules.token_budget import MESSAGE_OVERHEAD_TOKENS, context_budget, estimate_tokens, truncate_tokens
+
 logger = logging.getLogger(__name__)
 
 
@@ -14,9 +20,8 @@ class ContextCompressor:
     """对话上下文压缩器"""
 
     # 配置
-    MAX_CHARS_BEFORE_COMPRESS = 30000  # 超过此字符数触发压缩
+    MAX_TOKENS_BEFORE_COMPRESS = 30000  # 超过此 token 数触发压缩
     KEEP_RECENT_MESSAGES = 8  # 保留最近的消息数（4轮对话）
-    SUMMARY_MAX_CHARS = 2000  # 摘要最大长度
 
     def __init__(self):
         self.ai_service = None
@@ -33,8 +38,7 @@ class ContextCompressor:
         if len(messages) <= self.KEEP_RECENT_MESSAGES + 2:
             return False
 
-        total_chars = sum(len(msg.get('content', '')) for msg in messages)
-        return total_chars > self.MAX_CHARS_BEFORE_COMPRESS
+        return MessageTotals().sync(messages).total_tokens > self.MAX_TOKENS_BEFORE_COMPRESS
 
     def generate_summary(self, messages: List[Dict], module: str = '') -> str:
         """
@@ -73,21 +77,22 @@ class ContextCompressor:
 - 结论2
 """
 
-        # 构建对话文本
-        conversation_text = "\n".join([
+        # 构建对话文本（单条过长的截断；整体超出上下文预算时保留最近的部分）
+        conversation_text = "\n".join(context_budget.start().take_recent('history', [
             f"{'用户' if msg['role'] == 'user' else 'AI'}: {msg['content']}"
             for msg in messages
-        ])
+        ], item_limit=2000))
 
         try:
             ai = self._get_ai_service()
-            summary = ai.chat(
-                messages=[{'role': 'user', 'content': f"请压缩以下对话：\n\n{conversation_text}"}],
-                system_prompt=compress_prompt,
-                model='flash',  # 使用快速模型压缩
-                temperature=0.3,
-                max_tokens=1000
-            )
+            # 后台优先级：服务商配额紧张时给用户对话让路，等不到就用降级摘要（用户还在等回复）
+            with ai_scheduler.slot(PRIORITY_BACKGROUND, max_wait=Config.AI_SCHEDULER_SUMMARY_WAIT):
+                summary = ai.chat(
+                    messages=[{'role': 'user', 'content': f"请压缩以下对话：\n\n{conversation_text}"}],
+                    system_prompt=compress_prompt,
+                    profile=PROFILE_SUMMARY,  # 快速模型压缩
+                    cacheable=True  # 重试 / 重复压缩同一段历史时复用摘要
+                )
             logger.info(f"生成摘要成功，长度: {len(summary)}")
             return summary
         except Exception as e:
@@ -98,7 +103,7 @@ class ContextCompressor:
     def _fallback_summary(self, messages: List[Dict]) -> str:
         """降级方案：简单提取关键信息"""
         user_messages = [
-            msg['content'][:200]  # 每条消息取前200字
+            truncate_tokens(msg['content'], 200)  # 每条消息取前 200 token
             for msg in messages
             if msg.get('role') == 'user'
         ]
@@ -108,7 +113,8 @@ class ContextCompressor:
         self,
         messages: List[Dict],
         module: str = '',
-        force: bool = False
+        force: bool = False,
+        max_tokens: int = None
     ) -> List[Dict]:
         """
         智能压缩消息列表
@@ -117,6 +123,8 @@ class ContextCompressor:
             messages: 完整消息列表
             module: 当前模块
             force: 是否强制压缩
+            max_tokens: 压缩结果的 token 上限（默认为整个上下文预算）；
+                        摘要不超过预算里的摘要上限，最近消息放不下时只保留能放下的部分
 
         Returns:
             压缩后的消息列表
@@ -126,6 +134,7 @@ class ContextCompressor:
             return [{'role': m['role'], 'content': m['content']} for m in messages]
 
         logger.info(f"开始压缩对话，原始消息数: {len(messages)}")
+        budget = context_budget.start(max_tokens)
 
         # 分离：第一条(欢迎消息) + 中间消息(需压缩) + 最近消息(保留)
         first_message = messages[0] if messages else None
@@ -140,14 +149,28 @@ class ContextCompressor:
                 'role': first_message['role'],
                 'content': first_message['content']
             })
+            budget.charge('history', estimate_tokens(first_message['content']) + MESSAGE_OVERHEAD_TOKENS)
+
+        # 最近消息优先于摘要：先从预算里预留；放不下的较早几条并入摘要
+        recent_totals = MessageTotals().sync(recent_messages)
+        reserve = budget.remaining - min(budget.limit('summary'), budget.remaining // 4)
+        start = recent_totals.window_start(max(0, reserve), by='tokens')
+        if start and middle_messages:
+            middle_messages = middle_messages + recent_messages[:start]
+        recent_messages = recent_messages[start:]
+        budget.charge('history', recent_totals.total_tokens - recent_totals.tokens[start])
 
         # 2. 如果有中间消息，生成摘要
         if middle_messages:
-            summary = self.generate_summary(middle_messages, module)
+            # 包裹摘要的说明文字和消息格式开销也计入摘要预算
+            wrapper = "[以下是之前对话的摘要]\n{}\n[摘要结束，以下是最近的对话]"
+            overhead = estimate_tokens(wrapper.format('')) + MESSAGE_OVERHEAD_TOKENS
+            budget.charge('summary', overhead)
+            summary = budget.take('summary', self.generate_summary(middle_messages, module))
             if summary:
                 result.append({
                     'role': 'system',
-                    'content': f"[以下是之前对话的摘要]\n{summary}\n[摘要结束，以下是最近的对话]"
+                    'content': wrapper.format(summary)
                 })
 
         # 3. 保留最近消息
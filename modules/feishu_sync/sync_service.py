@@ -7,6 +7,7 @@ import logging
 from datetime import datetime
 from typing import Dict, Optional
 
+from modules.storage_codec import storage_codec
 from .feishu_client import FeishuBitableClient
 from .field_mapper import FieldMapper
 from .sync_status import SyncStatusManager
@@ -17,6 +18,9 @@ logger = logging.getLogger(__name__)
 class FeishuSyncService:
     """飞书多维表格同步服务"""
 
+    # 会话查询字段：嵌入 session_messages 消息行（仅在已执行 create_session_messages_table.sql 时使用）
+    SESSION_COLUMNS = '*, session_messages(seq, role, content, created_at)'
+
     def __init__(self):
         self.client = FeishuBitableClient()
         self.mapper = FieldMapper()
@@ -32,6 +36,8 @@ class FeishuSyncService:
             'redeem_codes': os.getenv('FEISHU_TABLE_REDEEM_CODES', ''),
             'admin_logs': os.getenv('FEISHU_TABLE_ADMIN_LOGS', ''),
         }
+        # Supabase 是否已有 session_messages 表（首次查询会话时检测）
+        self._use_message_table = None
 
     def is_enabled(self) -> bool:
         """检查飞书同步是否启用"""
@@ -43,6 +49,42 @@ class FeishuSyncService:
         )
         return enabled and has_config
 
+    def _session_columns(self, supabase) -> str:
+        """会话查询字段：有 session_messages 表时嵌入消息行，否则只查会话行（读旧的 messages 数组）"""
+        if self._use_message_table is None:
+            try:
+                supabase.table('session_messages').select('session_id').limit(1).execute()
+                self._use_message_table = True
+            except Exception as e:
+                # 只有 Supabase 明确拒绝（表不存在）才记住结果，连接故障照常抛出
+                if type(e).__name__ != 'APIError':
+                    raise
+                logger.warning(f"Supabase session_messages 表不可用，按旧的 messages 数组同步: {e}")
+                self._use_message_table = False
+        return self.SESSION_COLUMNS if self._use_message_table else '*'
+
+    @staticmethod
+    def _session_messages(session: Dict) -> list:
+        """取出会话消息：优先 session_messages 消息行，兼容旧的 messages 数组"""
+        rows = session.pop('session_messages', None)
+        if rows:
+            return [
+                {
+                    'role': r.get('role'),
+                    'content': storage_codec.decode(r.get('content')) or '',
+                    'timestamp': r.get('created_at')
+                }
+                for r in sorted(rows, key=lambda r: r.get('seq', 0))
+            ]
+
+        messages = session.get('messages', [])
+        if isinstance(messages, str):
+            try:
+                messages = json.loads(messages)
+            except:
+                messages = []
+        return messages
+
     # ========================================
     # 实时同步（异步非阻塞）
     # ========================================
@@ -114,7 +156,7 @@ class FeishuSyncService:
 
             last_sync = self.status_manager.get_last_sync_time('sessions')
 
-            query = supabase.table('sessions').select('*')
+            query = supabase.table('sessions').select(self._session_columns(supabase))
             if last_sync:
                 query = query.gt('updated_at', last_sync)
             result = query.order('updated_at').limit(500).execute()
@@ -124,6 +166,7 @@ class FeishuSyncService:
 
             count = 0
             for session in result.data:
+                session['messages'] = self._session_messages(session)
                 fields = self.mapper.map_session(session)
                 try:
                     self.client.upsert_record(
@@ -165,7 +208,7 @@ class FeishuSyncService:
             last_sync = self.status_manager.get_last_sync_time('messages')
 
             # 查询更新过的 sessions
-            query = supabase.table('sessions').select('*')
+            query = supabase.table('sessions').select(self._session_columns(supabase))
             if last_sync:
                 query = query.gt('updated_at', last_sync)
             result = query.order('updated_at').limit(100).execute()
@@ -181,12 +224,7 @@ class FeishuSyncService:
             batch_records = []
 
             for session in result.data:
-                messages = session.get('messages', [])
-                if isinstance(messages, str):
-                    try:
-                        messages = json.loads(messages)
-                    except:
-                        messages = []
+                messages = self._session_messages(session)
 
                 if not messages or not isinstance(messages, list):
                     continue
@@ -398,7 +436,7 @@ class FeishuSyncService:
             logger.info(f"[飞书同步] 已加载 {len(profiles_by_id)} 个用户资料")
 
             # 2. 获取所有会话及其消息
-            result = supabase.table('sessions').select('*').execute()
+            result = supabase.table('sessions').select(self._session_columns(supabase)).execute()
 
             total_count = 0
             batch_records = []
@@ -406,12 +444,7 @@ class FeishuSyncService:
             table_record_count = self._get_table_record_count(current_table_id)
 
             for session in (result.data or []):
-                messages = session.get('messages', [])
-                if isinstance(messages, str):
-                    try:
-                        messages = json.loads(messages)
-                    except:
-                        messages = []
+                messages = self._session_messages(session)
 
                 if not messages or not isinstance(messages, list):
                     continue
@@ -0,0 +1,225 @@
+"""
+图片预处理 - 多模态对话上传的图片在发给 AI 服务商前先解码、缩小、重新编码、去重
+手机原图动辄几 MB，原样转发会让请求 JSON、上传到服务商的时间和服务商的处理耗时都变大；
+缩到 max_edge 以内再编码成 WebP（或 JPEG）通常只剩几十到一两百 KB，视觉模型的识别效果基本不变
+"""
+import base64
+import binascii
+import hashlib
+import io
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from config import Config
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:
+    # Pillow 已在 requirements.txt 中；未安装（如本地开发环境）时退化为只做去重
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+
+def _gevent_threadpool():
+    """gevent 打过补丁时返回 hub 的原生线程池（普通线程池在 gevent 下是协程，CPU 密集任务会卡住整个 worker）"""
+    try:
+        from gevent import monkey, get_hub
+    except ImportError:
+        return None
+    if not monkey.is_module_patched('threading'):
+        return None
+    return get_hub().threadpool
+
+
+class ImagePreprocessor:
+    """
+    图片预处理
+
+    - 同一请求里内容完全相同的图片（解码后字节的 SHA-256 相同）只保留第一张
+    - 解码后按 EXIF 方向摆正，最长边缩到 max_edge 以内，去掉 EXIF 后编码成 fmt（webp / jpeg）
+    - 结果没有变小且不需要缩小时保留原图；动图、超过 max_pixels 像素或无法解码的图片原样转发
+    - 解码 / 缩放 / 编码在线程池里执行（gevent 下用 hub 的原生线程池），不阻塞 gevent 协程和 asyncio 事件循环；
+      未安装 Pillow 时只做去重
+    """
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        max_edge: int = 1536,
+        fmt: str = 'webp',
+        quality: int = 80,
+        workers: int = 2,
+        max_pixels: int = 50_000_000
+    ):
+        self.enabled = enabled
+        self.max_edge = max_edge
+        self.quality = quality
+        self.workers = workers
+        self.max_pixels = max_pixels
+        if Image is None:
+            if enabled:
+                print("⚠️ 未安装 Pillow（pip install -r requirements.txt），图片预处理只做去重，不缩放")
+            self.format = None
+        elif fmt == 'webp' and not features.check('webp'):
+            print("⚠️ Pillow 不支持 WebP，图片预处理改用 JPEG")
+            self.format = 'jpeg'
+        else:
+            self.format = fmt
+        self._executor = None
+        self._lock = threading.Lock()
+        self._stats = {'requests': 0, 'images_in': 0, 'images_out': 0, 'duplicates': 0, 'resized': 0,
+                       'reencoded': 0, 'kept': 0, 'failed': 0, 'bytes_in': 0, 'bytes_out': 0,
+                       'seconds': 0.0, 'max_seconds': 0.0}
+
+    # ========================================
+    # 单张图片
+    # ========================================
+
+    @staticmethod
+    def _decode_data_url(image: str) -> Optional[bytes]:
+        """data URL 或裸 base64 → 图片字节；不是合法 base64 时返回 None"""
+        data = image.split(',', 1)[1] if image.startswith('data:') and ',' in image else image
+        try:
+            return base64.b64decode(data, validate=False)
+        except (binascii.Error, ValueError):
+            return None
+
+    def _transcode(self, raw: bytes) -> Tuple[Optional[bytes], bool]:
+        """缩放并重新编码，返回 (新图片字节, 是否缩小了)；应保留原图时返回 (None, False)"""
+        with Image.open(io.BytesIO(raw)) as img:
+            if getattr(img, 'n_frames', 1) > 1 or img.width * img.height > self.max_pixels:
+                return None, False
+            resized = max(img.size) > self.max_edge
+            # JPEG 解码时直接按 1/2、1/4、1/8 缩小（draft），大图省掉大部分解码时间
+            img.draft('RGB', (self.max_edge, self.max_edge))
+            out = ImageOps.exif_transpose(img)
+            if resized:
+                out.thumbnail((self.max_edge, self.max_edge), Image.LANCZOS)
+            if out.mode not in ('RGB', 'RGBA') or (self.format == 'jpeg' and out.mode == 'RGBA'):
+                alpha = out.mode in ('RGBA', 'LA', 'PA') or 'transparency' in out.info
+                out = out.convert('RGBA' if alpha else 'RGB')
+                if alpha and self.format == 'jpeg':
+                    # JPEG 没有透明通道，透明部分铺白底
+                    background = Image.new('RGB', out.size, (255, 255, 255))
+                    background.paste(out, mask=out.getchannel('A'))
+                    out = background
+            buffer = io.BytesIO()
+            out.save(buffer, 'WEBP' if self.format == 'webp' else 'JPEG', quality=self.quality,
+                     **({'method': 4} if self.format == 'webp' else {'optimize': True}))
+        encoded = buffer.getvalue()
+        if not resized and len(encoded) >= len(raw):
+            return None, False
+        return encoded, resized
+
+    def _process_one(self, image: str, raw: bytes) -> Tuple[str, str]:
+        """处理一张图片，返回 (data URL, 结果：resized / reencoded / kept / failed)"""
+        try:
+            encoded, resized = self._transcode(raw)
+        except Exception as e:
+            logger.warning(f"图片预处理失败，原图转发: {e}")
+            return image, 'failed'
+        if encoded is None:
+            return image, 'kept'
+        data_url = f"data:image/{self.format};base64,{base64.b64encode(encoded).decode('ascii')}"
+        return data_url, 'resized' if resized else 'reencoded'
+
+    # ========================================
+    # 整个请求
+    # ========================================
+
+    def _run(self, jobs: List[Tuple[str, bytes]]) -> List[Tuple[str, str]]:
+        if self.format is None:
+            return [(image, 'kept') for image, _ in jobs]
+        pool = _gevent_threadpool()
+        if pool is not None:
+            results = [pool.spawn(self._process_one, image, raw) for image, raw in jobs]
+            return [result.get() for result in results]
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='image')
+        return list(self._executor.map(lambda job: self._process_one(*job), jobs))
+
+    def process(self, images: List[str]) -> Tuple[List[str], Dict]:
+        """
+        预处理一个请求的全部图片，返回 (处理后的图片列表, 本次统计)
+
+        本次统计：图片数（前 / 后）、去重数、字节数（前 / 后，按 base64 文本计）、耗时
+        """
+        if not self.enabled or not images:
+            return images, {}
+        started = time.monotonic()
+        seen = set()
+        jobs = []
+        duplicates = 0
+        bytes_in = 0
+        for image in images:
+            if not isinstance(image, str) or not image:
+                continue
+            bytes_in += len(image)
+            raw = self._decode_data_url(image)
+            if raw is None:
+                jobs.append((image, b''))
+                continue
+            digest = hashlib.sha256(raw).digest()
+            if digest in seen:
+                duplicates += 1
+                continue
+            seen.add(digest)
+            jobs.append((image, raw))
+
+        results = self._run(jobs) if jobs else []
+        processed = [image for image, _ in results]
+        elapsed = time.monotonic() - started
+        report = {
+            'images_in': len(images),
+            'images_out': len(processed),
+            'duplicates': duplicates,
+            'bytes_in': bytes_in,
+            'bytes_out': sum(len(image) for image in processed),
+            'ms': round(elapsed * 1000, 1)
+        }
+        with self._lock:
+            stats = self._stats
+            stats['requests'] += 1
+            stats['images_in'] += report['images_in']
+            stats['images_out'] += report['images_out']
+            stats['duplicates'] += duplicates
+            for _, outcome in results:
+                stats[outcome] += 1
+            stats['bytes_in'] += report['bytes_in']
+            stats['bytes_out'] += report['bytes_out']
+            stats['seconds'] += elapsed
+            stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+        logger.info(
+            f"[图片预处理] {report['images_in']} 张 → {report['images_out']} 张（去重 {duplicates}），"
+            f"{report['bytes_in'] / 1024:.0f}KB → {report['bytes_out'] / 1024:.0f}KB，耗时 {report['ms']}ms"
+        )
+        return processed, report
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+        seconds = stats.pop('seconds')
+        stats['saved_bytes'] = stats['bytes_in'] - stats['bytes_out']
+        stats['saved_ratio'] = round(stats['saved_bytes'] / stats['bytes_in'], 4) if stats['bytes_in'] else 0.0
+        stats['avg_ms'] = round(seconds / stats['requests'] * 1000, 1) if stats['requests'] else 0.0
+        stats['max_ms'] = round(stats.pop('max_seconds') * 1000, 1)
+        stats['enabled'] = self.enabled
+        stats['format'] = self.format or 'none'
+        stats['max_edge'] = self.max_edge
+        return stats
+
+
+# 单例实例
+image_preprocessor = ImagePreprocessor(
+    enabled=Config.IMAGE_PREPROCESS_ENABLED,
+    max_edge=Config.IMAGE_MAX_EDGE,
+    fmt=Config.IMAGE_FORMAT,
+    quality=Config.IMAGE_QUALITY,
+    workers=Config.IMAGE_PREPROCESS_WORKERS
+)
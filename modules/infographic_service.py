@@ -2,10 +2,14 @@
 信息图生成服务 - 使用 Gemini Flash 分析聊天记录生成信息图
 """
 import os
-import requests
 import logging
 from typing import List, Dict, Optional
 from config import Config
+from modules.ai_cache import ai_cache
+from modules.ai_gateway import ai_gateway
+from modules.ai_ledger import ai_ledger, STATUS_OK, STATUS_ERROR, STATUS_REJECTED
+from modules.ai_profiles import ai_profiles, PROFILE_INFOGRAPHIC
+from modules.ai_scheduler import ai_scheduler, AISchedulerTimeout, PRIORITY_ANALYSIS
 
 # 配置日志
 logger = logging.getLogger(__name__)
@@ -19,8 +23,9 @@ class InfographicService:
         self.closeai_api_key = Config.CLOSEAI_API_KEY
         self.closeai_base_url = Config.CLOSEAI_BASE_URL
 
-        # 使用 Flash 模型（快速、便宜）
-        self.model = 'gemini-2.0-flash'  # 更稳定的模型
+        # 使用 Flash 模型（快速、便宜），生成参数见 infographic 配置档
+        self.profile = ai_profiles[PROFILE_INFOGRAPHIC]
+        self.model = self.profile.model_name()
 
     def _get_api_config(self):
         """获取 API 配置"""
@@ -142,36 +147,41 @@ class InfographicService:
         """调用 AI API"""
         import json
 
-        headers = {
-            'Authorization': f'Bearer {api_key}',
-            'Content-Type': 'application/json'
-        }
-
-        payload = {
+        payload = self.profile.apply({
             'model': self.model,
             'messages': [
                 {'role': 'user', 'content': prompt}
-            ],
-            'temperature': 0.3,
-            'max_tokens': 2000
-        }
+            ]
+        })
+
+        # 同一段对话重复生成信息图时复用上次的分析结果
+        cache_key = ai_cache.key(payload['model'], payload['messages'], payload['temperature'], payload['max_tokens'])
+        cached = ai_cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"信息图 AI 分析命中缓存 [{self.model}]")
+            try:
+                return json.loads(cached)
+            except json.JSONDecodeError:
+                pass
 
         logger.info(f"信息图 AI 请求 [{self.model}] 发起中...")
 
+        record = ai_ledger.begin(self.profile, self.model, PRIORITY_ANALYSIS)
         try:
-            response = requests.post(
-                f'{base_url}/chat/completions',
-                headers=headers,
-                json=payload,
-                timeout=60
-            )
+            with ai_scheduler.slot(PRIORITY_ANALYSIS):
+                record.attempt(ai_ledger.provider_name(base_url))
+                response = ai_gateway.post(base_url, api_key, payload, timeout=self.profile.timeout or 60)
 
             logger.info(f"信息图 AI 响应状态: {response.status_code}")
 
             if response.status_code == 200:
                 data = response.json()
-                content = data['choices'][0]['message']['content']
+                choice = data['choices'][0]
+                content = choice['message']['content']
                 logger.info(f"信息图 AI 响应成功，长度: {len(content)}")
+                # 非流式请求整个响应一起到达，首字耗时即请求耗时
+                record.first_token(record.provider)
+                record.finish(STATUS_OK, payload, content, data.get('usage'), choice.get('finish_reason'))
 
                 # 提取 JSON
                 # 尝试找到 JSON 块
@@ -184,16 +194,27 @@ class InfographicService:
                     end = content.find('```', start)
                     content = content[start:end].strip()
 
-                return json.loads(content)
+                analysis = json.loads(content)
+                # 解析成功才缓存（缓存提取出的 JSON 文本）
+                ai_cache.put(cache_key, content, self.model)
+                return analysis
             else:
                 logger.error(f"信息图 API 错误: {response.status_code} - {response.text[:500]}")
+                record.finish(STATUS_ERROR, payload)
                 return None
 
         except json.JSONDecodeError as e:
             logger.error(f"信息图 JSON 解析错误: {e}")
+            # 响应体不是 JSON 时还没有记账；提取的内容解析失败时已记过，这里不会重复记
+            record.finish(STATUS_ERROR, payload)
+            return None
+        except AISchedulerTimeout as e:
+            logger.error(f"信息图 API 调用错误: {e}")
+            record.finish(STATUS_REJECTED)
             return None
         except Exception as e:
             logger.error(f"信息图 API 调用错误: {e}")
+            record.finish(STATUS_ERROR, payload)
             return None
 
     def _generate_html_infographic(self, analysis: Dict, module_info: Dict) -> str:
@@ -3,9 +3,15 @@
 """
 import json
 import re
+import threading
 from typing import Dict, Optional, List
 from datetime import datetime
 
+from config import Config
+from modules.ai_profiles import PROFILE_EXTRACTION
+from modules.ai_scheduler import ai_scheduler, PRIORITY_BACKGROUND
+from modules.token_budget import context_budget
+
 
 class MemoryService:
     """用户记忆管理服务"""
@@ -28,9 +34,16 @@ class MemoryService:
     "key_challenges": ["用户提到的核心痛点或挑战"]
 }}"""
 
-    def __init__(self):
+    def __init__(self, workers: int = 2, queue_size: int = 200):
         self.client = None
         self.ai_service = None
+        self.workers = workers
+        self.queue_size = queue_size
+        # 待提取的 user_id -> 最新对话（按加入顺序执行）
+        self._queued: Dict[str, List[Dict]] = {}
+        self._cond = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self._stats = {'submitted': 0, 'coalesced': 0, 'dropped': 0, 'done': 0, 'failed': 0}
         self._init_client()
 
     def _init_client(self):
@@ -114,20 +127,11 @@ class MemoryService:
         if not messages:
             return {}
 
-        # 拼接对话内容（限制长度避免 token 过多）
-        conversation_parts = []
-        total_len = 0
-        max_len = 4000  # 限制最大长度
-
-        for msg in messages[-20:]:  # 只取最近 20 条消息
-            role = '用户' if msg.get('role') == 'user' else 'AI'
-            content = msg.get('content', '')[:500]  # 每条消息限制 500 字
-            line = f"{role}: {content}"
-
-            if total_len + len(line) > max_len:
-                break
-            conversation_parts.append(line)
-            total_len += len(line)
+        # 拼接对话内容（限制长度避免 token 过多）：最近 20 条，每条最多 500 token，总共最多 4000 token
+        conversation_parts = context_budget.start(4000).take_recent('history', [
+            f"{'用户' if msg.get('role') == 'user' else 'AI'}: {msg.get('content', '')}"
+            for msg in messages[-20:]
+        ], item_limit=500)
 
         conversation = '\n'.join(conversation_parts)
 
@@ -154,12 +158,14 @@ class MemoryService:
         prompt = self.EXTRACT_PROMPT.format(conversation=conversation)
 
         try:
-            # 调用 AI（使用快速模型）
-            response = self.ai_service.chat(
-                messages=[{'role': 'user', 'content': prompt}],
-                system_prompt="你是一个信息提取助手，只返回 JSON 格式的结果，不要其他内容。",
-                model='flash'  # 使用快速模型节省成本
-            )
+            # 调用 AI（使用快速模型，后台优先级：配额紧张时给用户对话让路）
+            with ai_scheduler.slot(PRIORITY_BACKGROUND):
+                response = self.ai_service.chat(
+                    messages=[{'role': 'user', 'content': prompt}],
+                    system_prompt="你是一个信息提取助手，只返回 JSON 格式的结果，不要其他内容。",
+                    profile=PROFILE_EXTRACTION,  # 快速模型、几百 token 的生成上限
+                    cacheable=True  # 同一段对话重复提取时直接复用结果
+                )
 
             # 解析 JSON
             # 尝试从响应中提取 JSON
@@ -273,6 +279,53 @@ class MemoryService:
         # 更新记忆
         return self.update_memory(user_id, extracted)
 
+    def submit_extraction(self, user_id: str, messages: List[Dict]) -> bool:
+        """
+        后台提取用户画像（不阻塞调用方）
+
+        固定 workers 个线程执行（AI 提取再按 background 优先级排队，见 ai_scheduler）；
+        同一用户还在排队时只保留最新的对话；排队满 queue_size 个用户时丢弃，返回 False
+        """
+        if not user_id or not messages:
+            return False
+        with self._cond:
+            self._stats['submitted'] += 1
+            if user_id in self._queued:
+                self._stats['coalesced'] += 1
+            elif len(self._queued) >= self.queue_size:
+                self._stats['dropped'] += 1
+                return False
+            self._queued[user_id] = messages
+            if len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._extraction_worker, daemon=True)
+                self._threads.append(thread)
+                thread.start()
+            self._cond.notify()
+        return True
+
+    def _extraction_worker(self):
+        while True:
+            with self._cond:
+                while not self._queued:
+                    self._cond.wait()
+                user_id = next(iter(self._queued))
+                messages = self._queued.pop(user_id)
+            try:
+                self.extract_and_update(user_id, messages)
+                key = 'done'
+            except Exception as e:
+                print(f"⚠️ 用户画像提取失败: {e}")
+                key = 'failed'
+            with self._cond:
+                self._stats[key] += 1
+
+    def extraction_stats(self) -> Dict:
+        with self._cond:
+            stats = dict(self._stats)
+            stats['queued'] = len(self._queued)
+            stats['workers'] = len(self._threads)
+        return stats
+
     def get_memory_context(self, user_id: str) -> str:
         """获取用于注入到系统提示词的记忆上下文"""
         memory = self.get_memory(user_id)
@@ -332,4 +385,4 @@ class MemoryService:
 
 
 # 单例实例
-memory_service = MemoryService()
+memory_service = MemoryService(Config.AI_SCHEDULER_BACKGROUND_CONCURRENCY, Config.MEMORY_EXTRACTION_QUEUE)
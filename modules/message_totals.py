@@ -0,0 +1,58 @@
+"""
+消息用量累计 - 按消息维护字符数 / 估算 token 数的前缀和
+消息只追加不修改，追加时 O(1) 更新；预算判断取末项 O(1)，截断窗口用二分查找
+"""
+from bisect import bisect_left
+from typing import Dict, List
+
+from modules.token_budget import MESSAGE_OVERHEAD_TOKENS, estimate_tokens
+
+
+class MessageTotals:
+    """
+    单个会话的消息用量前缀和
+
+    chars[i] / tokens[i] 为前 i 条消息的累计值（chars[0] = 0），
+    第 a 到 b-1 条消息的总量为 chars[b] - chars[a]；tokens 含每条消息的格式开销
+    """
+
+    __slots__ = ('chars', 'tokens')
+
+    def __init__(self):
+        self.chars = [0]
+        self.tokens = [0]
+
+    def __len__(self) -> int:
+        return len(self.chars) - 1
+
+    def append(self, content: str):
+        content = content or ''
+        self.chars.append(self.chars[-1] + len(content))
+        self.tokens.append(self.tokens[-1] + estimate_tokens(content) + MESSAGE_OVERHEAD_TOKENS)
+
+    def sync(self, messages: List[Dict]) -> 'MessageTotals':
+        """与消息列表对齐：只补算新增的尾部消息；条数对不上（不应发生）时整体重算"""
+        if len(self) > len(messages):
+            self.chars = [0]
+            self.tokens = [0]
+        for msg in messages[len(self):]:
+            self.append(msg.get('content'))
+        return self
+
+    @property
+    def total_chars(self) -> int:
+        return self.chars[-1]
+
+    @property
+    def total_tokens(self) -> int:
+        return self.tokens[-1]
+
+    def window_start(self, budget: int, lo: int = 0, by: str = 'chars') -> int:
+        """
+        最近消息窗口的起点：满足 sum(messages[start:]) <= budget 的最小 start（start >= lo）
+
+        等价于从最后一条往前逐条累加、放不下即停止的做法
+        """
+        prefix = self.chars if by == 'chars' else self.tokens
+        end = len(prefix) - 1
+        return bisect_left(prefix, prefix[end] - budget, lo, end)
@@ -5,6 +5,9 @@ from typing import Dict, List, Optional
 from datetime import datetime
 import json
 
+from config import Config
+from modules.token_budget import truncate_tokens
+
 
 class PromptService:
     """提示词管理服务"""
@@ -322,7 +325,7 @@ class PromptService:
             return False
 
     def get_knowledge_context(self, module_id: str) -> str:
-        """获取模块的知识库上下文（用于注入到提示词）"""
+        """获取模块的知识库上下文（用于注入到提示词，每个文件最多 AI_KNOWLEDGE_FILE_TOKENS 个 token）"""
         files = self.get_knowledge_files(module_id)
 
         if not files:
@@ -330,9 +333,7 @@ class PromptService:
 
         context = "\n## 参考知识库\n"
         for f in files:
-            content = f.get('content', '')
-            if len(content) > 2000:
-                content = content[:2000] + "...(内容已截断)"
+            content = truncate_tokens(f.get('content', ''), Config.AI_KNOWLEDGE_FILE_TOKENS, "...(内容已截断)")
             context += f"\n### {f.get('filename', '未知文件')}\n{content}\n"
 
         return context
@@ -0,0 +1,284 @@
+"""
+全文检索 - 基于 SQLite FTS5 的对话消息 / 调研记录搜索（管理后台使用）
+中文等 CJK 文本切成二元组（bigram）后交给 unicode61 分词器，无需 jieba 等额外依赖
+"""
+import re
+from typing import Dict, List, Optional, Tuple
+
+from modules.storage_codec import storage_codec
+
+# CJK 字符（中日韩统一表意文字、假名、谚文）
+_CJK = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff'
+_TOKEN_RE = re.compile(rf'(?P<cjk>[{_CJK}]+)|(?P<word>[^\W_{_CJK}]+)')
+
+SOURCE_MESSAGE = 'message'
+SOURCE_RESEARCH_NOTE = 'research_note'
+
+
+def _cjk_tokens(run: str, trailing_unigram: bool) -> List[str]:
+    """CJK 连续片段 -> 二元组；trailing_unigram 时补上末字单字（单字查询用前缀匹配命中）"""
+    if len(run) == 1:
+        return [run]
+    tokens = [run[i:i + 2] for i in range(len(run) - 1)]
+    if trailing_unigram:
+        tokens.append(run[-1])
+    return tokens
+
+
+def tokenize_for_index(text: str) -> str:
+    """索引用分词：CJK 片段切二元组并补末字，其余按词保留"""
+    tokens = []
+    for match in _TOKEN_RE.finditer(text or ''):
+        if match.group('cjk'):
+            tokens.extend(_cjk_tokens(match.group('cjk'), trailing_unigram=True))
+        else:
+            tokens.append(match.group('word'))
+    return ' '.join(tokens)
+
+
+def build_match_query(query: str) -> Optional[str]:
+    """
+    搜索词 -> FTS5 MATCH 表达式
+
+    每个空格分隔的词构成一个短语（相邻 token 必须连续，相当于子串匹配），多个词之间为 AND。
+    与索引使用同一套切分规则：片段在词尾时不补末字（索引中该位置可能接着别的字），
+    词尾为单个汉字或英文单词时按前缀匹配。
+    """
+    phrases = []
+    for term in (query or '').split():
+        matches = list(_TOKEN_RE.finditer(term))
+        if not matches:
+            continue
+        tokens = []
+        prefix = False
+        for i, match in enumerate(matches):
+            is_last = i == len(matches) - 1
+            if match.group('cjk'):
+                run = match.group('cjk')
+                tokens.extend(_cjk_tokens(run, trailing_unigram=not is_last))
+                prefix = is_last and len(run) == 1
+            else:
+                tokens.append(match.group('word'))
+                prefix = is_last
+        phrases.append('"' + ' '.join(tokens) + '"' + ('*' if prefix else ''))
+    return ' AND '.join(phrases) if phrases else None
+
+
+def make_snippet(content: str, query: str, width: int = 40) -> str:
+    """在原文中截取第一个命中词附近的片段"""
+    content = content or ''
+    lowered = content.lower()
+    position = -1
+    for term in (query or '').split():
+        position = lowered.find(term.lower())
+        if position >= 0:
+            break
+    if position < 0:
+        return content[:width * 2] + ('...' if len(content) > width * 2 else '')
+
+    start = max(0, position - width)
+    end = min(len(content), position + width)
+    return ('...' if start > 0 else '') + content[start:end] + ('...' if end < len(content) else '')
+
+
+class SearchIndex:
+    """
+    全文索引（存于本地 SQLite）
+
+    - search_docs 保存原文和元数据，search_fts 只存分词后的文本，rowid 与 search_docs.id 对应
+    - 写入消息 / 调研记录时增量索引；已有数据通过 scripts/rebuild_search_index.py 批量重建
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    @staticmethod
+    def create_tables(cursor):
+        """建表（由 Database._init_db 调用）"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS search_docs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                source TEXT NOT NULL,
+                ref_id TEXT NOT NULL,
+                role TEXT,
+                user_email TEXT,
+                content TEXT,
+                created_at TEXT
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_search_docs_ref ON search_docs(source, ref_id)')
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(
+                body,
+                tokenize = 'unicode61 remove_diacritics 2'
+            )
+        ''')
+
+    # ========================================
+    # 写入
+    # ========================================
+
+    def _insert_docs(self, conn, docs: List[Tuple]):
+        """docs: (source, ref_id, role, user_email, content, created_at)"""
+        for doc in docs:
+            cursor = conn.execute('''
+                INSERT INTO search_docs (source, ref_id, role, user_email, content, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', doc[:4] + (storage_codec.encode(doc[4]), doc[5]))
+            conn.execute(
+                'INSERT INTO search_fts (rowid, body) VALUES (?, ?)',
+                (cursor.lastrowid, tokenize_for_index(doc[4]))
+            )
+
+    def index_message(self, session_id: str, role: str, content: str, created_at: str):
+        """增量索引一条消息（失败不影响对话）"""
+        if not content:
+            return
+        try:
+            with self.db.connection() as conn:
+                self._insert_docs(conn, [(SOURCE_MESSAGE, session_id, role, None, content, created_at)])
+        except Exception as e:
+            print(f"⚠️ 消息写入搜索索引失败: {e}")
+
+    @staticmethod
+    def _note_text(note: Dict) -> str:
+        parts = [note.get('content'), note.get('notes'), note.get('file_name'), note.get('file_text_content')]
+        return '\n'.join(part for part in parts if part)
+
+    def index_research_note(self, note: Dict):
+        """增量索引一条调研记录（失败不影响保存）"""
+        text = self._note_text(note)
+        if not text:
+            return
+        try:
+            with self.db.connection() as conn:
+                self._insert_docs(conn, [(
+                    SOURCE_RESEARCH_NOTE, note['id'], note.get('category'),
+                    note.get('user_email'), text, note.get('created_at')
+                )])
+        except Exception as e:
+            print(f"⚠️ 调研记录写入搜索索引失败: {e}")
+
+    def remove(self, source: str, ref_id: str):
+        """删除某个会话 / 调研记录的全部索引"""
+        try:
+            with self.db.connection() as conn:
+                rows = conn.execute(
+                    'SELECT id FROM search_docs WHERE source = ? AND ref_id = ?', (source, ref_id)
+                ).fetchall()
+                conn.executemany('DELETE FROM search_fts WHERE rowid = ?', [(row['id'],) for row in rows])
+                conn.execute('DELETE FROM search_docs WHERE source = ? AND ref_id = ?', (source, ref_id))
+        except Exception as e:
+            print(f"⚠️ 删除搜索索引失败: {e}")
+
+    # ========================================
+    # 批量重建
+    # ========================================
+
+    def rebuild(self, batch_size: int = 200, progress=None) -> Dict:
+        """
+        从存储中重建全部索引
+
+        Args:
+            batch_size: 每批处理的会话数
+            progress: 可选回调 progress(已处理会话数, 已索引消息数)
+        """
+        with self.db.connection() as conn:
+            conn.execute('DELETE FROM search_fts')
+            conn.execute('DELETE FROM search_docs')
+
+        sessions_done = 0
+        messages_done = 0
+        cursor = None
+        while True:
+            page = self.db.browse_sessions(limit=batch_size, cursor=cursor)
+            sessions = page['sessions']
+            if not sessions:
+                break
+            messages_map = self.db.get_messages_for_sessions([s['id'] for s in sessions])
+            docs = [
+                (SOURCE_MESSAGE, session_id, msg.get('role'), None, msg.get('content'), msg.get('timestamp'))
+                for session_id, messages in messages_map.items()
+                for msg in messages
+                if msg.get('content')
+            ]
+            with self.db.connection() as conn:
+                self._insert_docs(conn, docs)
+
+            sessions_done += len(sessions)
+            messages_done += len(docs)
+            if progress:
+                progress(sessions_done, messages_done)
+            cursor = page['next_cursor']
+            if not cursor:
+                break
+
+        notes_done = 0
+        notes = self.db.get_all_research_notes()
+        with self.db.connection() as conn:
+            for note in notes:
+                text = self._note_text(note)
+                if text:
+                    self._insert_docs(conn, [(
+                        SOURCE_RESEARCH_NOTE, note['id'], note.get('category'),
+                        note.get('user_email'), text, note.get('created_at')
+                    )])
+                    notes_done += 1
+
+        with self.db.connection() as conn:
+            conn.execute("INSERT INTO search_fts (search_fts) VALUES ('optimize')")
+
+        return {'sessions': sessions_done, 'messages': messages_done, 'research_notes': notes_done}
+
+    # ========================================
+    # 查询
+    # ========================================
+
+    def search(self, query: str, source: str = None, limit: int = 20, cursor: int = None) -> Dict:
+        """
+        搜索（按 bm25 相关度排序，游标为下一页的起始位置）
+
+        Returns:
+            {'results': [...], 'next_cursor': int 或 None}
+        """
+        match = build_match_query(query)
+        if not match:
+            return {'results': [], 'next_cursor': None}
+
+        conditions = ['search_fts MATCH ?']
+        params = [match]
+        if source:
+            conditions.append('d.source = ?')
+            params.append(source)
+        offset = int(cursor or 0)
+
+        with self.db.connection() as conn:
+            rows = conn.execute(f'''
+                SELECT d.id, d.source, d.ref_id, d.role, d.user_email, d.content, d.created_at
+                FROM search_fts
+                JOIN search_docs d ON d.id = search_fts.rowid
+                WHERE {' AND '.join(conditions)}
+                ORDER BY search_fts.rank, d.id DESC
+                LIMIT ? OFFSET ?
+            ''', params + [limit + 1, offset]).fetchall()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = offset + limit
+
+        results = [{
+            'id': row['id'],
+            'source': row['source'],
+            'ref_id': row['ref_id'],
+            'role': row['role'],
+            'user_email': row['user_email'],
+            'created_at': row['created_at'],
+            'snippet': make_snippet(storage_codec.decode(row['content']), query)
+        } for row in rows]
+        return {'results': results, 'next_cursor': next_cursor}
+
+    def stats(self) -> Dict:
+        with self.db.connection() as conn:
+            rows = conn.execute('SELECT source, COUNT(*) AS cnt FROM search_docs GROUP BY source').fetchall()
+        return {row['source']: row['cnt'] for row in rows}
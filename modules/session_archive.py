@@ -0,0 +1,502 @@
+"""
+会话冷存储 - 长期未活跃的会话整体移出热表（Supabase / SQLite sessions），
+压缩后追加写入 data/archive/ 下的段文件
+
+- 段文件只追加：每条记录为 [魔数 4 字节][长度 4 字节][zlib 压缩的会话 JSON]，写满后换下一个文件
+- 本地库 session_archive 表记录 session_id -> (段文件, 偏移, 长度) 以及会话摘要（列表展示用）
+- 读取按索引定位解压；恢复（/resume）时整段写回热表并删除索引，段文件中的旧记录不再引用
+"""
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+from modules.storage_codec import storage_codec
+
+RECORD_MAGIC = b'KPA1'
+_HEADER = struct.Struct('>4sI')
+
+
+class SessionArchive:
+    """会话归档（后台线程定期归档，多个 worker 通过租约保证同一时刻只有一个在写段文件）"""
+
+    BATCH_SIZE = 100
+    SEGMENT_MAX_BYTES = 64 * 1024 * 1024
+    LEASE_NAME = 'session_archive'
+    LEASE_SECONDS = 600
+
+    # 索引中保存的摘要字段（与管理后台 / 用户会话列表的字段一致）
+    SUMMARY_FIELDS = (
+        'id', 'module', 'user_id', 'user_email', 'status', 'created_at', 'updated_at',
+        'message_count', 'preview', 'last_role', 'total_chars'
+    )
+
+    def __init__(self, db, archive_dir: str, idle_days: int = 0, interval: float = 3600):
+        self.db = db
+        self.archive_dir = archive_dir
+        self.idle_days = idle_days
+        self.interval = interval
+        self._is_started = False
+        self._stop_flag = False
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {'archived': 0, 'restored': 0, 'reads': 0, 'bytes_written': 0, 'last_run_at': None,
+                       'last_error': None}
+
+    @staticmethod
+    def create_tables(cursor):
+        """建表（由 Database._init_db 调用）"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS session_archive (
+                session_id TEXT PRIMARY KEY,
+                segment TEXT NOT NULL,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL,
+                user_id TEXT,
+                user_email TEXT,
+                updated_at TEXT,
+                summary TEXT,
+                archived_at TEXT
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_session_archive_user ON session_archive(user_id, updated_at)')
+
+    def _count(self, key: str, delta: int = 1):
+        with self._lock:
+            self._stats[key] += delta
+
+    # ========================================
+    # 段文件
+    # ========================================
+
+    def _current_segment(self, incoming: int) -> str:
+        """当前可追加的段文件名（写满则换下一个）"""
+        os.makedirs(self.archive_dir, exist_ok=True)
+        segments = sorted(name for name in os.listdir(self.archive_dir) if name.endswith('.seg'))
+        if segments:
+            last = segments[-1]
+            if os.path.getsize(os.path.join(self.archive_dir, last)) + incoming <= self.SEGMENT_MAX_BYTES:
+                return last
+            number = int(last.split('-')[1].split('.')[0]) + 1
+        else:
+            number = 1
+        return f'segment-{number:06d}.seg'
+
+    def _append_records(self, records: List[Dict]) -> List[tuple]:
+        """把一批会话记录追加到段文件，返回 [(session_id, segment, offset, length)]"""
+        blobs = [
+            (record['id'], zlib.compress(json.dumps(record, ensure_ascii=False, default=str).encode('utf-8'), 6))
+            for record in records
+        ]
+        segment = self._current_segment(sum(len(blob) + _HEADER.size for _, blob in blobs))
+        locations = []
+        with open(os.path.join(self.archive_dir, segment), 'ab') as f:
+            for session_id, blob in blobs:
+                f.write(_HEADER.pack(RECORD_MAGIC, len(blob)))
+                locations.append((session_id, segment, f.tell(), len(blob)))
+                f.write(blob)
+            f.flush()
+            os.fsync(f.fileno())
+        self._count('bytes_written', sum(length + _HEADER.size for _, _, _, length in locations))
+        return locations
+
+    def _read_record(self, segment: str, offset: int, length: int) -> Dict:
+        with open(os.path.join(self.archive_dir, segment), 'rb') as f:
+            f.seek(offset - _HEADER.size)
+            magic, stored_length = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != RECORD_MAGIC or stored_length != length:
+                raise ValueError(f'归档记录损坏: {segment}@{offset}')
+            return json.loads(zlib.decompress(f.read(length)).decode('utf-8'))
+
+    # ========================================
+    # 读取
+    # ========================================
+
+    def contains(self, session_id: str) -> bool:
+        with self.db.connection() as conn:
+            row = conn.execute('SELECT 1 FROM session_archive WHERE session_id = ?', (session_id,)).fetchone()
+        return row is not None
+
+    def load(self, session_id: str) -> Optional[Dict]:
+        """读取归档记录：{'id', 'backend', 'session': 会话行, 'messages': [...], 'archived_at'}"""
+        with self.db.connection() as conn:
+            row = conn.execute(
+                'SELECT segment, offset, length FROM session_archive WHERE session_id = ?', (session_id,)
+            ).fetchone()
+        if not row:
+            return None
+        try:
+            record = self._read_record(row['segment'], row['offset'], row['length'])
+        except Exception as e:
+            print(f"⚠️ 读取归档会话 {session_id} 失败: {e}")
+            return None
+        self._count('reads')
+        return record
+
+    def get_session(self, session_id: str) -> Optional[Dict]:
+        """以 Database.get_session 的格式返回归档会话（带 archived 标记）"""
+        record = self.load(session_id)
+        if not record:
+            return None
+        row = record['session']
+        return {
+            'id': row['id'],
+            'module': row.get('module'),
+            'user_id': row.get('user_id'),
+            'user_email': row.get('user_email'),
+            'status': row.get('status') or 'in_progress',
+            'collected_data': self.db._safe_json_loads(row.get('collected_data'), {})
+            if isinstance(row.get('collected_data'), str) else (row.get('collected_data') or {}),
+            'messages': record['messages'],
+            'output_document': row.get('output_document'),
+            'created_at': row.get('created_at'),
+            'updated_at': row.get('updated_at'),
+            'archived': True
+        }
+
+    def get_summaries(self, session_ids: List[str]) -> Dict[str, Dict]:
+        """按 id 批量取归档会话摘要"""
+        if not session_ids:
+            return {}
+        placeholders = ','.join('?' * len(session_ids))
+        with self.db.connection() as conn:
+            rows = conn.execute(
+                f'SELECT session_id, summary FROM session_archive WHERE session_id IN ({placeholders})',
+                list(session_ids)
+            ).fetchall()
+        return {row['session_id']: dict(json.loads(row['summary']), archived=True) for row in rows}
+
+    def list_user_sessions(self, user_id: str, limit: int) -> List[Dict]:
+        """某用户的归档会话摘要（按更新时间倒序）"""
+        with self.db.connection() as conn:
+            rows = conn.execute('''
+                SELECT summary FROM session_archive WHERE user_id = ?
+                ORDER BY updated_at DESC LIMIT ?
+            ''', (user_id, limit)).fetchall()
+        return [dict(json.loads(row['summary']), archived=True) for row in rows]
+
+    def get_messages(self, session_ids: List[str]) -> Dict[str, List[Dict]]:
+        """归档会话的完整消息"""
+        if not session_ids:
+            return {}
+        placeholders = ','.join('?' * len(session_ids))
+        with self.db.connection() as conn:
+            archived = [row['session_id'] for row in conn.execute(
+                f'SELECT session_id FROM session_archive WHERE session_id IN ({placeholders})', list(session_ids)
+            ).fetchall()]
+        result = {}
+        for session_id in archived:
+            record = self.load(session_id)
+            if record:
+                result[session_id] = record['messages']
+        return result
+
+    # ========================================
+    # 归档
+    # ========================================
+
+    def _candidates(self, remote_cutoff: str, local_cutoff: str, limit: int) -> List[tuple]:
+        """闲置超过期限的会话：[(backend, 会话行)]，有待补写记录的会话跳过"""
+        candidates = []
+        if self.db._supabase_available():
+            try:
+                result = self.db.supabase.table('sessions').select('*') \
+                    .lt('updated_at', remote_cutoff).order('updated_at').limit(limit).execute()
+                self.db._supabase_ok()
+                candidates.extend(('supabase', row) for row in (result.data or []))
+            except Exception as e:
+                self.db._supabase_failed(e)
+                print(f"Supabase 查询待归档会话失败: {e}")
+                return []
+
+        # 只存在于本地的会话（未启用 Supabase 时即全部本地会话）
+        local_only = 'AND synced_at IS NULL' if self.db.use_supabase else ''
+        with self.db.connection() as conn:
+            rows = conn.execute(f'''
+                SELECT * FROM sessions WHERE updated_at < ? {local_only}
+                ORDER BY updated_at LIMIT ?
+            ''', (local_cutoff, limit)).fetchall()
+            candidates.extend(('sqlite', dict(row)) for row in rows)
+
+            ids = [row['id'] for _, row in candidates]
+            if not ids:
+                return []
+            pending = {row['record_key'] for row in conn.execute(f'''
+                SELECT DISTINCT record_key FROM sync_outbox
+                WHERE status = 'pending' AND record_key IN ({','.join('?' * len(ids))})
+            ''', ids).fetchall()}
+        return [(backend, row) for backend, row in candidates if row['id'] not in pending]
+
+    def archive_once(self, idle_days: int = None, limit: int = None) -> int:
+        """归档一批闲置会话，返回归档条数"""
+        idle_days = idle_days or self.idle_days
+        if not idle_days or idle_days <= 0:
+            return 0
+        if not self.db.outbox.acquire_lease(self.LEASE_NAME, self.LEASE_SECONDS):
+            return 0
+
+        try:
+            # Supabase 的 updated_at 是 timestamptz，用带时区的 UTC 时间比较；本地库沿用本地时间格式
+            remote_cutoff = (datetime.now(timezone.utc) - timedelta(days=idle_days)).isoformat()
+            local_cutoff = (datetime.now() - timedelta(days=idle_days)).strftime('%Y-%m-%d %H:%M:%S')
+            candidates = self._candidates(remote_cutoff, local_cutoff, limit or self.BATCH_SIZE)
+            if not candidates:
+                return 0
+
+            messages_map = self._fetch_messages(candidates)
+            if messages_map is None:
+                return 0
+            now = datetime.now().isoformat()
+            records = []
+            for backend, row in candidates:
+                # 读到的消息条数与摘要列不一致的不归档（宁可留在热表，也不把缺消息的快照写进段文件后删掉原会话）；
+                # 没有摘要列时至少要读到消息
+                messages = messages_map.get(row['id'], [])
+                expected = row.get('message_count')
+                if (len(messages) != expected) if expected is not None else not messages:
+                    print(f"⚠️ 会话 {row['id']} 读到 {len(messages)} 条消息，与摘要 {expected} 不符，跳过归档")
+                    continue
+                row = {key: value for key, value in row.items() if key not in ('messages', 'session_messages')}
+                row['output_document'] = storage_codec.decode(row.get('output_document'))
+                records.append({
+                    'id': row['id'],
+                    'backend': backend,
+                    'session': row,
+                    'messages': messages,
+                    'archived_at': now
+                })
+            if not records:
+                return 0
+
+            locations = self._append_records(records)
+            with self.db.connection() as conn:
+                conn.executemany('''
+                    INSERT OR REPLACE INTO session_archive
+                    (session_id, segment, offset, length, user_id, user_email, updated_at, summary, archived_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', [
+                    (session_id, segment, offset, length, record['session'].get('user_id'),
+                     record['session'].get('user_email'), record['session'].get('updated_at'),
+                     json.dumps(self._summary(record), ensure_ascii=False, default=str), now)
+                    for (session_id, segment, offset, length), record in zip(locations, records)
+                ])
+
+            # 删除时重新检查闲置条件：快照之后又有新消息的会话留在热表，其索引随后删除
+            deleted = []
+            try:
+                deleted.extend(self._delete_hot(
+                    [record for record in records if record['backend'] == 'supabase'], remote_cutoff, remote=True
+                ))
+                deleted.extend(self._delete_hot(
+                    [record for record in records if record['backend'] == 'sqlite'], local_cutoff, remote=False
+                ))
+            finally:
+                survived = [record['id'] for record in records if record['id'] not in set(deleted)]
+                if survived:
+                    with self.db.connection() as conn:
+                        conn.execute(
+                            f'DELETE FROM session_archive WHERE session_id IN ({",".join("?" * len(survived))})',
+                            survived
+                        )
+            self._count('archived', len(deleted))
+            return len(deleted)
+        finally:
+            self.db.outbox.release_lease(self.LEASE_NAME)
+            with self._lock:
+                self._stats['last_run_at'] = datetime.now().isoformat()
+
+    def _fetch_messages(self, candidates: List[tuple]) -> Optional[Dict[str, List[Dict]]]:
+        """
+        按会话所在后端读取待归档会话的消息；Supabase 不可用或读取出错时返回 None（整批放弃）
+
+        不走 get_messages_for_sessions：它在 Supabase 出错时回退到 SQLite，只在 Supabase 的会话会读到空列表
+        """
+        remote_ids = [row['id'] for backend, row in candidates if backend == 'supabase']
+        local_ids = [row['id'] for backend, row in candidates if backend == 'sqlite']
+        messages_map = {}
+        if remote_ids:
+            if not self.db._supabase_available():
+                return None
+            try:
+                messages_map.update(self.db._fetch_remote_messages(remote_ids))
+                self.db._supabase_ok()
+            except Exception as e:
+                self.db._supabase_failed(e)
+                print(f"Supabase 读取待归档会话消息失败，本批不归档: {e}")
+                return None
+        with self.db.connection() as conn:
+            messages_map.update(self.db._load_local_messages(conn.cursor(), local_ids))
+        return messages_map
+
+    def _summary(self, record: Dict) -> Dict:
+        summary = dict(record['session'], **self.db._summarize_messages(record['messages']))
+        summary = {field: summary.get(field) for field in self.SUMMARY_FIELDS}
+        return self.db._session_summary(summary)
+
+    def _delete_hot(self, records: List[Dict], cutoff: str, remote: bool) -> List[str]:
+        """
+        从热表删除已归档且仍闲置（updated_at < cutoff）的会话，返回实际删除的 id
+
+        Supabase 的 session_messages 随会话级联删除，本地已补写的副本一并删除
+        """
+        ids = [record['id'] for record in records]
+        if not ids:
+            return []
+        if remote:
+            # 熔断中不删远端会话（本批索引随后删除，下次重新归档）
+            if not self.db._supabase_available():
+                return []
+            try:
+                result = self.db.supabase.table('sessions').delete().in_('id', ids).lt('updated_at', cutoff).execute()
+                self.db._supabase_ok()
+            except Exception as e:
+                self.db._supabase_failed(e)
+                raise
+            deleted = [row['id'] for row in (result.data or [])]
+            self._delete_local(deleted)
+        else:
+            deleted = self._delete_local(ids, cutoff)
+        for session_id in deleted:
+            self.db.session_cache.invalidate(session_id)
+            self.db._forget_backend(session_id)
+        return deleted
+
+    def _delete_local(self, ids: List[str], cutoff: str = None) -> List[str]:
+        """删除本地会话及其消息（传 cutoff 时只删仍闲置的），返回实际删除的 id"""
+        if not ids:
+            return []
+        condition = ' AND updated_at < ?' if cutoff else ''
+        with self.db.connection(immediate=True) as conn:
+            deleted = [row['id'] for row in conn.execute(
+                f'DELETE FROM sessions WHERE id IN ({",".join("?" * len(ids))}){condition} RETURNING id',
+                ids + ([cutoff] if cutoff else [])
+            ).fetchall()]
+            if deleted:
+                conn.execute(
+                    f'DELETE FROM session_messages WHERE session_id IN ({",".join("?" * len(deleted))})', deleted
+                )
+        return deleted
+
+    # ========================================
+    # 恢复
+    # ========================================
+
+    def restore(self, session_id: str) -> bool:
+        """把归档会话写回热表（Supabase 会话需 Supabase 可用），成功后删除索引"""
+        record = self.load(session_id)
+        if not record:
+            return False
+
+        if record['backend'] == 'supabase':
+            if not self.db._supabase_available():
+                return False
+            try:
+                self._restore_to_supabase(record)
+                self.db._supabase_ok()
+            except Exception as e:
+                self.db._supabase_failed(e)
+                print(f"Supabase 恢复归档会话失败: {e}")
+                return False
+            self.db._remember_backend(session_id, 'supabase')
+        else:
+            self._restore_to_sqlite(record)
+
+        with self.db.connection() as conn:
+            conn.execute('DELETE FROM session_archive WHERE session_id = ?', (session_id,))
+        self.db.session_cache.invalidate(session_id)
+        self._count('restored')
+        return True
+
+    def _restore_to_supabase(self, record: Dict):
+        row = dict(record['session'], output_document=self.db._supabase_text(record['session'].get('output_document')))
+        messages = record['messages']
+        # 会话行仍在热表时（如归档时删除失败）保留现有行，不用快照覆盖
+        if not self.db.use_message_table:
+            self.db.supabase.table('sessions').upsert(
+                dict(row, messages=messages), on_conflict='id', ignore_duplicates=True
+            ).execute()
+            return
+
+        if self.db.use_summary_columns:
+            # 新插入的会话行摘要列由插入消息的触发器重新累加
+            row.update(message_count=0, preview='', last_role=None, total_chars=0)
+        self.db.supabase.table('sessions').upsert(
+            dict(row, messages=[]), on_conflict='id', ignore_duplicates=True
+        ).execute()
+        for start in range(0, len(messages), self.db.MESSAGE_PAGE_SIZE):
+            self.db.supabase.table('session_messages').upsert([
+                dict(self.db._supabase_message(self.db._encoded_message(
+                    row['id'], msg.get('role', 'user'), msg.get('content', ''), msg.get('timestamp')
+                )), seq=start + i)
+                for i, msg in enumerate(messages[start:start + self.db.MESSAGE_PAGE_SIZE])
+            ], on_conflict='session_id,seq', ignore_duplicates=True).execute()
+
+    def _restore_to_sqlite(self, record: Dict):
+        row = dict(record['session'], output_document=storage_codec.encode(record['session'].get('output_document')))
+        with self.db.connection() as conn:
+            columns = [col[1] for col in conn.execute('PRAGMA table_info(sessions)').fetchall()]
+            row = {key: value for key, value in row.items() if key in columns}
+            # 会话行仍在热表时保留现有行（摘要列与消息一致），不用快照覆盖
+            conn.execute(
+                f'INSERT OR IGNORE INTO sessions ({", ".join(row)}) VALUES ({", ".join("?" * len(row))})',
+                list(row.values())
+            )
+            records = [
+                self.db._encoded_message(row['id'], msg.get('role', 'user'), msg.get('content', ''), msg.get('timestamp'))
+                for msg in record['messages']
+            ]
+            conn.executemany('''
+                INSERT OR IGNORE INTO session_messages
+                (session_id, seq, role, content, created_at, content_chars, content_preview)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', [
+                (r['session_id'], seq, r['role'], r['content'], r['created_at'],
+                 r.get('content_chars'), r.get('content_preview'))
+                for seq, r in enumerate(records)
+            ])
+
+    # ========================================
+    # 后台线程
+    # ========================================
+
+    def _run(self):
+        while not self._stop_flag:
+            try:
+                archived = self.archive_once()
+            except Exception as e:
+                print(f"⚠️ 会话归档线程错误: {e}")
+                with self._lock:
+                    self._stats['last_error'] = str(e)
+                archived = 0
+            # 整批归档满说明还有积压，稍后继续
+            time.sleep(60 if archived >= self.BATCH_SIZE else self.interval)
+
+    def start(self):
+        """启动归档线程（未配置闲置天数时不启动）"""
+        if self._is_started or not self.idle_days or self.idle_days <= 0:
+            return
+        with self._lock:
+            if self._is_started:
+                return
+            self._is_started = True
+        self._stop_flag = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_flag = True
+        self._is_started = False
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+        with self.db.connection() as conn:
+            row = conn.execute('SELECT COUNT(*) AS cnt FROM session_archive').fetchone()
+        stats['archived_total'] = row['cnt']
+        stats['idle_days'] = self.idle_days
+        stats['running'] = self._is_started
+        return stats
@@ -0,0 +1,132 @@
+"""
+会话缓存 - 减少同一次请求内对同一会话的重复读取
+两层：请求级缓存（请求结束即清空）+ 可选的短 TTL 进程内 LRU
+"""
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+
+class SessionCache:
+    """
+    会话读取缓存
+
+    - 请求级缓存：before_request 开启、teardown_request 关闭，gevent 下按协程隔离
+    - LRU：max_size > 0 时启用，条目 ttl 秒后过期（多 worker 之间不共享，TTL 应保持很短）
+    - 写入走 write-through：add_message 等写操作直接更新缓存中的副本
+    """
+
+    def __init__(self, max_size: int = 0, ttl: float = 5.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._local = threading.local()
+        self._lru: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'request_hits': 0, 'lru_hits': 0, 'misses': 0}
+
+    @staticmethod
+    def _copy(session: Dict) -> Dict:
+        """返回副本，避免调用方修改缓存内容"""
+        copied = dict(session)
+        copied['messages'] = list(session.get('messages') or [])
+        copied['collected_data'] = dict(session.get('collected_data') or {})
+        return copied
+
+    def _count(self, key: str):
+        with self._lock:
+            self._stats[key] += 1
+
+    # ========================================
+    # 请求级作用域
+    # ========================================
+
+    def begin_request(self):
+        self._local.scope = {}
+
+    def end_request(self):
+        self._local.scope = None
+
+    @contextmanager
+    def request_scope(self):
+        """在请求之外（后台任务等）手动开启一个缓存作用域"""
+        previous = getattr(self._local, 'scope', None)
+        self._local.scope = {} if previous is None else previous
+        try:
+            yield
+        finally:
+            self._local.scope = previous
+
+    def _scope(self) -> Optional[Dict]:
+        return getattr(self._local, 'scope', None)
+
+    # ========================================
+    # 读写
+    # ========================================
+
+    def get(self, session_id: str) -> Optional[Dict]:
+        scope = self._scope()
+        if scope is not None and session_id in scope:
+            self._count('request_hits')
+            return self._copy(scope[session_id])
+
+        if self.max_size > 0:
+            with self._lock:
+                entry = self._lru.get(session_id)
+                if entry and entry[0] > time.monotonic():
+                    self._lru.move_to_end(session_id)
+                    self._stats['lru_hits'] += 1
+                    session = entry[1]
+                else:
+                    session = None
+                    if entry:
+                        del self._lru[session_id]
+            if session is not None:
+                if scope is not None:
+                    scope[session_id] = session
+                return self._copy(session)
+
+        self._count('misses')
+        return None
+
+    def put(self, session_id: str, session: Dict):
+        session = self._copy(session)
+        scope = self._scope()
+        if scope is not None:
+            scope[session_id] = session
+
+        if self.max_size > 0:
+            with self._lock:
+                self._lru[session_id] = (time.monotonic() + self.ttl, session)
+                self._lru.move_to_end(session_id)
+                while len(self._lru) > self.max_size:
+                    self._lru.popitem(last=False)
+
+    def update(self, session_id: str, apply: Callable[[Dict], None]):
+        """write-through：对已缓存的会话副本应用修改（未缓存则忽略）"""
+        scope = self._scope()
+        if scope is not None and session_id in scope:
+            apply(scope[session_id])
+
+        if self.max_size > 0:
+            with self._lock:
+                entry = self._lru.get(session_id)
+                if entry and (scope is None or entry[1] is not scope.get(session_id)):
+                    apply(entry[1])
+
+    def invalidate(self, session_id: str):
+        scope = self._scope()
+        if scope is not None:
+            scope.pop(session_id, None)
+        if self.max_size > 0:
+            with self._lock:
+                self._lru.pop(session_id, None)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['lru_size'] = len(self._lru)
+        total = stats['request_hits'] + stats['lru_hits'] + stats['misses']
+        stats['hit_rate'] = round((stats['request_hits'] + stats['lru_hits']) / total, 4) if total else 0.0
+        return stats
@@ -0,0 +1,163 @@
+"""
+单飞请求 - 相同的昂贵调用（如管理后台的用户洞察 / 工具分析）同一时刻只执行一次
+领头的请求持有跨 worker 租约（sync_leases 表）执行调用，结果写入本地库；
+其余请求（本 worker 或其他 worker）等待并直接取用这份结果，不再重复生成
+"""
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+from modules.storage_codec import storage_codec
+
+
+class SingleFlightTimeout(Exception):
+    """等待领头请求的结果超时"""
+
+
+class SingleFlight:
+    """
+    跨 worker 的单飞执行
+
+    - do(key, fn)：拿到租约的请求执行 fn 并写入结果，其他请求轮询结果
+    - 领头请求失败时释放租约、不写结果，下一个等待者接手重新执行（失败通常是暂时的）
+    - 领头请求执行期间每 lease_seconds / 3 秒续期一次租约，执行再慢（排队 + 超时 + 切换服务商）也不会被接手；
+      领头的 worker 崩溃后租约最多 lease_seconds 秒过期
+    - 结果保留 result_ttl 秒，期间同一 key 的请求直接取用；since 用于强制刷新：只接受该时间之后生成的结果
+    """
+
+    LEASE_PREFIX = 'flight:'
+
+    def __init__(self, db, lease_seconds: float = 60, wait_seconds: float = 180,
+                 poll_interval: float = 0.5, result_ttl: float = 600):
+        self.db = db
+        self.lease_seconds = lease_seconds
+        self.wait_seconds = wait_seconds
+        self.poll_interval = poll_interval
+        self.result_ttl = result_ttl
+        # 本 worker 内正在执行的 key -> Event，同 worker 的等待者不必等满一个轮询间隔
+        self._local: Dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+        self._stats = {'leaders': 0, 'shared': 0, 'takeovers': 0, 'timeouts': 0, 'failures': 0}
+
+    @staticmethod
+    def create_tables(cursor):
+        """建表（由 Database._init_db 调用）"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS single_flight_results (
+                key TEXT PRIMARY KEY,
+                result TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        ''')
+
+    def _count(self, key: str):
+        with self._lock:
+            self._stats[key] += 1
+
+    # ========================================
+    # 结果
+    # ========================================
+
+    def _load(self, key: str, since: Optional[float]) -> Optional[str]:
+        oldest = time.time() - self.result_ttl
+        if since is not None:
+            oldest = max(oldest, since)
+        with self.db.connection() as conn:
+            row = conn.execute(
+                'SELECT result FROM single_flight_results WHERE key = ? AND created_at >= ?', (key, oldest)
+            ).fetchone()
+        return storage_codec.decode(row['result']) if row else None
+
+    def _store(self, key: str, result: str):
+        now = time.time()
+        with self.db.connection() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO single_flight_results (key, result, created_at) VALUES (?, ?, ?)',
+                (key, storage_codec.encode(result), now)
+            )
+            conn.execute('DELETE FROM single_flight_results WHERE created_at < ?', (now - self.result_ttl,))
+
+    # ========================================
+    # 执行
+    # ========================================
+
+    def do(self, key: str, fn: Callable[[], str], since: float = None) -> Tuple[str, bool]:
+        """
+        执行或等待一次调用
+
+        Returns:
+            (结果, shared)；shared=True 表示结果来自其他请求（正在进行的或 result_ttl 内已完成的）
+        Raises:
+            fn 的异常（本请求是领头者时）；SingleFlightTimeout（等待超过 wait_seconds）
+        """
+        lease = self.LEASE_PREFIX + key
+        deadline = time.monotonic() + self.wait_seconds
+        waited = False
+        while True:
+            result = self._load(key, since)
+            if result is not None:
+                self._count('shared')
+                return result, True
+
+            if self.db.outbox.acquire_lease(lease, self.lease_seconds):
+                # 拿到租约前领头者可能刚写完结果并释放，再查一次
+                result = self._load(key, since)
+                if result is not None:
+                    self.db.outbox.release_lease(lease)
+                    self._count('shared')
+                    return result, True
+                if waited:
+                    self._count('takeovers')
+                return self._lead(key, lease, fn), False
+
+            if time.monotonic() >= deadline:
+                self._count('timeouts')
+                raise SingleFlightTimeout(f'等待相同请求的结果超时: {key}')
+            waited = True
+            with self._lock:
+                event = self._local.get(key)
+            if event is not None:
+                event.wait(self.poll_interval)
+            else:
+                time.sleep(self.poll_interval)
+
+    def _lead(self, key: str, lease: str, fn: Callable[[], str]) -> str:
+        event = threading.Event()
+        with self._lock:
+            self._local[key] = event
+        self._count('leaders')
+        stop = threading.Event()
+        threading.Thread(
+            target=self._heartbeat, args=(lease, self.db.outbox._owner(), stop), daemon=True
+        ).start()
+        try:
+            result = fn()
+            self._store(key, result)
+            return result
+        except Exception:
+            self._count('failures')
+            raise
+        finally:
+            stop.set()
+            try:
+                self.db.outbox.release_lease(lease)
+            finally:
+                with self._lock:
+                    if self._local.get(key) is event:
+                        del self._local[key]
+                event.set()
+
+    def _heartbeat(self, lease: str, owner: str, stop: threading.Event):
+        """领头请求执行期间续期租约"""
+        while not stop.wait(self.lease_seconds / 3):
+            try:
+                if not self.db.outbox.renew_lease(lease, self.lease_seconds, owner):
+                    return
+            except Exception as e:
+                print(f"⚠️ 单飞租约续期失败: {e}")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = len(self._local)
+        return stats
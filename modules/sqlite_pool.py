@@ -0,0 +1,138 @@
+"""
+SQLite 连接池 - 本地备用库的连接复用
+WAL 日志模式 + busy_timeout，多个 gunicorn worker 并发写入时不再频繁出现 database is locked
+"""
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Dict
+
+
+class SQLitePool:
+    """
+    SQLite 连接管理器
+
+    - 同一线程/协程内嵌套使用时复用同一个连接（gevent 下 threading.local 按协程隔离）
+    - 用完的连接放回空闲队列，下次直接复用，省去建连和 PRAGMA 开销
+    - 每个连接开启较大的语句缓存，重复执行的 SQL 无需重新编译
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        max_idle: int = 8,
+        busy_timeout_ms: int = 5000,
+        cached_statements: int = 256
+    ):
+        self.db_path = db_path
+        self.max_idle = max_idle
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cached_statements = cached_statements
+
+        self._local = threading.local()
+        self._idle = queue.LifoQueue()
+        self._pid = os.getpid()
+        self._stats_lock = threading.Lock()
+        self._stats = {'created': 0, 'reused': 0, 'in_use': 0, 'closed': 0}
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+
+    def _count(self, key: str, delta: int = 1):
+        with self._stats_lock:
+            self._stats[key] += delta
+
+    def _create(self) -> sqlite3.Connection:
+        """新建连接并设置 PRAGMA"""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout_ms / 1000,
+            check_same_thread=False,
+            cached_statements=self.cached_statements
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout_ms)}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA cache_size=-8000')  # 约 8MB 页缓存
+        self._count('created')
+        return conn
+
+    def _check_fork(self):
+        """gunicorn fork 后丢弃父进程留下的连接"""
+        if os.getpid() != self._pid:
+            self._pid = os.getpid()
+            self._idle = queue.LifoQueue()
+            self._local = threading.local()
+
+    def _acquire(self) -> sqlite3.Connection:
+        try:
+            conn = self._idle.get_nowait()
+            self._count('reused')
+            return conn
+        except queue.Empty:
+            return self._create()
+
+    def _release(self, conn: sqlite3.Connection):
+        if self._idle.qsize() < self.max_idle:
+            self._idle.put(conn)
+        else:
+            conn.close()
+            self._count('closed')
+
+    @contextmanager
+    def connection(self, immediate: bool = False):
+        """
+        获取连接（上下文管理器）
+
+        正常退出时提交，异常时回滚；嵌套调用共用外层连接和事务
+
+        Args:
+            immediate: 以 BEGIN IMMEDIATE 开启事务，用于先读后写的场景，避免升级写锁时冲突
+        """
+        self._check_fork()
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self._local.depth += 1
+            try:
+                yield conn
+            finally:
+                self._local.depth -= 1
+            return
+
+        conn = self._acquire()
+        self._local.conn = conn
+        self._local.depth = 1
+        self._count('in_use')
+        try:
+            if immediate:
+                conn.execute('BEGIN IMMEDIATE')
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self._local.conn = None
+            self._local.depth = 0
+            self._count('in_use', -1)
+            self._release(conn)
+
+    def stats(self) -> Dict:
+        """连接池统计"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['idle'] = self._idle.qsize()
+        return stats
+
+    def close_all(self):
+        """关闭所有空闲连接"""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
@@ -0,0 +1,279 @@
+"""
+SSE 编解码 - AI 服务商流式响应的解析，以及推给前端的 SSE 帧
+- SSEDecoder：按字节解析网络读到的整批数据，不逐行 decode；装了 orjson 时用它解析 / 编码 JSON
+- StreamCoalescer：把细碎的增量合并后再输出，减少 SSE 帧数（每帧一次 JSON 编码 + 一次写 socket）；
+  coalesce / acoalesce 等上游时带超时，攒着的内容最多扣住 interval 秒
+同步（ai_service / app.py）和异步（ai_async / asgi.py）流式路径共用
+"""
+import asyncio
+import contextvars
+import json
+import queue
+import threading
+import time
+from typing import AsyncIterable, AsyncGenerator, Generator, Iterable, Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_loads = orjson.loads if orjson else json.loads
+
+_DONE_LINES = (b'data: [DONE]', b'data:[DONE]')
+
+# _scan_content 无法直接切出内容时返回，交给 JSON 解析
+_PARSE = object()
+
+
+def sse_frame(payload: dict) -> bytes:
+    """编码一个 SSE 帧（orjson 直接输出 UTF-8，json 输出 ASCII 转义，前端解析结果相同）"""
+    if orjson:
+        return b'data: ' + orjson.dumps(payload) + b'\n\n'
+    return f"data: {json.dumps(payload)}\n\n".encode('utf-8')
+
+
+def _scan_content(line: bytes):
+    """
+    直接从字节里切出 delta.content，不构造整帧 JSON
+
+    Returns:
+        内容文本；content 为 null 返回 None；带转义字符或格式不认识时返回 _PARSE
+    """
+    start = line.find(b'"content":')
+    if start < 0:
+        return _PARSE
+    start += 10
+    if line[start:start + 1] == b' ':
+        start += 1
+    quote = line[start:start + 1]
+    if quote != b'"':
+        return None if line.startswith(b'null', start) else _PARSE
+    end = line.find(b'"', start + 1)
+    if end < 0:
+        return _PARSE
+    value = line[start + 1:end]
+    # 有反斜杠说明带转义（\n、\uXXXX、\"），找到的引号也可能是转义的
+    if b'\\' in value:
+        return _PARSE
+    return value.decode('utf-8')
+
+
+class SSEDecoder:
+    """
+    OpenAI 兼容流式响应的增量解析器
+
+    不带转义的内容直接从字节切出（最常见的情况），其余整帧解析 JSON；
+    feed() 输入网络读到的原始字节（可在任意位置截断，包括多字节字符中间），
+    返回其中完整帧的增量文本（同一批的多帧已拼接）；收到 [DONE] 后 done 置 True，之后的数据忽略
+    """
+
+    def __init__(self):
+        self._buffer = b''
+        self.done = False
+        self.frames = 0
+
+    def feed(self, data: bytes) -> str:
+        if self.done:
+            return ''
+        if self._buffer:
+            data = self._buffer + data
+        end = data.rfind(b'\n')
+        if end < 0:
+            self._buffer = data
+            return ''
+        self._buffer = data[end + 1:]
+
+        pieces = []
+        for line in data[:end].split(b'\n'):
+            if not line.startswith(b'data:'):
+                continue
+            self.frames += 1
+            # 只有角色 / 结束原因的帧不解析 JSON
+            if b'"content"' not in line:
+                if line.rstrip() in _DONE_LINES:
+                    self.done = True
+                    break
+                continue
+            content = _scan_content(line)
+            if content is _PARSE:
+                try:
+                    content = _loads(line[5:])['choices'][0]['delta'].get('content')
+                except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+                    continue
+            if content:
+                pieces.append(content)
+        return ''.join(pieces)
+
+
+class StreamCoalescer:
+    """
+    合并流式增量后再输出
+
+    - 第一段立即输出，首字延迟不变
+    - 之后距上次输出满 interval 秒、或攒够 max_chars 字就输出
+    - 近期到达间隔（EWMA）不小于 interval 时不再攒、逐段输出
+    - 攒着内容时，调用方最多等 due() 秒就调用 expire() 输出，服务商停顿（或续写切换）时内容不会被扣住
+    - 流结束 / 出错前调用 flush() 取出剩余内容；interval <= 0 时不合并
+    """
+
+    def __init__(self, interval: float = 0.05, max_chars: int = 1024):
+        self.interval = interval
+        self.max_chars = max_chars
+        self._pending = []
+        self._pending_chars = 0
+        self._last_flush: Optional[float] = None
+        self._last_arrival: Optional[float] = None
+        self._gap: Optional[float] = None
+        self.pushed = 0
+        self.flushed = 0
+
+    def push(self, text: str, now: float = None) -> str:
+        """输入一段增量，返回应立即输出的内容（可能为空字符串）"""
+        if now is None:
+            now = time.monotonic()
+        self.pushed += 1
+        if self._last_arrival is not None:
+            gap = now - self._last_arrival
+            self._gap = gap if self._gap is None else 0.5 * self._gap + 0.5 * gap
+        self._last_arrival = now
+
+        self._pending.append(text)
+        self._pending_chars += len(text)
+        if (
+            self._last_flush is None
+            or self._pending_chars >= self.max_chars
+            or now - self._last_flush >= self.interval
+            or (self._gap or 0.0) >= self.interval
+        ):
+            self._last_flush = now
+            return self.flush()
+        return ''
+
+    def due(self, now: float = None) -> Optional[float]:
+        """攒着的内容还要等多少秒输出；没有攒着的内容返回 None（可以一直等下一段）"""
+        if not self._pending:
+            return None
+        if now is None:
+            now = time.monotonic()
+        return max(0.0, self._last_flush + self.interval - now)
+
+    def expire(self, now: float = None) -> str:
+        """等下一段超过 due() 秒时调用，取出攒着的内容"""
+        self._last_flush = time.monotonic() if now is None else now
+        return self.flush()
+
+    def flush(self) -> str:
+        """取出攒着的全部内容"""
+        if not self._pending:
+            return ''
+        text = ''.join(self._pending)
+        self._pending = []
+        self._pending_chars = 0
+        self.flushed += 1
+        return text
+
+
+def _prefetch(chunks: Iterable[str], events: queue.Queue, stop: threading.Event):
+    """在后台线程里读取 chunks 放入 events，调用方据此可以带超时地等下一段"""
+    try:
+        for chunk in chunks:
+            if stop.is_set():
+                break
+            events.put(('data', chunk))
+        events.put(('done', None))
+    except Exception as e:
+        events.put(('error', e))
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+def coalesce(chunks: Iterable[str], interval: float, max_chars: int) -> Generator[str, None, None]:
+    """合并 chat_stream 的输出；[ERROR] 段先输出已攒的内容，再原样输出；攒着内容时最多等 interval 秒"""
+    if interval <= 0:
+        yield from chunks
+        return
+
+    coalescer = StreamCoalescer(interval, max_chars)
+    events = queue.Queue()
+    stop = threading.Event()
+    # 在调用方的上下文里读取（沿用 ai_scheduler 的优先级）；gevent 打过补丁时是协程
+    context = contextvars.copy_context()
+    threading.Thread(target=context.run, args=(_prefetch, chunks, events, stop), daemon=True).start()
+    try:
+        while True:
+            try:
+                kind, value = events.get(timeout=coalescer.due())
+            except queue.Empty:
+                text = coalescer.expire()
+                if text:
+                    yield text
+                continue
+            if kind == 'error':
+                raise value
+            if kind == 'done':
+                break
+            if value.startswith('[ERROR]'):
+                text = coalescer.flush()
+                if text:
+                    yield text
+                yield value
+                return
+            text = coalescer.push(value)
+            if text:
+                yield text
+        text = coalescer.flush()
+        if text:
+            yield text
+    finally:
+        stop.set()
+
+
+async def acoalesce(chunks: AsyncIterable[str], interval: float, max_chars: int) -> AsyncGenerator[str, None]:
+    """coalesce 的异步版本"""
+    coalescer = StreamCoalescer(interval, max_chars)
+    iterator = chunks.__aiter__()
+    # 等待中的下一段；超时不取消它（取消会打断上游生成器），输出攒着的内容后继续等
+    pending: Optional[asyncio.Future] = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            wait = coalescer.due()
+            if wait is not None:
+                done, _ = await asyncio.wait({pending}, timeout=wait)
+                if not done:
+                    text = coalescer.expire()
+                    if text:
+                        yield text
+                    continue
+            try:
+                chunk = await pending
+            except StopAsyncIteration:
+                pending = None
+                break
+            pending = None
+            if chunk.startswith('[ERROR]'):
+                text = coalescer.flush()
+                if text:
+                    yield text
+                yield chunk
+                return
+            text = coalescer.push(chunk)
+            if text:
+                yield text
+        text = coalescer.flush()
+        if text:
+            yield text
+    finally:
+        if pending is not None and not pending.done():
+            pending.cancel()
+            try:
+                await pending
+            except BaseException:
+                pass
+        aclose = getattr(iterator, 'aclose', None)
+        if aclose is not None:
+            await aclose()
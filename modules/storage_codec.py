@@ -0,0 +1,109 @@
+"""
+存储编码 - 大文本字段（消息正文、文件提取文本、产出文档）落库前压缩
+压缩后的值仍是普通字符串（前缀标记 + base64），Supabase text 列和 SQLite 都能直接存；
+不带标记的旧数据原样读出，新旧数据可以混存
+"""
+import base64
+import threading
+import zlib
+from typing import Dict, Optional
+
+from config import Config
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 标记以 ESC 控制字符开头，正常文本不会出现
+_MARKER_ZLIB = '\x1bz1:'
+_MARKER_ZSTD = '\x1bzs1:'
+
+
+class StorageCodec:
+    """
+    大文本压缩编解码
+
+    - encode：超过阈值才压缩，压缩后没变小则保持原文
+    - decode：只认带标记的值，其余原样返回（兼容未压缩的旧数据）
+    """
+
+    def __init__(self, threshold: int = 8192, algorithm: str = 'auto', level: int = 6):
+        self.threshold = threshold
+        if algorithm == 'auto':
+            algorithm = 'zstd' if zstandard else 'zlib'
+        if algorithm == 'zstd' and not zstandard:
+            print("⚠️ 未安装 zstandard，存储压缩改用 zlib")
+            algorithm = 'zlib'
+        self.algorithm = algorithm
+        self.level = level
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stats = {'encoded': 0, 'decoded': 0, 'raw_bytes': 0, 'stored_bytes': 0, 'decode_errors': 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold > 0 and self.algorithm != 'none'
+
+    @staticmethod
+    def is_encoded(value) -> bool:
+        return isinstance(value, str) and value.startswith('\x1b')
+
+    def _compress(self, data: bytes) -> str:
+        if self.algorithm == 'zstd':
+            compressor = getattr(self._local, 'zstd', None)
+            if compressor is None:
+                compressor = self._local.zstd = zstandard.ZstdCompressor(level=self.level)
+            return _MARKER_ZSTD + base64.b64encode(compressor.compress(data)).decode('ascii')
+        return _MARKER_ZLIB + base64.b64encode(zlib.compress(data, self.level)).decode('ascii')
+
+    def encode(self, text: Optional[str]) -> Optional[str]:
+        """落库前调用：超过阈值的文本压缩成带标记的字符串"""
+        if not self.enabled or not isinstance(text, str) or len(text) < self.threshold \
+                or self.is_encoded(text):
+            return text
+        raw = text.encode('utf-8')
+        stored = self._compress(raw)
+        if len(stored) >= len(raw):
+            return text
+        with self._lock:
+            self._stats['encoded'] += 1
+            self._stats['raw_bytes'] += len(raw)
+            self._stats['stored_bytes'] += len(stored)
+        return stored
+
+    def decode(self, value):
+        """读库后调用：带标记的值解压，其余原样返回"""
+        if not self.is_encoded(value):
+            return value
+        try:
+            if value.startswith(_MARKER_ZSTD):
+                if not zstandard:
+                    raise RuntimeError('需要安装 zstandard 才能读取该数据')
+                data = zstandard.ZstdDecompressor().decompress(
+                    base64.b64decode(value[len(_MARKER_ZSTD):]), max_output_size=1 << 30
+                )
+            elif value.startswith(_MARKER_ZLIB):
+                data = zlib.decompress(base64.b64decode(value[len(_MARKER_ZLIB):]))
+            else:
+                return value
+        except Exception as e:
+            with self._lock:
+                self._stats['decode_errors'] += 1
+            print(f"⚠️ 存储数据解压失败，按原值返回: {e}")
+            return value
+        with self._lock:
+            self._stats['decoded'] += 1
+        return data.decode('utf-8')
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats['algorithm'] = self.algorithm if self.enabled else 'none'
+        stats['threshold'] = self.threshold
+        stats['saved_bytes'] = stats['raw_bytes'] - stats['stored_bytes']
+        return stats
+
+
+# 单例实例
+storage_codec = StorageCodec(Config.STORAGE_COMPRESS_THRESHOLD, Config.STORAGE_COMPRESS_ALGORITHM)
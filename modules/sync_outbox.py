@@ -0,0 +1,429 @@
+"""
+同步发件箱 - Supabase 故障期间回退到 SQLite 的写入先记一笔，恢复后由后台线程批量补写回 Supabase
+同一台机器上的多个 worker 共用本地库，通过租约保证同一时刻只有一个 worker 在补写
+"""
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, List
+
+# 发件箱记录类型
+KIND_SESSION = 'session'                # 本地会话（补写时读取会话当前整行）
+KIND_MESSAGE = 'message'                # 消息（payload 为完整消息；带 seq 的是本地会话的消息）
+KIND_SESSION_UPDATE = 'session_update'  # 对 Supabase 会话的字段更新（payload 为要更新的字段）
+KIND_RESEARCH_NOTE = 'research_note'    # 本地调研记录（补写成功后删除本地副本）
+
+
+class SyncOutbox:
+    """
+    发件箱 + 补写线程
+
+    - enqueue() 与本地写入在同一个 SQLite 事务里执行，写入成功就一定有补写记录
+    - 补写按 id 顺序取一批，按类型合并成批量 insert / upsert（会话先于消息）；
+      本地会话的消息全部补写完才切换到 Supabase
+    - 整批失败时：故障类错误计入熔断器并结束本轮；请求类错误逐条重试，定位出的坏记录重试多次后标记为 dead
+    - 语义为至少一次：upsert 天然幂等，Supabase 会话的新消息在极端情况下可能重复一条
+    """
+
+    BATCH_SIZE = 200
+    MAX_ATTEMPTS = 5
+    LEASE_SECONDS = 60
+    LEASE_NAME = 'sync_outbox'
+
+    def __init__(self, db, interval: float = 5.0):
+        self.db = db
+        self.interval = interval
+        self._is_started = False
+        self._stop_flag = False
+        self._thread = None
+        self._lock = threading.Lock()
+        self._recent = deque()  # (完成时间, 条数)，用于计算最近一分钟吞吐
+        self._stats = {
+            'enqueued': 0,
+            'replayed': 0,
+            'batches': 0,
+            'failed_batches': 0,
+            'dead': 0,
+            'last_drain_at': None,
+            'last_batch_rows': 0,
+            'last_batch_seconds': 0.0,
+            'last_error': None
+        }
+
+    @staticmethod
+    def create_tables(cursor):
+        """建表（由 Database._init_db 调用）"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sync_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                record_key TEXT NOT NULL,
+                payload TEXT,
+                status TEXT DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                last_error TEXT,
+                created_at REAL NOT NULL
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sync_outbox_status ON sync_outbox(status, id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sync_outbox_key ON sync_outbox(record_key, status)')
+
+        # 跨 worker 的租约（谁持有谁执行）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sync_leases (
+                name TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        ''')
+
+    def _count(self, key: str, delta: int = 1):
+        with self._lock:
+            self._stats[key] += delta
+
+    # ========================================
+    # 记录
+    # ========================================
+
+    def enqueue(self, kind: str, record_key: str, payload: Dict = None):
+        """记录一次回退写入（调用方在同一个 db.connection() 块内调用即与本地写入同事务）"""
+        with self.db.connection() as conn:
+            conn.execute('''
+                INSERT INTO sync_outbox (kind, record_key, payload, created_at)
+                VALUES (?, ?, ?, ?)
+            ''', (kind, record_key, json.dumps(payload, ensure_ascii=False) if payload else None, time.time()))
+        self._count('enqueued')
+        self.start()
+
+    # ========================================
+    # 租约
+    # ========================================
+
+    @staticmethod
+    def _owner() -> str:
+        return f'{os.getpid()}:{threading.get_ident()}'
+
+    def acquire_lease(self, name: str = None, seconds: float = None) -> bool:
+        """
+        获取（或续期）一个跨 worker 的租约，持有期间其他 worker 拿不到同名租约
+
+        发件箱补写用默认名称；会话归档等其他后台任务传入自己的名称复用同一张表
+        """
+        name = name or self.LEASE_NAME
+        now = time.time()
+        owner = self._owner()
+        with self.db.connection(immediate=True) as conn:
+            conn.execute('''
+                INSERT INTO sync_leases (name, owner, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                WHERE sync_leases.expires_at < ? OR sync_leases.owner = excluded.owner
+            ''', (name, owner, now + (seconds or self.LEASE_SECONDS), now))
+            row = conn.execute('SELECT owner FROM sync_leases WHERE name = ?', (name,)).fetchone()
+        return row is not None and row['owner'] == owner
+
+    def renew_lease(self, name: str, seconds: float, owner: str) -> bool:
+        """替持有者（acquire_lease 时的 _owner()）续期租约，供其他线程做心跳；租约已被他人接手时返回 False"""
+        with self.db.connection() as conn:
+            cursor = conn.execute(
+                'UPDATE sync_leases SET expires_at = ? WHERE name = ? AND owner = ?',
+                (time.time() + seconds, name, owner)
+            )
+        return cursor.rowcount > 0
+
+    def release_lease(self, name: str = None):
+        with self.db.connection() as conn:
+            conn.execute(
+                'DELETE FROM sync_leases WHERE name = ? AND owner = ?', (name or self.LEASE_NAME, self._owner())
+            )
+
+    # ========================================
+    # 补写
+    # ========================================
+
+    def has_pending(self) -> bool:
+        with self.db.connection() as conn:
+            row = conn.execute("SELECT 1 FROM sync_outbox WHERE status = 'pending' LIMIT 1").fetchone()
+        return row is not None
+
+    def drain_once(self) -> int:
+        """补写一批，返回成功条数"""
+        if not self.db.use_supabase or not self.has_pending():
+            return 0
+        if not self.db.supabase_breaker.allow_request():
+            return 0
+        if not self.acquire_lease():
+            return 0
+
+        try:
+            with self.db.connection() as conn:
+                rows = [dict(row) for row in conn.execute('''
+                    SELECT * FROM sync_outbox WHERE status = 'pending' ORDER BY id LIMIT ?
+                ''', (self.BATCH_SIZE,)).fetchall()]
+            if not rows:
+                return 0
+            return self._replay_batch(rows)
+        finally:
+            self.release_lease()
+
+    def _replay_batch(self, rows: List[Dict]) -> int:
+        started = time.monotonic()
+        done_ids = []
+        handlers = (
+            (KIND_SESSION, self._replay_sessions),
+            (KIND_MESSAGE, self._replay_messages),
+            (KIND_SESSION_UPDATE, self._replay_session_updates),
+            (KIND_RESEARCH_NOTE, self._replay_research_notes)
+        )
+
+        try:
+            for kind, handler in handlers:
+                group = [row for row in rows if row['kind'] == kind]
+                if group:
+                    done_ids.extend(self._replay_group(group, handler))
+            self.db._supabase_ok()
+        except Exception as e:
+            # 故障类错误：Supabase 又不可用了，剩下的留到下一轮
+            self.db._supabase_failed(e)
+            self._count('failed_batches')
+            with self._lock:
+                self._stats['last_error'] = str(e)[:500]
+            print(f"⚠️ 发件箱补写中断，等待 Supabase 恢复: {e}")
+
+        if done_ids:
+            with self.db.connection() as conn:
+                conn.executemany('DELETE FROM sync_outbox WHERE id = ?', [(i,) for i in done_ids])
+            done = set(done_ids)
+            self._mark_synced(list(dict.fromkeys(
+                row['record_key'] for row in rows
+                if row['id'] in done and row['kind'] in (KIND_SESSION, KIND_MESSAGE)
+            )))
+
+        elapsed = time.monotonic() - started
+        with self._lock:
+            self._stats['replayed'] += len(done_ids)
+            self._stats['batches'] += 1
+            self._stats['last_drain_at'] = time.time()
+            self._stats['last_batch_rows'] = len(done_ids)
+            self._stats['last_batch_seconds'] = round(elapsed, 3)
+            self._recent.append((time.monotonic(), len(done_ids)))
+        if done_ids:
+            print(f"📤 发件箱补写 {len(done_ids)} 条到 Supabase，耗时 {elapsed:.2f} 秒")
+        return len(done_ids)
+
+    def _replay_group(self, group: List[Dict], handler: Callable[[List[Dict]], None]) -> List[int]:
+        """整组批量补写；被 Supabase 拒绝时逐条重试，找出坏记录"""
+        try:
+            handler(group)
+            return [row['id'] for row in group]
+        except Exception as e:
+            if not self.db._is_request_error(e):
+                raise
+            if len(group) == 1:
+                self._mark_failed(group[0], e)
+                return []
+
+        done = []
+        for row in group:
+            try:
+                handler([row])
+                done.append(row['id'])
+            except Exception as e:
+                if not self.db._is_request_error(e):
+                    raise
+                self._mark_failed(row, e)
+        return done
+
+    def _mark_failed(self, row: Dict, error: Exception):
+        attempts = row['attempts'] + 1
+        status = 'dead' if attempts >= self.MAX_ATTEMPTS else 'pending'
+        with self.db.connection() as conn:
+            conn.execute('''
+                UPDATE sync_outbox SET attempts = ?, status = ?, last_error = ? WHERE id = ?
+            ''', (attempts, status, str(error)[:500], row['id']))
+        if status == 'dead':
+            self._count('dead')
+            print(f"❌ 发件箱记录 {row['id']}（{row['kind']} {row['record_key']}）多次补写失败，已放弃: {error}")
+
+    @staticmethod
+    def _payload(row: Dict) -> Dict:
+        return json.loads(row['payload']) if row['payload'] else {}
+
+    @staticmethod
+    def _unique_keys(group: List[Dict]) -> List[str]:
+        return list(dict.fromkeys(row['record_key'] for row in group))
+
+    def _replay_sessions(self, group: List[Dict]):
+        session_ids = self._unique_keys(group)
+        placeholders = ','.join('?' * len(session_ids))
+        with self.db.connection() as conn:
+            cursor = conn.cursor()
+            rows = cursor.execute(
+                f'SELECT * FROM sessions WHERE id IN ({placeholders})', session_ids
+            ).fetchall()
+            # 旧结构下消息随会话整体写入 messages 数组
+            legacy_messages = None if self.db.use_message_table else \
+                self.db._load_local_messages(cursor, [row['id'] for row in rows])
+        if not rows:
+            return
+
+        records = [{
+            'id': row['id'],
+            'module': row['module'],
+            'user_id': row['user_id'],
+            'user_email': row['user_email'],
+            'status': row['status'],
+            'collected_data': self.db._safe_json_loads(row['collected_data'], {}),
+            'messages': legacy_messages[row['id']] if legacy_messages is not None else [],
+            'output_document': self.db._supabase_text(row['output_document']),
+            'created_at': row['created_at'],
+            'updated_at': row['updated_at']
+        } for row in rows]
+        self.db.supabase.table('sessions').upsert(records, on_conflict='id').execute()
+
+    def _mark_synced(self, session_ids: List[str]):
+        """
+        本地会话的会话行和全部消息都补写完成后，会话才改以 Supabase 为准
+
+        消息还在后面的批次里时就切过去，新消息会由触发器占用这些 seq，补写时被 ignore_duplicates 丢弃
+        """
+        if not session_ids:
+            return
+        placeholders = ','.join('?' * len(session_ids))
+        with self.db.connection(immediate=True) as conn:
+            synced_ids = [row['id'] for row in conn.execute(f'''
+                SELECT id FROM sessions
+                WHERE id IN ({placeholders}) AND synced_at IS NULL
+                  AND NOT EXISTS (
+                      SELECT 1 FROM sync_outbox
+                      WHERE record_key = sessions.id AND status = 'pending' AND kind IN (?, ?)
+                  )
+            ''', [*session_ids, KIND_SESSION, KIND_MESSAGE]).fetchall()]
+            if synced_ids:
+                conn.execute(
+                    f'UPDATE sessions SET synced_at = CURRENT_TIMESTAMP WHERE id IN ({",".join("?" * len(synced_ids))})',
+                    synced_ids
+                )
+        for session_id in synced_ids:
+            self.db._remember_backend(session_id, 'supabase')
+            self.db.session_cache.invalidate(session_id)
+
+    def _replay_messages(self, group: List[Dict]):
+        messages = [
+            self.db._supabase_message(dict(self._payload(row), session_id=row['record_key'])) for row in group
+        ]
+
+        if not self.db.use_message_table:
+            # 旧结构：本地会话的消息已随会话写入，Supabase 会话的消息逐条追加到 messages 数组
+            for msg in messages:
+                if msg.get('seq') is not None:
+                    continue
+                result = self.db.supabase.table('sessions').select('messages').eq('id', msg['session_id']).execute()
+                if not result.data:
+                    continue
+                session_messages = result.data[0].get('messages') or []
+                session_messages.append({'role': msg['role'], 'content': msg['content'], 'timestamp': msg['created_at']})
+                self.db.supabase.table('sessions').update({
+                    'messages': session_messages
+                }).eq('id', msg['session_id']).execute()
+            return
+
+        local = [msg for msg in messages if msg.get('seq') is not None]
+        remote = [msg for msg in messages if msg.get('seq') is None]
+        if local:
+            self.db.supabase.table('session_messages').upsert(
+                local, on_conflict='session_id,seq', ignore_duplicates=True
+            ).execute()
+        if remote:
+            # 不带 seq，由触发器按插入顺序分配
+            for msg in remote:
+                msg.pop('seq', None)
+            self.db.supabase.table('session_messages').insert(remote).execute()
+
+    def _replay_session_updates(self, group: List[Dict]):
+        for row in group:
+            fields = self._payload(row)
+            if 'output_document' in fields:
+                fields['output_document'] = self.db._supabase_text(fields['output_document'])
+            self.db.supabase.table('sessions').update(fields).eq('id', row['record_key']).execute()
+            self.db.session_cache.invalidate(row['record_key'])
+
+    def _replay_research_notes(self, group: List[Dict]):
+        note_ids = self._unique_keys(group)
+        placeholders = ','.join('?' * len(note_ids))
+        with self.db.connection() as conn:
+            rows = [dict(row) for row in conn.execute(
+                f'SELECT * FROM user_research_notes WHERE id IN ({placeholders})', note_ids
+            ).fetchall()]
+        if not rows:
+            return
+        for row in rows:
+            row['file_text_content'] = self.db._supabase_text(row['file_text_content'])
+
+        self.db.supabase.table('user_research_notes').upsert(rows, on_conflict='id').execute()
+
+        # 已进入 Supabase，删除本地副本避免重复
+        with self.db.connection() as conn:
+            conn.executemany('DELETE FROM user_research_notes WHERE id = ?', [(row['id'],) for row in rows])
+
+    # ========================================
+    # 后台线程
+    # ========================================
+
+    def _run(self):
+        while not self._stop_flag:
+            try:
+                replayed = self.drain_once()
+            except Exception as e:
+                print(f"⚠️ 发件箱补写线程错误: {e}")
+                replayed = 0
+            # 整批补满说明还有积压，立即继续
+            if replayed < self.BATCH_SIZE:
+                time.sleep(self.interval)
+
+    def start(self):
+        """启动补写线程（每个 worker 一个，重复调用无副作用）"""
+        if self._is_started or not self.db.use_supabase:
+            return
+        with self._lock:
+            if self._is_started:
+                return
+            self._is_started = True
+        self._stop_flag = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_flag = True
+        self._is_started = False
+
+    # ========================================
+    # 统计
+    # ========================================
+
+    def stats(self) -> Dict:
+        """吞吐（本 worker）+ 积压与延迟（本机所有 worker 共享）"""
+        now = time.monotonic()
+        with self._lock:
+            while self._recent and now - self._recent[0][0] > 60:
+                self._recent.popleft()
+            stats = dict(self._stats)
+            stats['replayed_last_minute'] = sum(count for _, count in self._recent)
+        seconds = stats['last_batch_seconds']
+        stats['last_batch_rows_per_second'] = round(stats['last_batch_rows'] / seconds, 1) if seconds else 0.0
+
+        with self.db.connection() as conn:
+            row = conn.execute('''
+                SELECT
+                    SUM(CASE WHEN status = 'pending' THEN 1 ELSE 0 END) AS pending,
+                    SUM(CASE WHEN status = 'dead' THEN 1 ELSE 0 END) AS dead,
+                    MIN(CASE WHEN status = 'pending' THEN created_at END) AS oldest
+                FROM sync_outbox
+            ''').fetchone()
+        stats['pending'] = row['pending'] or 0
+        stats['dead_total'] = row['dead'] or 0
+        # 最早一条未补写记录距今多久
+        stats['lag_seconds'] = round(time.time() - row['oldest'], 1) if row['oldest'] else 0.0
+        stats['running'] = self._is_started
+        return stats
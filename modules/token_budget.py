@@ -0,0 +1,203 @@
+"""
+Token 预算 - 可替换的 token 估算器 + 组装提示词时统一分配上下文预算
+中文 1 个字符并不等于 1 个 token，按字符数截断要么超出模型上下文、要么浪费；
+系统提示词、用户记忆、知识库、对话摘要和最近对话都从同一份 token 预算里扣除
+"""
+import math
+import re
+from typing import Dict, List, Optional
+
+from config import Config
+
+# 每条消息在 chat 格式里额外占用的 token（角色、分隔符）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# CJK 字符（含日文假名、韩文、全角标点）
+_CJK_RE = re.compile('[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+
+
+def count_cjk(text: str) -> int:
+    """CJK 字符数"""
+    return len(_CJK_RE.findall(text)) if text else 0
+
+
+class HeuristicTokenEstimator:
+    """
+    CJK 感知的估算器（不依赖 tokenizer）
+
+    token ≈ CJK 字符数 × cjk_ratio + 其他字符数 / chars_per_token；
+    两个系数可用 scripts/calibrate_token_estimator.py 按实际对话数据标定
+    """
+
+    name = 'heuristic'
+
+    def __init__(self, cjk_ratio: float = 1.0, chars_per_token: float = 4.0):
+        self.cjk_ratio = cjk_ratio
+        self.chars_per_token = chars_per_token
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        cjk = count_cjk(text)
+        return math.ceil(cjk * self.cjk_ratio + (len(text) - cjk) / self.chars_per_token)
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """保留开头不超过 max_tokens 的部分（估算值随长度单调，二分查找截断位置）"""
+        lo, hi = 0, len(text)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self.count(text[:mid]) <= max_tokens:
+                lo = mid
+            else:
+                hi = mid - 1
+        return text[:lo]
+
+
+class TiktokenEstimator:
+    """
+    用 tiktoken 精确计数（可选依赖）
+
+    编码文件首次使用时会下载，离线部署需预先放到 TIKTOKEN_CACHE_DIR；
+    与实际模型的分词器不完全一致，但对中文的误差远小于按字符数
+    """
+
+    name = 'tiktoken'
+
+    def __init__(self, encoding: str = 'o200k_base'):
+        import tiktoken
+        self.encoding = tiktoken.get_encoding(encoding)
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        tokens = self.encoding.encode(text, disallowed_special=())
+        # 截断处可能切开多字节字符，丢掉残缺的部分
+        return self.encoding.decode_bytes(tokens[:max(0, max_tokens)]).decode('utf-8', errors='ignore')
+
+
+def create_estimator(name: str = 'heuristic'):
+    """按名称创建估算器；tiktoken 不可用时退回 CJK 估算"""
+    if name == 'tiktoken':
+        try:
+            return TiktokenEstimator(Config.TOKEN_ENCODING)
+        except Exception as e:
+            print(f"⚠️ tiktoken 加载失败，改用 CJK 估算: {e}")
+    return HeuristicTokenEstimator(Config.TOKEN_CJK_RATIO, Config.TOKEN_CHARS_PER_TOKEN)
+
+
+def estimate_tokens(text: str) -> int:
+    """估算文本的 token 数"""
+    return token_estimator.count(text)
+
+
+def truncate_tokens(text: str, max_tokens: int, suffix: str = '') -> str:
+    """截断到 max_tokens 以内，被截断时在末尾加 suffix（suffix 也计入预算）"""
+    if not text or token_estimator.count(text) <= max_tokens:
+        return text or ''
+    return token_estimator.truncate(text, max(0, max_tokens - token_estimator.count(suffix))) + suffix
+
+
+class PromptBudget:
+    """
+    一次提示词组装的 token 预算
+
+    - take()：把一段文本按上限（分项上限和剩余预算取小）截断后计入
+    - charge()：直接记入已知的用量（如历史消息的前缀和）
+    - take_recent()：从一组条目里保留最近的、放得下的部分
+    """
+
+    def __init__(self, total: int, caps: Dict[str, int] = None):
+        self.total = total
+        self.caps = caps or {}
+        self.used: Dict[str, int] = {}
+
+    @property
+    def remaining(self) -> int:
+        return max(0, self.total - sum(self.used.values()))
+
+    def spent(self, *sections: str) -> int:
+        return sum(self.used.get(section, 0) for section in sections)
+
+    def limit(self, section: str, limit: int = None) -> int:
+        """某一项当前最多能用的 token 数"""
+        cap = limit if limit is not None else self.caps.get(section)
+        if cap is not None:
+            cap = max(0, cap - self.used.get(section, 0))
+        return self.remaining if cap is None else min(cap, self.remaining)
+
+    def charge(self, section: str, tokens: int):
+        self.used[section] = self.used.get(section, 0) + max(0, tokens)
+
+    def take(self, section: str, text: Optional[str], limit: int = None, suffix: str = '...(内容已截断)') -> str:
+        if not text:
+            return ''
+        text = truncate_tokens(text, self.limit(section, limit), suffix)
+        self.charge(section, estimate_tokens(text))
+        return text
+
+    def take_recent(self, section: str, items: List[str], limit: int = None, item_limit: int = None,
+                    suffix: str = '...') -> List[str]:
+        """
+        从最新的一条往前保留放得下的条目（单条超过 item_limit 先截断），返回值保持原顺序
+
+        最新一条本身就放不下时截断保留，不会返回空列表
+        """
+        available = self.limit(section, limit)
+        kept = []
+        for item in reversed(items):
+            if item_limit is not None:
+                item = truncate_tokens(item, item_limit, suffix)
+            tokens = estimate_tokens(item)
+            if tokens > available and not kept and available > 0:
+                item = truncate_tokens(item, available, suffix)
+                tokens = estimate_tokens(item)
+            if tokens > available:
+                break
+            kept.append(item)
+            available -= tokens
+            self.charge(section, tokens)
+        kept.reverse()
+        return kept
+
+    def usage(self) -> Dict:
+        return {'total': self.total, 'remaining': self.remaining, 'sections': dict(self.used)}
+
+
+class ContextBudgetAllocator:
+    """
+    上下文预算分配
+
+    总预算 = 模型上下文 - 预留给回复的 token；记忆 / 知识库 / 摘要各有上限，
+    最近对话拿剩下的全部。所有组装提示词的地方都从 start() 取一份预算
+    """
+
+    def __init__(self, context_tokens: int, output_tokens: int, caps: Dict[str, int]):
+        self.context_tokens = context_tokens
+        self.output_tokens = output_tokens
+        self.caps = dict(caps)
+
+    @property
+    def total(self) -> int:
+        return max(0, self.context_tokens - self.output_tokens)
+
+    def cap(self, section: str) -> Optional[int]:
+        return self.caps.get(section)
+
+    def start(self, total: int = None) -> PromptBudget:
+        return PromptBudget(self.total if total is None else total, self.caps)
+
+
+# 单例实例
+token_estimator = create_estimator(Config.TOKEN_ESTIMATOR)
+context_budget = ContextBudgetAllocator(
+    Config.AI_CONTEXT_TOKENS,
+    Config.AI_OUTPUT_RESERVE_TOKENS,
+    caps={
+        'memory': Config.AI_MEMORY_TOKENS,
+        'knowledge': Config.AI_KNOWLEDGE_TOKENS,
+        'summary': Config.AI_SUMMARY_TOKENS
+    }
+)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+会话冷存储归档 / 恢复
+把闲置超过 N 天的会话移入 data/archive/ 段文件，或把指定会话恢复到热表
+
+用法（在项目根目录）：
+    python scripts/archive_sessions.py --days 180          # 归档闲置 180 天以上的会话
+    python scripts/archive_sessions.py --restore <会话ID>   # 恢复指定会话
+"""
+import argparse
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from database import db  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description='会话冷存储归档 / 恢复')
+    parser.add_argument('--days', type=int, help='归档闲置超过多少天的会话')
+    parser.add_argument('--batch-size', type=int, default=100, help='每批归档的会话数')
+    parser.add_argument('--restore', metavar='SESSION_ID', help='恢复指定会话到热表')
+    args = parser.parse_args()
+
+    if args.restore:
+        if db.archive.restore(args.restore):
+            print(f"✅ 已恢复会话 {args.restore}")
+        else:
+            print(f"❌ 恢复失败（会话不在归档中或 Supabase 不可用）: {args.restore}")
+            sys.exit(1)
+        return
+
+    if not args.days:
+        parser.error('请指定 --days 或 --restore')
+
+    print(f"📦 开始归档闲置超过 {args.days} 天的会话...")
+    total = 0
+    while True:
+        archived = db.archive.archive_once(idle_days=args.days, limit=args.batch_size)
+        if not archived:
+            break
+        total += archived
+        print(f"   已归档 {total} 个会话")
+
+    stats = db.archive.stats()
+    print(f"\n✅ 归档完成，本次 {total} 个，累计 {stats['archived_total']} 个")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+图片预处理效果测试：对给定的图片文件（如手机原图）做一次与对话上传相同的预处理，
+输出每张图片处理前后的大小（base64 文本字节数）、尺寸和整批耗时，用于调整 IMAGE_MAX_EDGE / IMAGE_FORMAT / IMAGE_QUALITY
+
+用法（在项目根目录，已 pip install -r requirements.txt）：
+    python scripts/bench_image_pipeline.py photo1.jpg photo2.png [--max-edge 1536] [--format webp] [--quality 80]
+"""
+import argparse
+import base64
+import io
+import mimetypes
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from modules.image_pipeline import Image, ImagePreprocessor  # noqa: E402
+
+
+def to_data_url(path: Path) -> str:
+    mime = mimetypes.guess_type(path.name)[0] or 'image/jpeg'
+    return f"data:{mime};base64,{base64.b64encode(path.read_bytes()).decode('ascii')}"
+
+
+def image_size(data_url: str) -> str:
+    if Image is None:
+        return '-'
+    with Image.open(io.BytesIO(base64.b64decode(data_url.split(',', 1)[1]))) as img:
+        return f'{img.width}x{img.height}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='图片预处理效果测试')
+    parser.add_argument('files', nargs='+', type=Path)
+    parser.add_argument('--max-edge', type=int, default=1536)
+    parser.add_argument('--format', default='webp', choices=['webp', 'jpeg'])
+    parser.add_argument('--quality', type=int, default=80)
+    parser.add_argument('--workers', type=int, default=2)
+    args = parser.parse_args()
+
+    if Image is None:
+        print('⚠️ 未安装 Pillow，只能测试去重')
+
+    preprocessor = ImagePreprocessor(True, args.max_edge, args.format, args.quality, args.workers)
+    images = [to_data_url(path) for path in args.files]
+    # 第一次处理会创建线程池，先预热一次再计时
+    preprocessor.process(images[:1])
+    processed, report = preprocessor.process(images)
+
+    print(f"{'文件':<30} {'原尺寸':>12} {'原大小':>10}")
+    for path, image in zip(args.files, images):
+        print(f'{path.name[:30]:<30} {image_size(image):>12} {len(image) / 1024:>9.0f}K')
+    print(f"\n处理后 {report['images_out']} 张（去重 {report['duplicates']}）：")
+    for image in processed:
+        print(f"  {image[5:image.index(';')]:<12} {image_size(image):>12} {len(image) / 1024:>9.0f}K")
+    saved = report['bytes_in'] - report['bytes_out']
+    print(f"\n总计 {report['bytes_in'] / 1024:.0f}K → {report['bytes_out'] / 1024:.0f}K，"
+          f"节省 {saved / 1024:.0f}K（{saved / report['bytes_in']:.1%}），耗时 {report['ms']}ms")
+
+
+if __name__ == '__main__':
+    main()
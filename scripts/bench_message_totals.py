@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+微基准：组装 API 上下文时的用量计算
+对比每轮全量求和 + 倒序逐条截断（旧做法）与前缀和 O(1) 判断 + 二分截断（MessageTotals）
+
+用法（在项目根目录）：
+    python scripts/bench_message_totals.py [--messages 1000] [--turns 200]
+"""
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from modules.message_totals import MessageTotals  # noqa: E402
+
+MAX_CHARS = 50000
+
+
+def make_messages(count: int):
+    random.seed(42)
+    return [
+        {'role': 'user' if i % 2 == 0 else 'assistant', 'content': '指标' * random.randint(20, 600)}
+        for i in range(count)
+    ]
+
+
+def old_turn(messages, budget):
+    """旧做法：每轮重算总字符数，超限时从最近一条往前逐条加入"""
+    total_chars = sum(len(msg.get('content', '')) for msg in messages)
+    if total_chars <= MAX_CHARS:
+        return len(messages)
+    remaining = budget
+    recent = []
+    for msg in reversed(messages[1:]):
+        msg_len = len(msg.get('content', ''))
+        if remaining >= msg_len:
+            recent.insert(0, msg)
+            remaining -= msg_len
+        else:
+            break
+    return len(messages) - len(recent)
+
+
+def new_turn(totals, messages, budget):
+    """新做法：前缀和末项判断预算，二分查找窗口起点"""
+    totals.sync(messages)
+    if totals.total_chars <= MAX_CHARS:
+        return len(messages)
+    return totals.window_start(budget, lo=1)
+
+
+def bench(label, fn, turns):
+    started = time.perf_counter()
+    for _ in range(turns):
+        result = fn()
+    elapsed = time.perf_counter() - started
+    print(f"   {label:<28} {elapsed / turns * 1e6:10.1f} µs/轮")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='消息用量前缀和微基准')
+    parser.add_argument('--messages', type=int, default=1000, help='会话消息数')
+    parser.add_argument('--turns', type=int, default=200, help='重复轮数')
+    args = parser.parse_args()
+
+    messages = make_messages(args.messages)
+    budget = MAX_CHARS - 2000
+    print(f"📏 {args.messages} 条消息，总字符数 {sum(len(m['content']) for m in messages)}")
+
+    totals = MessageTotals().sync(messages)
+    old_start = bench('全量求和 + 倒序截断', lambda: old_turn(messages, budget), args.turns)
+    new_start = bench('前缀和 + 二分截断', lambda: new_turn(totals, messages, budget), args.turns)
+    assert old_start == new_start, (old_start, new_start)
+
+    # 追加一条消息后的下一轮：旧做法仍全量重算，新做法只追加一项
+    def append_then_new():
+        totals.append('新消息')
+        messages.append({'role': 'user', 'content': '新消息'})
+        return new_turn(totals, messages, budget)
+
+    bench('追加一条 + 前缀和', append_then_new, args.turns)
+    print(f"\n✅ 窗口起点一致: {old_start}")
+
+
+if __name__ == "__main__":
+    main()
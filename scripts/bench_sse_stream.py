@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+微基准：流式回复从服务商响应到前端 SSE 帧的 CPU 开销
+对比逐行 decode + json.loads + 每段一帧（旧做法）与按字节批量解析 + 合并推送（SSEDecoder + StreamCoalescer）
+
+用法（在项目根目录）：
+    python scripts/bench_sse_stream.py [--streams 20] [--tokens 3000] [--interval 0.03]
+    python scripts/bench_sse_stream.py --record a.sse b.sse   # 用录制的服务商响应体
+
+录制：把服务商的流式响应体原样存成文件，如
+    curl -N https://api.closeai-asia.com/v1/chat/completions -H 'Authorization: Bearer ...' \\
+        -H 'Content-Type: application/json' -d '{"model": "...", "stream": true, "messages": [...]}' > a.sse
+录制文件没有到达时间，按 --interval 间隔、每 --frames-per-read 帧一次网络读取回放
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from modules.sse_codec import SSEDecoder, StreamCoalescer, orjson, sse_frame  # noqa: E402
+
+
+def make_stream(tokens: int, seed: int) -> bytes:
+    """生成一条 OpenAI 兼容格式的流式响应体（每帧 1~3 个汉字或一段标点 / 换行）"""
+    rng = random.Random(seed)
+    words = ['指标', '考核', '目标', '权重', '绩效', '门店', '转化率', '客单价', '复购', '。', '，', '\n', '**', '1.']
+    head = {'id': 'chatcmpl-bench', 'object': 'chat.completion.chunk', 'created': 1760000000, 'model': 'gemini-3-flash-preview'}
+    frames = [dict(head, choices=[{'index': 0, 'delta': {'role': 'assistant', 'content': ''}, 'finish_reason': None}])]
+    for _ in range(tokens):
+        frames.append(dict(head, choices=[{'index': 0, 'delta': {'content': rng.choice(words)}, 'finish_reason': None}]))
+    frames.append(dict(head, choices=[{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]))
+    body = ''.join(f"data: {json.dumps(frame, ensure_ascii=False)}\n\n" for frame in frames)
+    return (body + 'data: [DONE]\n\n').encode('utf-8')
+
+
+def split_reads(body: bytes, frames_per_read: int, interval: float):
+    """把响应体切成 (到达时间, 网络读到的字节)"""
+    frames = [frame + b'\n\n' for frame in body.split(b'\n\n') if frame]
+    return [
+        (i // frames_per_read * interval, b''.join(frames[i:i + frames_per_read]))
+        for i in range(0, len(frames), frames_per_read)
+    ]
+
+
+def old_pipeline(reads, fd):
+    """旧做法：requests.iter_lines 逐行切分 → decode → json.loads → 每段 json.dumps 一帧、写一次"""
+    text = []
+    writes = 0
+    pending = None
+    for _, chunk in reads:
+        if pending is not None:
+            chunk = pending + chunk
+        lines = chunk.splitlines()
+        pending = lines.pop() if lines and lines[-1] and chunk and lines[-1][-1] == chunk[-1] else None
+        for line in lines:
+            if not line:
+                continue
+            line = line.decode('utf-8')
+            if not line.startswith('data: '):
+                continue
+            data_str = line[6:]
+            if data_str == '[DONE]':
+                break
+            try:
+                data = json.loads(data_str)
+            except json.JSONDecodeError:
+                continue
+            content = data.get('choices', [{}])[0].get('delta', {}).get('content', '')
+            if content:
+                text.append(content)
+                os.write(fd, f"data: {json.dumps({'content': content})}\n\n".encode('utf-8'))
+                writes += 1
+    return ''.join(text), writes, []
+
+
+def new_pipeline(reads, fd, interval: float, max_chars: int):
+    """新做法：SSEDecoder 按批解析 → StreamCoalescer 合并 → sse_frame 一帧、写一次"""
+    decoder = SSEDecoder()
+    coalescer = StreamCoalescer(interval, max_chars)
+    text = []
+    writes = 0
+    delays = []
+    held_since = None
+    for now, chunk in reads:
+        content = decoder.feed(chunk)
+        if content:
+            if held_since is None:
+                held_since = now
+            out = coalescer.push(content, now=now)
+            if out:
+                delays.append(now - held_since)
+                held_since = None
+                text.append(out)
+                os.write(fd, sse_frame({'content': out}))
+                writes += 1
+        if decoder.done:
+            break
+    out = coalescer.flush()
+    if out:
+        text.append(out)
+        os.write(fd, sse_frame({'content': out}))
+        writes += 1
+    return ''.join(text), writes, delays
+
+
+def bench(label, fn, streams):
+    started = time.process_time()
+    results = [fn(reads) for reads in streams]
+    elapsed = time.process_time() - started
+    writes = sum(result[1] for result in results)
+    print(f"   {label:<30} {elapsed / len(streams) * 1e3:8.2f} ms CPU/流  {writes / len(streams):8.0f} 帧/流")
+    return results, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='流式 SSE 解析与合并推送微基准')
+    parser.add_argument('--record', nargs='*', default=[], help='录制的服务商响应体文件')
+    parser.add_argument('--streams', type=int, default=20, help='没有录制文件时生成的流数')
+    parser.add_argument('--tokens', type=int, default=3000, help='每条生成流的增量帧数')
+    parser.add_argument('--interval', type=float, default=0.03, help='网络读取间隔（秒）')
+    parser.add_argument('--frames-per-read', type=int, default=1, help='每次网络读取包含的帧数')
+    parser.add_argument('--flush-interval', type=float, default=0.05, help='合并推送间隔（秒）')
+    parser.add_argument('--flush-chars', type=int, default=1024, help='合并推送字数上限')
+    args = parser.parse_args()
+
+    if args.record:
+        bodies = [Path(path).read_bytes() for path in args.record]
+    else:
+        bodies = [make_stream(args.tokens, seed) for seed in range(args.streams)]
+    streams = [split_reads(body, args.frames_per_read, args.interval) for body in bodies]
+    print(f"📏 {len(bodies)} 条流，平均 {sum(len(b) for b in bodies) / len(bodies) / 1024:.0f} KB，"
+          f"每 {args.interval * 1000:.0f}ms 读取 {args.frames_per_read} 帧，JSON: {'orjson' if orjson else 'json'}")
+
+    fd = os.open(os.devnull, os.O_WRONLY)
+    try:
+        old_results, old_elapsed = bench('逐行解析 + 每段一帧', lambda reads: old_pipeline(reads, fd), streams)
+        new_results, new_elapsed = bench(
+            f'按批解析 + 合并（{args.flush_interval * 1000:.0f}ms）',
+            lambda reads: new_pipeline(reads, fd, args.flush_interval, args.flush_chars), streams
+        )
+    finally:
+        os.close(fd)
+
+    for old, new in zip(old_results, new_results):
+        assert old[0] == new[0], '两种做法输出的文本不一致'
+    delays = sorted(delay for result in new_results for delay in result[2])
+    print(f"   CPU 节省 {(1 - new_elapsed / old_elapsed) * 100:.0f}%，"
+          f"写次数减少 {(1 - sum(r[1] for r in new_results) / sum(r[1] for r in old_results)) * 100:.0f}%")
+    if delays:
+        print(f"   合并带来的推送延迟：p50 {delays[len(delays) // 2] * 1000:.0f}ms  "
+              f"p99 {delays[min(len(delays) - 1, int(len(delays) * 0.99))] * 1000:.0f}ms  "
+              f"max {delays[-1] * 1000:.0f}ms（首段 0ms）")
+
+
+if __name__ == '__main__':
+    main()
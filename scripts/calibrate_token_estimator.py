@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+标定 CJK token 估算系数
+用 tiktoken 对本地 SQLite 里的真实对话计数，最小二乘拟合 token ≈ a × CJK 字符数 + b × 其他字符数，
+输出 TOKEN_CJK_RATIO / TOKEN_CHARS_PER_TOKEN 的建议值，并对比按字符数、当前系数和拟合系数的误差
+
+用法（在项目根目录，需先 pip install tiktoken）：
+    python scripts/calibrate_token_estimator.py [--limit 5000] [--encoding o200k_base]
+"""
+import argparse
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from config import Config  # noqa: E402
+from database import db  # noqa: E402
+from modules.storage_codec import storage_codec  # noqa: E402
+from modules.token_budget import HeuristicTokenEstimator, TiktokenEstimator, count_cjk  # noqa: E402
+
+
+def load_samples(limit: int):
+    with db.connection() as conn:
+        rows = conn.execute(
+            'SELECT content FROM session_messages WHERE content IS NOT NULL ORDER BY created_at DESC LIMIT ?',
+            (limit,)
+        ).fetchall()
+    return [text for text in (storage_codec.decode(row['content']) for row in rows) if text]
+
+
+def fit(samples, counts):
+    """无截距最小二乘：解 2×2 正规方程"""
+    xs = [(count_cjk(text), len(text) - count_cjk(text)) for text in samples]
+    s11 = sum(c * c for c, _ in xs)
+    s12 = sum(c * o for c, o in xs)
+    s22 = sum(o * o for _, o in xs)
+    t1 = sum(c * y for (c, _), y in zip(xs, counts))
+    t2 = sum(o * y for (_, o), y in zip(xs, counts))
+    det = s11 * s22 - s12 * s12
+    if not det:
+        return None
+    return (t1 * s22 - t2 * s12) / det, (s11 * t2 - s12 * t1) / det
+
+
+def report(label, estimates, counts):
+    total = sum(counts)
+    errors = sorted(abs(e - y) / y for e, y in zip(estimates, counts) if y)
+    print(f"   {label:<24} 总量偏差 {(sum(estimates) - total) / total * 100:+6.1f}%  "
+          f"单条误差 p50 {errors[len(errors) // 2] * 100:5.1f}%  p95 {errors[int(len(errors) * 0.95)] * 100:5.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='用 tiktoken 标定 CJK token 估算系数')
+    parser.add_argument('--limit', type=int, default=5000, help='最多取多少条最近的消息')
+    parser.add_argument('--encoding', default=Config.TOKEN_ENCODING, help='tiktoken 编码名')
+    args = parser.parse_args()
+
+    try:
+        reference = TiktokenEstimator(args.encoding)
+    except Exception as e:
+        print(f"❌ 无法加载 tiktoken（{e}），请先 pip install tiktoken")
+        sys.exit(1)
+
+    samples = load_samples(args.limit)
+    if not samples:
+        print("❌ 本地数据库没有消息")
+        sys.exit(1)
+    counts = [reference.count(text) for text in samples]
+    print(f"📏 {len(samples)} 条消息，{sum(len(t) for t in samples)} 字符，{sum(counts)} token（{args.encoding}）")
+
+    coefficients = fit(samples, counts)
+    if coefficients is None or coefficients[1] <= 0:
+        print("❌ 样本不足以拟合（需要同时包含中文和其他字符）")
+        sys.exit(1)
+    cjk_ratio, other_ratio = coefficients
+    fitted = HeuristicTokenEstimator(cjk_ratio, 1 / other_ratio)
+    current = HeuristicTokenEstimator(Config.TOKEN_CJK_RATIO, Config.TOKEN_CHARS_PER_TOKEN)
+
+    report('按字符数', [len(text) for text in samples], counts)
+    report('当前系数', [current.count(text) for text in samples], counts)
+    report('拟合系数', [fitted.count(text) for text in samples], counts)
+
+    print("\n建议配置：")
+    print(f"   TOKEN_CJK_RATIO={cjk_ratio:.3f}")
+    print(f"   TOKEN_CHARS_PER_TOKEN={1 / other_ratio:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+流式对话压测：对比 gunicorn + gevent（Dockerfile 默认）与 uvicorn + asgi.py 的并发流式能力
+
+1. 启动模拟 AI 服务商（OpenAI 兼容 SSE，每个回复按固定间隔吐 token）：
+    python scripts/loadtest_stream.py provider --port 9100 --tokens 300 --interval 0.03
+
+2. 分别以两种方式启动应用，让 AI 请求打到模拟服务商（单 worker 便于对比单进程能力）：
+    CLOSEAI_BASE_URL=http://127.0.0.1:9100/v1 CLOSEAI_API_KEY=test YUNWU_API_KEY= \\
+        gunicorn -w 1 -k gevent --worker-connections 100 -b 0.0.0.0:3014 --timeout 120 app:app
+    CLOSEAI_BASE_URL=http://127.0.0.1:9100/v1 CLOSEAI_API_KEY=test YUNWU_API_KEY= \\
+        uvicorn asgi:app --host 0.0.0.0 --port 3015 --workers 1
+
+3. 用测试账号登录后取浏览器里的 session Cookie 和一个会话 ID（每次对话会扣积分、写消息，请用测试账号）：
+    python scripts/loadtest_stream.py run --url http://127.0.0.1:3014 --cookie 'session=...' \\
+        --session-id <会话ID> --concurrency 500 --requests 2000
+
+输出：成功 / 失败数、首个 content 帧耗时（TTFT）和总耗时的分位数、吞吐、峰值并发
+"""
+import argparse
+import asyncio
+import json
+import time
+
+
+# ========================================
+# 模拟服务商
+# ========================================
+
+async def handle_provider(reader, writer, tokens: int, interval: float):
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                return
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                if name.strip().lower() == 'content-length':
+                    length = int(value.strip())
+            if length:
+                await reader.readexactly(length)
+
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n')
+            for i in range(tokens):
+                frame = 'data: ' + json.dumps({'choices': [{'delta': {'content': f'指标{i} '}}]}) + '\n\n'
+                data = frame.encode('utf-8')
+                writer.write(b'%x\r\n%s\r\n' % (len(data), data))
+                await writer.drain()
+                await asyncio.sleep(interval)
+            done = b'data: [DONE]\n\n'
+            writer.write(b'%x\r\n%s\r\n0\r\n\r\n' % (len(done), done))
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def run_provider(args):
+    server = await asyncio.start_server(
+        lambda r, w: handle_provider(r, w, args.tokens, args.interval), args.host, args.port, backlog=4096
+    )
+    print(f"模拟服务商已启动: http://{args.host}:{args.port}/v1（每个回复 {args.tokens} token，间隔 {args.interval}s）")
+    async with server:
+        await server.serve_forever()
+
+
+# ========================================
+# 压测客户端
+# ========================================
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+async def run_load(args):
+    import httpx
+
+    results = {'ok': 0, 'error': 0, 'ttft': [], 'total': [], 'errors': {}}
+    active = 0
+    peak = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+    headers = {'Content-Type': 'application/json', 'Cookie': args.cookie, 'Origin': args.url}
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=httpx.Timeout(args.timeout)) as client:
+        async def one(index: int):
+            nonlocal active, peak
+            async with semaphore:
+                active += 1
+                peak = max(peak, active)
+                started = time.monotonic()
+                first = None
+                error = None
+                try:
+                    body = {'session_id': args.session_id, 'message': f'压测消息 {index}', 'model': args.model}
+                    async with client.stream('POST', '/api/chat/stream', json=body, headers=headers) as response:
+                        if response.status_code != 200:
+                            error = f'HTTP {response.status_code}'
+                        else:
+                            async for line in response.aiter_lines():
+                                if not line.startswith('data: '):
+                                    continue
+                                frame = json.loads(line[6:])
+                                if 'content' in frame and first is None:
+                                    first = time.monotonic() - started
+                                elif 'error' in frame:
+                                    error = frame['error'][:60]
+                                    break
+                                elif frame.get('done'):
+                                    break
+                except Exception as e:
+                    error = type(e).__name__
+                finally:
+                    active -= 1
+                if error:
+                    results['error'] += 1
+                    results['errors'][error] = results['errors'].get(error, 0) + 1
+                else:
+                    results['ok'] += 1
+                    results['ttft'].append(first or 0.0)
+                    results['total'].append(time.monotonic() - started)
+
+        started = time.monotonic()
+        await asyncio.gather(*(one(i) for i in range(args.requests)))
+        elapsed = time.monotonic() - started
+
+    print(f"目标: {args.url}  并发: {args.concurrency}  请求: {args.requests}  用时: {elapsed:.1f}s")
+    print(f"成功: {results['ok']}  失败: {results['error']}  峰值并发: {peak}  吞吐: {results['ok'] / elapsed:.1f} 流/秒")
+    for name in ('ttft', 'total'):
+        values = results[name]
+        print(f"{name:>5}: p50 {percentile(values, 50):.2f}s  p95 {percentile(values, 95):.2f}s  "
+              f"p99 {percentile(values, 99):.2f}s  max {max(values) if values else 0:.2f}s")
+    if results['errors']:
+        print('错误分布:', json.dumps(results['errors'], ensure_ascii=False))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='流式对话压测')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    provider = sub.add_parser('provider', help='启动模拟 AI 服务商')
+    provider.add_argument('--host', default='127.0.0.1')
+    provider.add_argument('--port', type=int, default=9100)
+    provider.add_argument('--tokens', type=int, default=300, help='每个回复的 token 数')
+    provider.add_argument('--interval', type=float, default=0.03, help='token 间隔（秒）')
+
+    run = sub.add_parser('run', help='对应用发起并发流式对话')
+    run.add_argument('--url', required=True, help='应用地址，如 http://127.0.0.1:3014')
+    run.add_argument('--cookie', required=True, help='登录后的 Cookie（session=...）')
+    run.add_argument('--session-id', required=True)
+    run.add_argument('--model', default='flash')
+    run.add_argument('--concurrency', type=int, default=200)
+    run.add_argument('--requests', type=int, default=1000)
+    run.add_argument('--timeout', type=float, default=300)
+
+    args = parser.parse_args()
+    if args.command == 'provider':
+        asyncio.run(run_provider(args))
+    else:
+        asyncio.run(run_load(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""
+重建全文搜索索引
+从 Supabase（不可用时为本地 SQLite）读取全部会话消息和调研记录，批量写入本地 FTS5 索引
+
+用法（在项目根目录）：
+    python scripts/rebuild_search_index.py [--batch-size 200]
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from database import db  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description='重建管理后台全文搜索索引')
+    parser.add_argument('--batch-size', type=int, default=200, help='每批处理的会话数')
+    args = parser.parse_args()
+
+    print("🔍 开始重建全文搜索索引...")
+    started = time.time()
+
+    def progress(sessions, messages):
+        print(f"   已处理 {sessions} 个会话，{messages} 条消息")
+
+    result = db.search_index.rebuild(batch_size=args.batch_size, progress=progress)
+
+    print(f"\n✅ 重建完成，耗时 {time.time() - started:.1f} 秒")
+    print(f"   会话: {result['sessions']}")
+    print(f"   消息: {result['messages']}")
+    print(f"   调研记录: {result['research_notes']}")
+
+
+if __name__ == "__main__":
+    main()